@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import resource
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from upsg.uobject import UObject, UObjectPhase
+from upsg.transform.timify import Timify
+
+ROWS_PER_BLOCK = 100000
+
+
+def make_csv(file_name, n_bytes):
+    """writes a csv of roughly n_bytes bytes with int, float, string and
+    date columns"""
+    rng = np.random.RandomState(0)
+    with open(file_name, 'w') as fout:
+        fout.write('id,score,name,date\n')
+        start = 0
+        while fout.tell() < n_bytes:
+            ids = np.arange(start, start + ROWS_PER_BLOCK)
+            scores = rng.rand(ROWS_PER_BLOCK)
+            names = rng.randint(0, 100000, ROWS_PER_BLOCK)
+            days = rng.randint(0, 10000, ROWS_PER_BLOCK)
+            dates = np.datetime64('1990-01-01') + days
+            fout.writelines('{},{},name_{},{}\n'.format(*row) for row in
+                            zip(ids, scores, names, dates))
+            start += ROWS_PER_BLOCK
+
+
+def read_genfromtxt(csv_name, upsg_name):
+    uo = UObject(UObjectPhase.Write)
+    # Passing a kwarg other than delimiter forces numpy.genfromtxt
+    uo.from_csv(csv_name, dtype=None, delimiter=',', names=True,
+                comments='#')
+    uo.write_to_read_phase()
+    uo_out = Timify().run(['output'], input=uo)['output']
+    uo_out.write_to_file(upsg_name)
+
+
+def read_streaming(csv_name, upsg_name):
+    uo = UObject(UObjectPhase.Write, file_name=upsg_name)
+    uo.from_csv(csv_name, parse_dates=True)
+
+
+def time_reader(reader, csv_name, upsg_name, results):
+    start = time.time()
+    reader(csv_name, upsg_name)
+    # ru_maxrss is in kilobytes on Linux
+    results.put((time.time() - start,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def run(n_bytes):
+    """times reading a generated csv of n_bytes bytes with numpy.genfromtxt
+    followed by Timify and with the streaming reader"""
+    tmp_dir = tempfile.mkdtemp()
+    csv_name = os.path.join(tmp_dir, 'bench.csv')
+    make_csv(csv_name, n_bytes)
+    print 'csv: {:.1f} MB'.format(os.path.getsize(csv_name) / 1e6)
+    for label, reader in (('genfromtxt + Timify', read_genfromtxt),
+                          ('streaming', read_streaming)):
+        upsg_name = os.path.join(tmp_dir, 'bench.upsg')
+        # Each reader gets its own process so that peak memory is its own
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(
+            target=time_reader,
+            args=(reader, csv_name, upsg_name, results))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            print '{}: failed with exit code {}'.format(label, proc.exitcode)
+        else:
+            seconds, peak_mb = results.get()
+            print '{}: {:.1f} s, peak memory {:.0f} MB'.format(
+                label,
+                seconds,
+                peak_mb)
+        if os.path.exists(upsg_name):
+            os.remove(upsg_name)
+    os.remove(csv_name)
+    os.rmdir(tmp_dir)
+
+
+def usage():
+    print """csv_read.py - compares reading a csv with numpy.genfromtxt and
+    with the streaming csv reader used by UObject.from_csv
+
+    usage: csv_read.py [size_mb]
+       or: csv_read.py --help displays this message
+       or: csv_read.py -h     displays this message
+
+    Arguments:
+       size_mb: The size of the generated csv in megabytes. 2000 by
+                default.
+    """
+    exit(0)
+
+if __name__ == '__main__':
+    size_mb = 2000
+    if len(sys.argv) > 1:
+        if sys.argv[1] in ('-h', '--help'):
+            usage()
+        size_mb = float(sys.argv[1])
+    run(int(size_mb * 1e6))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import tempfile
+import itertools as it
+
+import numpy as np
+import sqlalchemy
+
+from upsg.utils import np_to_sql, datetime64_to_datetime, random_table_name
+
+
+def make_array(n_rows):
+    """returns a structured array with int, float, string and datetime
+    columns"""
+    rng = np.random.RandomState(0)
+    A = np.empty(n_rows, dtype=[('id', int), ('score', float),
+                                ('name', 'S10'), ('time', 'M8[s]')])
+    A['id'] = np.arange(n_rows)
+    A['score'] = rng.rand(n_rows)
+    A['name'] = rng.randint(0, 100000, n_rows).astype('S10')
+    A['time'] = (np.datetime64('2000-01-01T00:00:00') +
+                 rng.randint(0, 10 ** 9, n_rows))
+    return A
+
+
+def per_row_insert(A, tbl_name, conn):
+    """uploads A the way np_to_sql used to: a dict per row and a single
+    SQLAlchemy executemany"""
+    md = sqlalchemy.MetaData()
+    tbl = sqlalchemy.Table(
+        tbl_name,
+        md,
+        sqlalchemy.Column('id', sqlalchemy.BIGINT),
+        sqlalchemy.Column('score', sqlalchemy.FLOAT),
+        sqlalchemy.Column('name', sqlalchemy.VARCHAR(10)),
+        sqlalchemy.Column('time', sqlalchemy.DATETIME))
+    md.create_all(conn)
+    conn.execute(
+        tbl.insert(),
+        [dict(it.izip(A.dtype.names,
+                      [datetime64_to_datetime(cell) for cell in row])) for
+         row in A])
+    return tbl
+
+
+def run(n_rows):
+    """times uploading an array of n_rows rows to a SQLite database"""
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, 'bench.db')
+    conn = sqlalchemy.create_engine('sqlite:///{}'.format(db_path)).connect()
+    A = make_array(n_rows)
+    print 'rows: {}'.format(n_rows)
+    for label, upload in (('per-row insert', per_row_insert),
+                          ('np_to_sql', np_to_sql)):
+        start = time.time()
+        tbl = upload(A, random_table_name(), conn)
+        seconds = time.time() - start
+        count = conn.execute(
+            sqlalchemy.select([sqlalchemy.func.count()]).select_from(
+                tbl)).scalar()
+        print '{}: {:.1f} s ({} rows in table)'.format(label, seconds, count)
+        tbl.drop(conn)
+    conn.close()
+    os.remove(db_path)
+    os.rmdir(tmp_dir)
+
+
+def usage():
+    print """np_to_sql.py - compares uploading a structured array to SQLite
+    with per-row inserts and with np_to_sql
+
+    usage: np_to_sql.py [n_rows]
+       or: np_to_sql.py --help displays this message
+       or: np_to_sql.py -h     displays this message
+
+    Arguments:
+       n_rows: The number of rows to upload. 1000000 by default.
+    """
+    exit(0)
+
+if __name__ == '__main__':
+    n_rows = 1000000
+    if len(sys.argv) > 1:
+        if sys.argv[1] in ('-h', '--help'):
+            usage()
+        n_rows = int(sys.argv[1])
+    run(n_rows)
@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+
+from utils import path_of_data, UPSGTestCase
+
+from upsg.db import get_engine, get_connection, dispose_engines
+from upsg.db import engine_keys
+from upsg.db import reflect_table, invalidate_tables
+from upsg.db import find_upload, drop_uploads
+from upsg.uobject import UObject, UObjectPhase
+
+
+class TestDB(UPSGTestCase):
+
+    def test_registry(self):
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        engine = get_engine(db_url)
+        self.assertIs(get_engine(db_url, {}), engine)
+        self.assertIsNot(get_engine(db_url, {'timeout': 10}), engine)
+        conn = get_connection(db_url)
+        self.assertIs(conn.engine, engine)
+        dispose_engines()
+        self.assertIsNot(get_engine(db_url), engine)
+        # connections that were checked out still work
+        self.assertEqual(
+            conn.execute('SELECT COUNT(*) FROM employees').scalar(), 
+            3)
+        conn.close()
+        # Only engines created since engine_keys was called are disposed,
+        # and in-memory databases are kept
+        engine = get_engine(db_url)
+        mem_engine = get_engine('sqlite://')
+        mem_engine.execute('CREATE TABLE t (x INTEGER)')
+        existing = engine_keys()
+        new_engine = get_engine(db_url, {'timeout': 10})
+        mem_engine_2 = get_engine('sqlite:///:memory:')
+        dispose_engines(existing)
+        self.assertIs(get_engine(db_url), engine)
+        self.assertIs(get_engine('sqlite://'), mem_engine)
+        self.assertIs(get_engine('sqlite:///:memory:'), mem_engine_2)
+        self.assertIsNot(get_engine(db_url, {'timeout': 10}), new_engine)
+        self.assertTrue(mem_engine.dialect.has_table(mem_engine, 't'))
+        dispose_engines()
+
+    def test_reflect_table(self):
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        conn = get_connection(db_url)
+        tbl = reflect_table(conn, db_url, 'employees')
+        self.assertEqual(tbl.metadata.tables.keys(), ['employees'])
+        self.assertIs(reflect_table(conn, db_url, 'employees'), tbl)
+        conn.execute('ALTER TABLE employees ADD COLUMN age INTEGER')
+        invalidate_tables(db_url, ['hours'])
+        self.assertIs(reflect_table(conn, db_url, 'employees'), tbl)
+        invalidate_tables(db_url)
+        self.assertIn('age', reflect_table(conn, db_url, 'employees').c)
+        conn.close()
+        invalidate_tables()
+
+    def test_upload_cache(self):
+        db_url = 'sqlite:///{}'.format(self._tmp_files('test_uploads.db'))
+        A = np.array([(1, 'a'), (2, 'b')], dtype=[('id', int), ('name', 'S1')])
+
+        def upload(A):
+            uo = UObject(UObjectPhase.Write)
+            uo.from_np(A)
+            uo.write_to_read_phase()
+            return uo.fingerprint(), uo.to_sql(db_url, {}).table.name
+
+        fingerprint, tbl_name = upload(A)
+        # Same contents in a different UObject
+        self.assertEqual(upload(A.copy()), (fingerprint, tbl_name))
+        B = A.copy()
+        B['id'][1] = 3
+        fingerprint_B, tbl_name_B = upload(B)
+        self.assertNotEqual(fingerprint_B, fingerprint)
+        self.assertNotEqual(tbl_name_B, tbl_name)
+        conn = get_connection(db_url)
+        self.assertEqual(find_upload(conn, db_url, fingerprint), tbl_name)
+        # Only the uploads we ask for are dropped
+        drop_uploads(conn, db_url, [tbl_name, 'not_an_upload'])
+        self.assertEqual(find_upload(conn, db_url, fingerprint_B), 
+                         tbl_name_B)
+        self.assertIsNone(find_upload(conn, db_url, fingerprint))
+        self.assertFalse(conn.dialect.has_table(conn, tbl_name))
+        # Uploads are made again once they've been dropped
+        self.assertNotEqual(upload(A)[1], tbl_name)
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from utils import TEMP_PATH, UPSGTestCase
+
+from upsg.memo import Memo, stage_fingerprint
+from upsg.pipeline import Pipeline
+from upsg.stage import RunnableStage
+from upsg.uobject import UObject, UObjectPhase
+from upsg.fetch.np import NumpyRead
+from upsg.export.np import NumpyWrite
+from upsg.transform.split import SplitColumns
+from upsg.wrap.wrap_sklearn import wrap_and_make_instance
+
+
+class ScaleStage(RunnableStage):
+    # Multiplies the 'val' column by factor. Records each run in runs
+    runs = []
+
+    def __init__(self, factor):
+        self.__factor = factor
+
+    @property
+    def input_keys(self):
+        return ['input']
+
+    @property
+    def output_keys(self):
+        return ['output']
+
+    def run(self, outputs_requested, **kwargs):
+        ScaleStage.runs.append(self.__factor)
+        A = kwargs['input'].to_np().copy()
+        A['val'] *= self.__factor
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np(A)
+        return {'output': uo}
+
+
+class TestMemo(UPSGTestCase):
+
+    def setUp(self):
+        super(TestMemo, self).setUp()
+        self.__dir = tempfile.mkdtemp(dir=TEMP_PATH)
+        del ScaleStage.runs[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.__dir)
+        super(TestMemo, self).tearDown()
+
+    def __run(self, memo, A, factors, mode='dbg'):
+        p = Pipeline()
+        read_node = p.add(NumpyRead(A))
+        # SplitColumns outputs a view, which is cached as a table
+        split_node = p.add(SplitColumns(['val']))
+        read_node['output'] > split_node['input']
+        last = split_node
+        for factor in factors:
+            scale_node = p.add(ScaleStage(factor))
+            last['output'] > scale_node['input']
+            last = scale_node
+        write = NumpyWrite()
+        last['output'] > p.add(write)['input']
+        p.run(mode, memo=memo)
+        return write.result
+
+    def test_memo(self):
+        memo = Memo(self.__dir)
+        A = np.array([(1, 0.5), (2, 1.5)], dtype=[('id', int),
+                                                  ('val', float)])
+        ctrl = A[['val']].copy()
+        ctrl['val'] *= 6
+        self.assertTrue(np.array_equal(self.__run(memo, A, [2, 3]), ctrl))
+        self.assertEqual(ScaleStage.runs, [2, 3])
+        # Nothing has changed, so nothing past the read is run
+        for mode in ('dbg', 'parallel'):
+            self.assertTrue(np.array_equal(
+                self.__run(memo, A, [2, 3], mode),
+                ctrl))
+            self.assertEqual(ScaleStage.runs, [2, 3])
+        # Only the changed stage and what follows it is run
+        ctrl['val'] *= 5.0 / 3
+        self.assertTrue(np.array_equal(self.__run(memo, A, [2, 5]), ctrl))
+        self.assertEqual(ScaleStage.runs, [2, 3, 5])
+        # Changed input data is noticed
+        B = A.copy()
+        B['val'][0] = 10
+        self.assertEqual(self.__run(memo, B, [2, 5])['val'][0], 100)
+        self.assertEqual(ScaleStage.runs, [2, 3, 5, 2, 5])
+
+        # Least recently used entries are evicted
+        memo = Memo(self.__dir, max_bytes=0)
+        self.__run(memo, A, [7])
+        self.assertEqual(len(os.listdir(self.__dir)), 1)
+
+    def test_stage_fingerprint(self):
+        self.assertEqual(stage_fingerprint(ScaleStage(2)),
+                         stage_fingerprint(ScaleStage(2)))
+        self.assertNotEqual(stage_fingerprint(ScaleStage(2)),
+                            stage_fingerprint(ScaleStage(3)))
+        from sklearn.svm import SVC
+        self.assertEqual(stage_fingerprint(wrap_and_make_instance(SVC, C=2)),
+                         stage_fingerprint(wrap_and_make_instance(SVC, C=2)))
+        self.assertNotEqual(
+            stage_fingerprint(wrap_and_make_instance(SVC, C=2)),
+            stage_fingerprint(wrap_and_make_instance(SVC, C=3)))
+
+if __name__ == '__main__':
+    unittest.main()
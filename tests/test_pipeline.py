@@ -2,11 +2,17 @@ import numpy as np
 from os import system
 import unittest
 import inspect
+import gc
+import weakref
 from StringIO import StringIO
 
-from upsg.pipeline import Pipeline
+from upsg.pipeline import Pipeline, PipelineException
 from upsg.export.csv import CSVWrite
 from upsg.fetch.csv import CSVRead
+from upsg.fetch.np import NumpyRead
+from upsg.export.np import NumpyWrite, NumpyWriteError
+from upsg.transform.split import SplitColumns, Query
+from upsg.transform.fill_na import FillNA
 from upsg.wrap.wrap_sklearn import wrap_and_make_instance
 from upsg.stage import RunnableStage
 from upsg.uobject import UObject, UObjectPhase
@@ -69,6 +75,80 @@ class MockupStage(RunnableStage):
     def run(self, outputs_requested, **kwargs):
         return {}
 
+class ChainStage(RunnableStage):
+    # Records which of the outputs of earlier ChainStages are still alive
+    # when it runs
+
+    def __init__(self, refs):
+        self.__refs = refs
+        self.alive = None
+
+    @property
+    def input_keys(self):
+        return ['input']
+
+    @property
+    def output_keys(self):
+        return ['output']
+
+    def run(self, outputs_requested, **kwargs):
+        gc.collect()
+        self.alive = [ref() is not None for ref in self.__refs]
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np(np.array([(len(self.__refs),)], dtype=[('i', int)]))
+        self.__refs.append(weakref.ref(uo))
+        return {'output': uo}
+
+class CountingStage(RunnableStage):
+    # Passes its input through, counting the times it's run
+    n_runs = 0
+
+    @property
+    def input_keys(self):
+        return ['input']
+
+    @property
+    def output_keys(self):
+        return ['output']
+
+    def run(self, outputs_requested, **kwargs):
+        CountingStage.n_runs += 1
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np(kwargs['input'].to_np())
+        return {'output': uo}
+
+class ChunkedSource(RunnableStage):
+    # Writes random rows, some with NaNs, to file_name with from_np_chunks
+    N_CHUNKS = 200
+    CHUNK_ROWS = 1000
+
+    def __init__(self, seed, file_name):
+        self.__seed = seed
+        self.__file_name = file_name
+
+    @property
+    def input_keys(self):
+        return []
+
+    @property
+    def output_keys(self):
+        return ['output']
+
+    def chunks(self):
+        rs = np.random.RandomState(self.__seed)
+        for _ in xrange(self.N_CHUNKS):
+            A = np.empty(self.CHUNK_ROWS, dtype=[('id', int), 
+                                                 ('val', float)])
+            A['id'] = rs.randint(0, 100, self.CHUNK_ROWS)
+            A['val'] = rs.rand(self.CHUNK_ROWS)
+            A['val'][::7] = np.nan
+            yield A
+
+    def run(self, outputs_requested, **kwargs):
+        uo = UObject(UObjectPhase.Write, file_name=self.__file_name)
+        uo.from_np_chunks(self.chunks())
+        return {'output': uo}
+
 class TestPipeline(UPSGTestCase):
 
     def test_rw(self):
@@ -234,5 +314,163 @@ class TestPipeline(UPSGTestCase):
         p_result_out(p_result_clf['y_pred'], p_result_clf['params'])
 
         self.assertTrue(p_ctrl.is_equal_by_str(p_result))
+
+    def test_dependency_index(self):
+        p = Pipeline()
+        nodes = [p.add(MockupStage(in_keys, out_keys), label) for 
+                 label, in_keys, out_keys in (
+                    ('sink', ('x', 'y'), ()),
+                    ('mid', ('input',), ('output',)),
+                    ('src', (), ('output', 'complement')))]
+        sink, mid, src = nodes
+        src['output'] > mid['input']
+        src['complement'] > sink['x']
+        mid['output'] > sink['y']
+        index = p.dependency_index()
+        self.assertEqual(index.nodes, [src, mid, sink])
+        self.assertEqual(index.in_degree, {src: 0, mid: 1, sink: 2})
+        self.assertEqual(set(index.producers[sink]), {mid, src})
+        self.assertEqual(set(index.consumers[src]), {mid, sink})
+
+        p = Pipeline()
+        csv_read_node = p.add(CSVRead(path_of_data('mixed_csv.csv')))
+        csv_write_node = p.add(CSVWrite(self._tmp_files.get('out.csv')))
+        self.assertRaises(PipelineException, p.dependency_index)
+        self.assertRaises(PipelineException, p.run)
+        csv_read_node > csv_write_node
+        p.dependency_index()
+
+        p = Pipeline()
+        a = p.add(MockupStage(('input',), ('output',)))
+        b = p.add(MockupStage(('input',), ('output',)))
+        a > b
+        b > a
+        self.assertRaises(PipelineException, p.dependency_index)
+
+    def test_release_outputs(self):
+        for mode in ('dbg', 'parallel'):
+            refs = []
+            stages = [ChainStage(refs) for _ in xrange(4)]
+            p = Pipeline()
+            nodes = [p.add(stage) for stage in stages]
+            for producer, consumer in zip(nodes[:-1], nodes[1:]):
+                producer > consumer
+            p.run(mode)
+            # Only the input of each stage is still around when it runs
+            self.assertEqual(
+                [stage.alive for stage in stages],
+                [[], [True], [False, True], [False, False, True]])
+
+    def test_luigi_resume(self):
+        A = np.array([(1, 0.5), (2, 1.5)], dtype=[('id', int),
+                                                  ('val', float)])
+        CountingStage.n_runs = 0
+
+        def run(A, **kwargs):
+            p = Pipeline()
+            p.add(NumpyRead(A))['output'] > p.add(CountingStage())['input']
+            count_node = p.add(CountingStage())
+            p.add(NumpyRead(A))['output'] > count_node['input']
+            write = NumpyWrite()
+            count_node['output'] > p.add(write)['input']
+            p.run('luigi_quiet', **kwargs)
+            return write.result
+
+        # Outputs are only reused when asked for
+        self.assertTrue(np.array_equal(run(A), A))
+        self.assertTrue(np.array_equal(run(A), A))
+        self.assertEqual(CountingStage.n_runs, 4)
+
+        CountingStage.n_runs = 0
+        self.assertTrue(np.array_equal(run(A, resume=True), A))
+        self.assertEqual(CountingStage.n_runs, 2)
+        # The output of the connected CountingStage is found on disk, and
+        # the stages without connected outputs left markers, so nothing is
+        # run again
+        self.assertRaises(NumpyWriteError, run, A, resume=True)
+        self.assertEqual(CountingStage.n_runs, 2)
+        B = A.copy()
+        B['val'] += 1
+        self.assertTrue(np.array_equal(run(B, resume=True), B))
+        self.assertEqual(CountingStage.n_runs, 4)
+        run(A, resume=True, run_id='other')
+        self.assertEqual(CountingStage.n_runs, 6)
+
+        # With more than one worker, stages run in other processes
+        p = Pipeline()
+        count_node = p.add(CountingStage())
+        p.add(NumpyRead(B))['output'] > count_node['input']
+        count_node['output'] > p.add(
+            CSVWrite(self._tmp_files.get('out.csv')))['input']
+        p.run('luigi_quiet', workers=2, resume=True)
+        self.assertTrue(np.array_equal(self._tmp_files.csv_read('out.csv'),
+                                       B))
+
+    def test_run_parallel(self):
+        p = Pipeline()
+        sout = StringIO()
+        s0 = OneCellLambdaStage(lambda: 'S0')
+        s1 = OneCellLambdaStage(lambda: 'S1')
+        s2 = OneCellLambdaStage(lambda x: '({})->I2'.format(x))
+        s3 = OneCellLambdaStage(lambda x, y: '({},{})->T3'.format(x, y),
+                                fout=sout)
+        nodes = [p.add(s) for s in (s0, s1, s2, s3)]
+        nodes[0]['fx'] > nodes[2]['x']
+        nodes[2]['fx'] > nodes[3]['x']
+        nodes[1]['fx'] > nodes[3]['y']
+        p.run('parallel', n_workers=2)
+        self.assertEqual(sout.getvalue(), '((S0)->I2,S1)->T3')
+
+        A = np.array([(1, 0.5, 'a'), (2, 1.5, 'b'), (3, 2.5, 'c')],
+                     dtype=[('id', int), ('val', float), ('name', 'S1')])
+        for pool in ('thread', 'process'):
+            p = Pipeline()
+            read_node = p.add(NumpyRead(A))
+            split_node = p.add(SplitColumns(['id']))
+            write_output = NumpyWrite()
+            write_complement = NumpyWrite()
+            write_whole = NumpyWrite()
+            read_node['output'] > split_node['input']
+            split_node['output'] > p.add(write_output)['input']
+            split_node['complement'] > p.add(write_complement)['input']
+            p.add(NumpyRead(A)) > p.add(write_whole)
+            p.run('parallel', pool=pool)
+            self.assertTrue(np.array_equal(write_output.result, A[['id']]))
+            self.assertTrue(np.array_equal(write_complement.result,
+                                           A[['val', 'name']]))
+            # Threads share the process, so the array is never copied
+            self.assertEqual(
+                np.may_share_memory(write_whole.result, A),
+                pool == 'thread')
+
+        # Many threads reading and writing hdf5 at once
+        p = Pipeline()
+        sources = []
+        writes = []
+        for seed in xrange(16):
+            source = ChunkedSource(seed, self._tmp_files.get(
+                'chunked_{}.upsg'.format(seed)))
+            query_node = p.add(Query('id < 50'))
+            fill_node = p.add(FillNA(-1))
+            write = NumpyWrite()
+            p.add(source)['output'] > query_node['input']
+            query_node['output'] > fill_node['input']
+            fill_node['output'] > p.add(write)['input']
+            sources.append(source)
+            writes.append(write)
+        p.run('parallel', n_workers=8, pool='thread')
+        for source, write in zip(sources, writes):
+            ctrl = np.concatenate(list(source.chunks()))
+            ctrl = ctrl[ctrl['id'] < 50]
+            ctrl['val'][np.isnan(ctrl['val'])] = -1
+            self.assertTrue(np.array_equal(write.result, ctrl))
+
+        p = Pipeline()
+        split_node = p.add(SplitColumns(['no_such_column']))
+        p.add(NumpyRead(A)) > split_node
+        split_node['output'] > p.add(NumpyWrite())['input']
+        for pool in ('thread', 'process'):
+            self.assertRaises(Exception, p.run, 'parallel', pool=pool)
+
 if __name__ == '__main__':
     unittest.main()
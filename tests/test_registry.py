@@ -0,0 +1,139 @@
+import os
+import imp
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import sqlalchemy
+
+from utils import BIN_PATH, TEMP_PATH, UPSGTestCase
+
+from upsg.registry import REGISTRY_ENV_VAR, RegistryEntry
+from upsg.registry import get_registry_path, register_file, read_registry
+from upsg.registry import write_registry
+from upsg.uobject import UObject, UObjectPhase
+from upsg.utils import np_to_sql
+from upsg.db import get_connection, find_upload
+
+cleanup = imp.load_source('cleanup', os.path.join(BIN_PATH, 'cleanup.py'))
+
+
+class TestRegistry(UPSGTestCase):
+
+    def setUp(self):
+        super(TestRegistry, self).setUp()
+        self.__dir = tempfile.mkdtemp(dir=TEMP_PATH)
+        os.environ[REGISTRY_ENV_VAR] = os.path.join(self.__dir, 'registry')
+
+    def tearDown(self):
+        del os.environ[REGISTRY_ENV_VAR]
+        shutil.rmtree(self.__dir)
+        super(TestRegistry, self).tearDown()
+
+    def test_cleanup(self):
+        db_url = 'sqlite:///{}'.format(os.path.join(self.__dir, 'reg.db'))
+        conn = sqlalchemy.create_engine(db_url).connect()
+        A = np.array([(1, 0.5), (2, 1.5)], dtype=[('id', int),
+                                                  ('val', float)])
+        np_to_sql(A, 'old_tbl', conn)
+        np_to_sql(A, 'new_tbl', conn)
+        np_to_sql(A, 'user_tbl', conn)
+        file_names = [os.path.join(self.__dir, name) for name in
+                      ('old.upsg', 'new.upsg')]
+        for file_name in file_names:
+            open(file_name, 'w').close()
+        # Tables made by pipelines are registered as they're made
+        uo = UObject(UObjectPhase.Write)
+        uo.from_sql(db_url, {}, 'new_tbl', True)
+        uo.write_to_read_phase()
+        uo_view = UObject(UObjectPhase.Write)
+        uo_view.from_view(uo, ['id'])
+        uo_view.write_to_read_phase()
+        view_name = str(uo_view.to_sql(db_url, {}).table.name)
+        uo_view.cleanup()
+        uo.cleanup()
+        register_file(file_names[1])
+        # Pretend that these were made a day ago
+        day_ago = time.time() - 24 * 60 * 60
+        registry_path = get_registry_path()
+        write_registry(registry_path, [
+            RegistryEntry(day_ago, 'sql', 'old_tbl', db_url, {}),
+            RegistryEntry(day_ago, 'file', file_names[0], None, None)])
+        self.assertEqual(
+            sorted(entry.name for entry in read_registry(registry_path)),
+            sorted(['new_tbl', view_name, 'old_tbl'] + file_names))
+
+        def tables_left():
+            inspector = sqlalchemy.inspect(conn)
+            return set(inspector.get_table_names() +
+                       inspector.get_view_names())
+
+        cleanup.run(self.__dir, cleanup.parse_age('12h'))
+        self.assertEqual(tables_left(),
+                         {'new_tbl', 'user_tbl', view_name})
+        self.assertFalse(os.path.exists(file_names[0]))
+        self.assertTrue(os.path.exists(file_names[1]))
+        self.assertEqual(len(read_registry(registry_path)), 3)
+
+        cleanup.run(self.__dir)
+        self.assertEqual(tables_left(), {'user_tbl'})
+        self.assertFalse(os.path.exists(file_names[1]))
+        self.assertEqual(read_registry(registry_path), [])
+        conn.close()
+
+    def test_cleanup_views(self):
+        A = np.array([(1, 0.5), (2, 1.5)], dtype=[('id', int),
+                                                  ('val', float)])
+        parent_file = os.path.join(self.__dir, 'parent.upsg')
+        uo = UObject(UObjectPhase.Write, file_name=parent_file)
+        uo.from_np(A)
+        uo.write_to_read_phase()
+        view_file = os.path.join(self.__dir, 'view.upsg')
+        uo_view = UObject(UObjectPhase.Write)
+        uo_view.from_view(uo, ['val'])
+        uo_view.write_to_file(view_file)
+        uo_view.cleanup()
+        uo.cleanup()
+        # The parent was made a day ago, but the view was just made
+        day_ago = time.time() - 24 * 60 * 60
+        write_registry(get_registry_path(), [
+            RegistryEntry(day_ago, 'file', parent_file, None, None)])
+        register_file(view_file)
+        cleanup.run(self.__dir, cleanup.parse_age('12h'))
+        self.assertTrue(os.path.exists(parent_file))
+        uo_view = UObject(UObjectPhase.Read, file_name=view_file)
+        self.assertTrue(np.array_equal(uo_view.to_np()['val'], A['val']))
+        uo_view.cleanup()
+        cleanup.run(self.__dir)
+        self.assertFalse(os.path.exists(parent_file))
+        self.assertFalse(os.path.exists(view_file))
+
+    def test_cleanup_uploads(self):
+        db_url = 'sqlite:///{}'.format(os.path.join(self.__dir, 'up.db'))
+
+        def upload(A):
+            uo = UObject(UObjectPhase.Write)
+            uo.from_np(A)
+            uo.write_to_read_phase()
+            tbl_name = str(uo.to_sql(db_url, {}).table.name)
+            fingerprint = uo.fingerprint()
+            uo.cleanup()
+            return fingerprint, tbl_name
+
+        A = np.array([(1, 0.5), (2, 1.5)], dtype=[('id', int),
+                                                  ('val', float)])
+        # An upload made by a pipeline running in another directory
+        os.environ[REGISTRY_ENV_VAR] = os.path.join(self.__dir, 'other')
+        theirs = upload(A)
+        os.environ[REGISTRY_ENV_VAR] = os.path.join(self.__dir, 'registry')
+        ours = upload(A[:1])
+        cleanup.run(self.__dir)
+        conn = get_connection(db_url)
+        self.assertEqual(find_upload(conn, db_url, theirs[0]), theirs[1])
+        self.assertIsNone(find_upload(conn, db_url, ours[0]))
+        self.assertFalse(conn.dialect.has_table(conn, ours[1]))
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
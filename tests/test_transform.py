@@ -1,20 +1,24 @@
 import ast
 import numpy as np
 from os import system
+import itertools as it
 import unittest
 
 from numpy.lib.recfunctions import append_fields
 from numpy.lib.recfunctions import merge_arrays
 
 import pandas as pd
+import sqlalchemy
 
 from sklearn.cross_validation import KFold as SKKFold
 
 from upsg.pipeline import Pipeline
+from upsg.uobject import UObject, UObjectPhase
 from upsg.export.csv import CSVWrite
 from upsg.export.np import NumpyWrite
 from upsg.fetch.csv import CSVRead
 from upsg.fetch.np import NumpyRead
+from upsg.fetch.sql import SQLRead
 from upsg.transform.rename_cols import RenameCols
 from upsg.transform.sql import RunSQL
 from upsg.transform.split import Query, SplitColumns, KFold, SplitByInds
@@ -29,6 +33,7 @@ from upsg.transform.hstack import HStack
 from upsg.transform.generate_feature import GenerateFeature
 from upsg.wrap.wrap_sklearn import wrap
 from upsg.utils import np_nd_to_sa, np_sa_to_nd, is_sa, obj_to_str
+from upsg.utils import np_to_sql, SQLPartitioning
 
 from utils import path_of_data, UPSGTestCase, csv_read
 
@@ -237,6 +242,129 @@ class TestTransform(UPSGTestCase):
         self.assertTrue(np.array_equal(np_out_inds.get_stage().result, inds[:2]))
         self.assertTrue(np.array_equal(np_complement_inds.get_stage().result, inds[2:]))
 
+    def test_query_stats(self):
+        # Queries that the table's statistics decide, and one that they 
+        # don't
+        A = np.array([(1, 2.5), (5, np.nan), (3, 0.5)], 
+                     dtype=[('id', int), ('val', float)])
+        tests = [("id < 10", [True, True, True]),
+                 ("id > 5", [False, False, False]),
+                 ("(id >= 1) and not (val > 3.0)", [True, True, True]),
+                 ("(id > 1) and (val > 3.0)", [False, False, False]),
+                 ("(val != 7.0) or (id == 2)", [True, True, True]),
+                 ("val < 3.0", [True, False, True]),
+                 ("id != 3", [True, True, False])]
+        uo_written = UObject(UObjectPhase.Write)
+        uo_written.from_np(A)
+        # Statistics are only used if they've been stored
+        image = uo_written.get_image()
+        for (query, ctrl_mask), in_memory in it.product(tests, (True, False)):
+            if in_memory:
+                uo_in = UObject(UObjectPhase.Write)
+                uo_in.from_np(A)
+                uo_in.write_to_read_phase()
+            else:
+                uo_in = UObject(UObjectPhase.Read, image)
+            result = Query(query).run(['output', 'complement'], input=uo_in)
+            for key in result:
+                result[key].write_to_read_phase()
+            # ids are unique, and unlike vals, don't have NaNs
+            ctrl_mask = np.array(ctrl_mask)
+            self.assertTrue(np.array_equal(result['output'].to_np()['id'], 
+                                           A[ctrl_mask]['id']))
+            self.assertTrue(np.array_equal(
+                result['complement'].to_np()['id'], 
+                A[np.logical_not(ctrl_mask)]['id']))
+
+    def test_sql_failure(self):
+        # A statement that fails leaves no outputs behind, even in SQLite, 
+        # which commits CREATE TABLE as soon as it's run
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        q = ('CREATE TABLE {out} AS SELECT * FROM employees; '
+             'INSERT INTO {out} SELECT * FROM no_such_table;')
+        stage = RunSQL(db_url, q, [], ['out'], {}, unlogged=True)
+        conn = sqlalchemy.create_engine(db_url).connect()
+        tables_before = set(sqlalchemy.inspect(conn).get_table_names())
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            stage.run(['out'])
+        self.assertEqual(set(sqlalchemy.inspect(conn).get_table_names()),
+                         tables_before)
+        conn.close()
+
+    def test_query_sql(self):
+        # Queries of tables in sql are run in the database, and select the 
+        # same rows as they would in numpy
+        db_url = 'sqlite:///{}'.format(self._tmp_files('test_query_sql.db'))
+        conn = sqlalchemy.create_engine(db_url).connect()
+        A = np.array([(1, 2.5, 'a', '2012-01-01T00:00:00'), 
+                      (5, np.nan, 'bb', 'NaT'), 
+                      (3, 0.5, 'a', '2014-03-11T12:00:00')], 
+                     dtype=[('id', int), ('val', float), ('name', 'S2'),
+                            ('dt', 'M8[s]')])
+        np_to_sql(A, 'query_sql', conn)
+        conn.close()
+        tests = ["val < 3.0",
+                 "val != 2.5",
+                 "not val > 1.0",
+                 "(name == 'a') and (id > 2)",
+                 "(dt < DT('2013-01-01')) or (id == 5)",
+                 "1 < id"]
+        for query in tests:
+            uo_in = UObject(UObjectPhase.Write)
+            uo_in.from_np(A)
+            uo_in.write_to_read_phase()
+            ctrl = Query(query).run(['output', 'complement', 'output_inds'], 
+                                    input=uo_in)
+            uo_in = UObject(UObjectPhase.Write)
+            uo_in.from_sql(db_url, {}, 'query_sql', False)
+            uo_in.write_to_read_phase()
+            result = Query(query).run(['output', 'complement', 'output_inds'], 
+                                      input=uo_in)
+            for key in result:
+                result[key].write_to_read_phase()
+                ctrl[key].write_to_read_phase()
+            self.assertEqual(result['output'].get_storage_method(), 'sql')
+            self.assertEqual(result['complement'].get_storage_method(), 
+                             'sql')
+            for key in ('output', 'complement'):
+                self.assertTrue(np.array_equal(result[key].to_np()['id'], 
+                                               ctrl[key].to_np()['id']))
+            self.assertTrue(np.array_equal(result['output_inds'].to_np(), 
+                                           ctrl['output_inds'].to_np()))
+
+    def test_sql_read(self):
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        tests = [({}, 
+                  ['id', 'last_name', 'first_name', 'salary', 'height', 
+                   'usefulness'],
+                  [1, 2, 3]),
+                 ({'columns': ['salary', 'id'], 
+                   'query': 'salary < 100000', 
+                   'order_by': ['-salary']},
+                  ['salary', 'id'],
+                  [3, 1]),
+                 ({'order_by': ['usefulness'], 'limit': 2},
+                  None,
+                  [2, 3]),
+                 ({'columns': ['id'], 'sample': 1.0},
+                  ['id'],
+                  [1, 2, 3]),
+                 ({'partitioning': SQLPartitioning('salary', 2, 'range', 2)},
+                  None,
+                  [1, 3, 2])]
+        for kwargs, ctrl_cols, ctrl_ids in tests:
+            result = SQLRead(db_url, 'employees', **kwargs).run(['output'])
+            uo_out = result['output']
+            uo_out.write_to_read_phase()
+            self.assertEqual(uo_out.get_storage_method(), 'sql')
+            if ctrl_cols is not None:
+                self.assertEqual(uo_out.get_column_names(), ctrl_cols)
+            self.assertEqual(list(uo_out.to_np()['id']), ctrl_ids)
+
     def test_fill_na(self):
 
         p = Pipeline()
@@ -566,6 +694,26 @@ class TestTransform(UPSGTestCase):
 
         self.assertTrue(np.array_equal(ctrl, out.get_stage().result))
 
+    def test_split_by_inds_sql(self):
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        ctrl = SQLRead(db_url, 'employees').run(['output'])['output']
+        ctrl.write_to_read_phase()
+        ctrl = ctrl.to_np()[[2, 0]]
+
+        p = Pipeline()
+        sql_in = p.add(SQLRead(db_url, 'employees'))
+        inds_in = p.add(NumpyRead(np.array([(2,), (0,)], 
+                                           dtype=[('ind', int)])))
+        split_inds = p.add(SplitByInds())
+        split_inds(sql_in, inds_in)
+        out = p.add(NumpyWrite())
+        out(split_inds)
+        self.run_pipeline(p)
+
+        self.assertTrue(np.array_equal(ctrl, out.get_stage().result))
+
     def test_hstack(self):
         a = np.array(
                 [(0.0, 0.1), (1.0, 1.1), (2.0, 2.1)], 
@@ -1,10 +1,13 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 from os import system
 import unittest
 
 from upsg.uobject import *
-from upsg.utils import np_type
-from utils import path_of_data, UPSGTestCase
+from upsg.utils import np_type, np_nd_to_sa, np_sa_to_nd
+from utils import path_of_data, UPSGTestCase, TEMP_PATH
 
 
 class TestUObject(UPSGTestCase):
@@ -52,6 +55,252 @@ class TestUObject(UPSGTestCase):
         d = uo.to_dict()
         self.assertEqual(d, self.test_dict)
 
+    def test_in_memory_handoff(self):
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np(self.test_array)
+        uo.write_to_read_phase()
+        A = uo.to_np()
+        self.assertTrue(np.array_equal(self.test_array, A))
+        # the reader gets the writer's data without a copy, but can't
+        # change it
+        self.assertTrue(np.may_share_memory(self.test_array, A))
+        self.assertFalse(A.flags.writeable)
+        # an image can still be produced on demand
+        uo_image = UObject(UObjectPhase.Read, uo.get_image())
+        self.assertTrue(np.array_equal(self.test_array, uo_image.to_np()))
+
+    def test_file_backed(self):
+        # write directly to disk
+        file_name = self._tmp_files('test_file_backed.upsg')
+        uo = UObject(UObjectPhase.Write, file_name=file_name)
+        uo.from_np(self.test_array)
+        uo.write_to_read_phase()
+        self.assertTrue(np.array_equal(self.test_array, uo.to_np()))
+        uo.cleanup()
+        uo_read = UObject(UObjectPhase.Read, file_name=file_name)
+        self.assertTrue(np.array_equal(self.test_array, uo_read.to_np()))
+        uo_read.cleanup()
+
+        # copy an in-memory UObject to disk
+        file_name_copy = self._tmp_files('test_file_backed_copy.upsg')
+        uo = UObject(UObjectPhase.Write)
+        uo.from_dict(self.test_dict)
+        uo.write_to_file(file_name_copy)
+        uo_read = UObject(UObjectPhase.Read, file_name=file_name_copy)
+        self.assertEqual(self.test_dict, uo_read.to_dict())
+        uo_read.cleanup()
+
+    def test_to_np_columns(self):
+        cols = ['k3', 'k1']
+        ctrl = self.test_array[cols]
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np(self.test_array)
+        uo_image = UObject(UObjectPhase.Read, uo.get_image())
+        uo.write_to_read_phase()
+        for uo_read in (uo, uo_image):
+            self.assertEqual(uo_read.get_column_names(), 
+                             list(self.test_array.dtype.names))
+            result = uo_read.to_np(cols)
+            self.assertEqual(result.dtype.names, tuple(cols))
+            self.assertTrue(np.array_equal(result, ctrl))
+
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        uo_sql = UObject(UObjectPhase.Write)
+        uo_sql.from_sql(db_url, {}, 'employees', False)
+        uo_sql.write_to_read_phase()
+        result = uo_sql.to_np(['salary', 'id'])
+        self.assertEqual(result.dtype.names, ('salary', 'id'))
+
+    def test_chunks(self):
+        chunk_rows = 2
+        A = np.tile(self.test_array, 5)
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np_chunks(A[start:start + chunk_rows] for 
+                          start in xrange(0, A.shape[0], chunk_rows))
+        uo_image = UObject(UObjectPhase.Read, uo.get_image())
+        uo.write_to_read_phase()
+        for uo_read in (uo, uo_image):
+            chunks = list(uo_read.iter_np(chunk_rows))
+            self.assertTrue(all(chunk.shape[0] <= chunk_rows for chunk in 
+                                chunks))
+            self.assertEqual(len(chunks), 3)
+            self.assertTrue(np.array_equal(np.concatenate(chunks), A))
+
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        uo_sql = UObject(UObjectPhase.Write)
+        uo_sql.from_sql(db_url, {}, 'employees', False)
+        uo_sql.write_to_read_phase()
+        ctrl = uo_sql.to_np(['id', 'salary'])
+        result = np.concatenate(list(uo_sql.iter_np(chunk_rows, 
+                                                    ['id', 'salary'])))
+        self.assertTrue(np.array_equal(result, ctrl))
+
+    def test_columnar(self):
+        A = np.array([(1, 2.5, 'a', '2015-01-01T00:00'), 
+                      (2, 3.5, 'bcd', '2015-02-01T12:30')],
+                     dtype=[('id', int), ('score', float), ('name', 'S3'),
+                            ('dt', 'M8[m]')])
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np(A, storage_method='columnar')
+        uo_read = UObject(UObjectPhase.Read, uo.get_image())
+        self.assertEqual(uo_read.get_column_names(), list(A.dtype.names))
+        result = uo_read.to_np()
+        self.assertEqual(result.dtype, A.dtype)
+        self.assertTrue(np.array_equal(result, A))
+        self.assertTrue(np.array_equal(uo_read.to_np(['dt', 'id']), 
+                                       A[['dt', 'id']]))
+        chunks = list(uo_read.iter_np(1, ['name']))
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(np.array_equal(np.concatenate(chunks), A[['name']]))
+
+    def test_matrix(self):
+        M = np.array([[1.0, 2.5], [3.0, 4.5], [5.0, 6.5]])
+        dtype = np.dtype([('id', int), ('score', float)])
+        ctrl_sa = np_nd_to_sa(M, dtype)
+        ctrl_nd, ctrl_dtype = np_sa_to_nd(ctrl_sa)
+        uo = UObject(UObjectPhase.Write)
+        uo.from_matrix(M, dtype)
+        uo_image = UObject(UObjectPhase.Read, uo.get_image())
+        uo.write_to_read_phase()
+        for uo_read in (uo, uo_image):
+            self.assertEqual(uo_read.get_column_names(), ['id', 'score'])
+            nd, nd_dtype = uo_read.to_matrix()
+            self.assertEqual(nd_dtype, ctrl_dtype)
+            self.assertEqual(nd.dtype, ctrl_nd.dtype)
+            self.assertTrue(np.array_equal(nd, ctrl_nd))
+            self.assertTrue(np.array_equal(uo_read.to_np(), ctrl_sa))
+            self.assertTrue(np.array_equal(uo_read.to_np(['score']), 
+                                           ctrl_sa[['score']]))
+
+        for M in (np.arange(4), np.array(7.5)):
+            uo = UObject(UObjectPhase.Write)
+            uo.from_matrix(M)
+            uo_read = UObject(UObjectPhase.Read, uo.get_image())
+            nd, nd_dtype = uo_read.to_matrix()
+            self.assertEqual(nd.shape, M.shape)
+            self.assertTrue(np.array_equal(nd, M))
+
+    def test_compression(self):
+        A = np.zeros(10000, dtype=[('id', int), ('val', float)])
+        A['id'] = np.arange(10000)
+
+        def write(policy):
+            with compression_policy(policy):
+                uo = UObject(UObjectPhase.Write)
+            uo.from_np(A)
+            return uo.get_image()
+
+        image_none = write(NO_COMPRESSION)
+        image_zlib = write('complib=zlib,complevel=5,chunk_rows=1024')
+        self.assertLess(len(image_zlib), len(image_none) / 4)
+        uo_read = UObject(UObjectPhase.Read, image_zlib)
+        self.assertTrue(np.array_equal(uo_read.to_np(), A))
+
+        self.assertEqual(
+            CompressionPolicy.from_str('complevel=9,shuffle=0'),
+            DEFAULT_COMPRESSION._replace(complevel=9, shuffle=False))
+        self.assertEqual(CompressionPolicy.from_str('none'), NO_COMPRESSION)
+        self.assertRaises(UObjectException, CompressionPolicy.from_str, 
+                          'level=2')
+
+    def test_stats(self):
+        A = np.array([(1, 2.5, 'a', '2015-01-01'), 
+                      (3, np.nan, 'bb', 'NaT'),
+                      (1, 0.5, 'a', '2014-01-01')], 
+                     dtype=[('id', int), ('val', float), ('name', 'S2'), 
+                            ('dt', 'M8[D]')])
+        uo = UObject(UObjectPhase.Write)
+        uo.from_np_chunks([A[:2], A[2:]])
+        uo_image = UObject(UObjectPhase.Read, uo.get_image())
+        uo.write_to_read_phase()
+        self.assertIsNotNone(uo_image.stats(compute=False))
+        # Only computed for tables in memory when asked for
+        uo_mem = UObject(UObjectPhase.Write)
+        uo_mem.from_np(A)
+        uo_mem.write_to_read_phase()
+        self.assertIsNone(uo_mem.stats(compute=False))
+        self.assertEqual(uo_mem.stats().rows, 3)
+        for uo_read in (uo, uo_image):
+            stats = uo_read.stats()
+            self.assertEqual(stats.rows, 3)
+            self.assertEqual(stats.nbytes, A.nbytes)
+            self.assertEqual(stats.columns.keys(), list(A.dtype.names))
+            self.assertEqual(stats.columns['id'], 
+                             ColumnStats(0, 1, 3, 2, 24))
+            self.assertEqual(stats.columns['val'].nulls, 1)
+            self.assertEqual(stats.columns['val'].max, 2.5)
+            self.assertEqual(stats.columns['name'].min, None)
+            self.assertEqual(stats.columns['name'].distinct, 2)
+            self.assertEqual(stats.columns['dt'].nulls, 1)
+            self.assertEqual(stats.columns['dt'].min, 
+                             np.datetime64('2014-01-01'))
+
+    def test_view(self):
+        A = np.array([(1, 2.5, 'a'), (2, 3.5, 'b'), (3, 4.5, 'c')],
+                     dtype=[('id', int), ('val', float), ('name', 'S1')])
+        parent_file_name = self._tmp_files('test_view_parent.upsg')
+        uo_parent = UObject(UObjectPhase.Write, file_name=parent_file_name)
+        uo_parent.from_np(A)
+        uo_parent.write_to_read_phase()
+
+        uo_view = UObject(UObjectPhase.Write)
+        uo_view.from_view(uo_parent, ['name', 'id'], ['letter', 'num'])
+        # A view of a view refers to the parent
+        uo_view.write_to_read_phase()
+        uo = UObject(UObjectPhase.Write)
+        uo.from_view(uo_view, ['num'], rows=np.array([True, False, True]))
+        view_file_name = self._tmp_files('test_view.upsg')
+        uo.write_to_file(view_file_name)
+        uo_file = UObject(UObjectPhase.Read, file_name=view_file_name)
+        uo.write_to_read_phase()
+        uo_parent.cleanup()
+        for uo_read in (uo, uo_file):
+            self.assertEqual(uo_read.get_column_names(), ['num'])
+            result = uo_read.to_np()
+            self.assertEqual(result.dtype.names, ('num',))
+            self.assertTrue(np.array_equal(result['num'], [1, 3]))
+            chunks = list(uo_read.iter_np(1))
+            self.assertEqual(len(chunks), 2)
+        self.assertEqual(uo_view.stats().columns['letter'].distinct, 3)
+        uo_file.cleanup()
+
+        # Without a file to refer to, the view is resolved
+        uo = UObject(UObjectPhase.Write)
+        uo_in = UObject(UObjectPhase.Read, uo_view.get_image())
+        uo.from_view(uo_in, rename=['l', 'n'], rows=[2, 0])
+        uo_read = UObject(UObjectPhase.Read, uo.get_image())
+        self.assertTrue(np.array_equal(uo_read.to_np()['n'], [3, 1]))
+
+        db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
+            'small.db'))
+        db_url = 'sqlite:///{}'.format(db_path)
+        uo_sql = UObject(UObjectPhase.Write)
+        uo_sql.from_sql(db_url, {}, 'employees', False)
+        uo_sql.write_to_read_phase()
+        uo = UObject(UObjectPhase.Write)
+        uo.from_view(uo_sql, ['id'], ['employee_id'])
+        uo.write_to_read_phase()
+        tbl = uo.to_sql(db_url, {}).table
+        self.assertEqual([col.name for col in tbl.columns], ['employee_id'])
+        self.assertTrue(np.array_equal(uo.to_np()['employee_id'],
+                                       uo_sql.to_np()['id']))
+
+        # Views are found if they're moved along with their parents
+        moved_dir = tempfile.mkdtemp(dir=TEMP_PATH)
+        for file_name in (parent_file_name, view_file_name):
+            shutil.move(file_name, moved_dir)
+        uo_file = UObject(
+            UObjectPhase.Read, 
+            file_name=os.path.join(moved_dir, 
+                                   os.path.basename(view_file_name)))
+        self.assertTrue(np.array_equal(uo_file.to_np()['num'], [1, 3]))
+        uo_file.cleanup()
+        shutil.rmtree(moved_dir)
+
     def test_sql(self):
         # Make sure we don't accidentally corrupt our test database
         db_path, db_file_name = self._tmp_files.tmp_copy(path_of_data(
@@ -1,6 +1,8 @@
 import numpy as np
 from os import system
+from datetime import datetime
 import unittest
+import sqlalchemy
 from utils import UPSGTestCase
 
 from upsg.utils import *
@@ -50,5 +52,142 @@ class TestUtils(UPSGTestCase):
         self.assertEqual(np.dtype(np_type(7.2)), np.dtype(float))
         self.assertEqual(np.dtype(np_type("hello")), np.dtype("S5"))
 
+    def test_csv_iter_np(self):
+        file_name = self._tmp_files('test_csv_iter_np.csv')
+        with open(file_name, 'w') as fout:
+            fout.write('id,val,flag,when,name\n'
+                       '1,2,True,2015-01-01,a\n'
+                       '2,,false,,bb\n'
+                       '# a comment\n'
+                       '3,4.5,True,2015-01-01T10:00,cccc\n')
+        dtype = csv_sample_dtype(file_name, sample_rows=2, parse_dates=True)
+        self.assertEqual(dtype, np.dtype([('id', int), ('val', int),
+                                          ('flag', bool), ('when', 'M8[D]'),
+                                          ('name', 'S2')]))
+        with self.assertRaises(CSVSchemaError) as cm:
+            list(csv_iter_np(file_name, dtype, 2, parse_dates=True))
+        # val and name are widened in the second block, but the first block
+        # is fine
+        dtype = cm.exception.dtype
+        self.assertEqual(dtype, np.dtype([('id', int), ('val', float),
+                                          ('flag', bool), ('when', 'M8[m]'),
+                                          ('name', 'S4')]))
+        chunks = list(csv_iter_np(file_name, dtype, 2, parse_dates=True))
+        self.assertEqual(len(chunks), 2)
+        result = np.concatenate(chunks)
+        self.assertTrue(np.array_equal(result['val'][[0, 2]], [2.0, 4.5]))
+        self.assertTrue(np.isnan(result['val'][1]))
+        self.assertTrue(np.array_equal(result['flag'], [True, False, True]))
+        self.assertTrue(np.isnat(result['when'][1]))
+        self.assertEqual(list(result['name']), ['a', 'bb', 'cccc'])
+
+    def test_kmv(self):
+        k = 64
+        rs = np.random.RandomState(0)
+        for n_values in (10, 10000):
+            values = rs.randint(0, n_values, 5000)
+            sketch = np.empty(0, dtype=np.uint64)
+            for start in xrange(0, values.shape[0], 1000):
+                sketch = kmv_update(
+                    sketch, 
+                    np_col_hashes(values[start:start + 1000]),
+                    k)
+            ctrl = np.unique(np_col_hashes(values))[:k]
+            self.assertTrue(np.array_equal(sketch, ctrl))
+        self.assertEqual(kmv_estimate(sketch[:5], k), 5)
+
+    def test_sql_to_np_nulls(self):
+        db_url = 'sqlite:///{}'.format(self._tmp_files('test_sql_nulls.db'))
+        conn = sqlalchemy.create_engine(db_url).connect()
+        tbl = sqlalchemy.Table(
+            'nulls',
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('id', sqlalchemy.Integer),
+            sqlalchemy.Column('val', sqlalchemy.Float),
+            sqlalchemy.Column('name', sqlalchemy.String),
+            sqlalchemy.Column('time', sqlalchemy.DateTime))
+        tbl.create(conn)
+        conn.execute(tbl.insert(), [
+            {'id': 1, 'val': 0.5, 'name': u'caf\xe9',
+             'time': datetime(2015, 1, 1)},
+            {'id': None, 'val': None, 'name': None, 'time': None}])
+        result = sql_to_np(tbl, conn)
+        self.assertEqual(list(result['id']), [1, -999])
+        self.assertTrue(np.isnan(result['val'][1]))
+        self.assertEqual(list(result['name']), ['caf?', ''])
+        self.assertEqual(result['time'][0], np.datetime64('2015-01-01'))
+        self.assertTrue(np.isnat(result['time'][1]))
+        chunks = list(sql_iter_np(tbl, conn, 1))
+        self.assertTrue(np.array_equal(np.concatenate(chunks)['id'],
+                                       result['id']))
+        conn.close()
+
+    def test_sql_declared_str_len(self):
+        db_url = 'sqlite:///{}'.format(self._tmp_files(
+            'test_sql_str_len.db'))
+        conn = sqlalchemy.create_engine(db_url).connect()
+        tbl = sqlalchemy.Table(
+            'str_len',
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('short', sqlalchemy.String(10)),
+            sqlalchemy.Column('long', sqlalchemy.String(4000)))
+        tbl.create(conn)
+        conn.execute(tbl.insert(), [{'short': 'a', 'long': 'bcd'}])
+        # Pretend that sqlite enforces declared lengths
+        import upsg.utils
+        dialects = upsg.utils.DIALECTS_IGNORING_STR_LEN
+        upsg.utils.DIALECTS_IGNORING_STR_LEN = frozenset()
+        try:
+            result = sql_to_np(tbl, conn)
+        finally:
+            upsg.utils.DIALECTS_IGNORING_STR_LEN = dialects
+        self.assertEqual(result.dtype['short'], np.dtype('S10'))
+        # Too long to allocate, so the column is scanned
+        self.assertEqual(result.dtype['long'], np.dtype('S3'))
+        conn.close()
+
+    def test_sql_partitions(self):
+        db_url = 'sqlite:///{}'.format(self._tmp_files(
+            'test_sql_partitions.db'))
+        conn = sqlalchemy.create_engine(db_url).connect()
+        A = np.empty(100, dtype=[('id', int), ('time', 'M8[s]')])
+        A['id'] = np.arange(-50, 50)
+        A['time'] = np.datetime64('2015-01-01T00:00:00') + A['id'] * 3600
+        A['time'][[3, 70]] = np.datetime64('NaT')
+        tbl = np_to_sql(A, 'partitions', conn)
+        ctrl = sql_to_np(tbl, conn)
+        for partitioning in (SQLPartitioning('id', 3, 'range', 2),
+                             SQLPartitioning('id', 4, 'hash', 4),
+                             SQLPartitioning('time', 5, 'range', 2)):
+            result = sql_to_np(tbl, conn, partitioning=partitioning)
+            self.assertTrue(np.array_equal(np.sort(result['id']), 
+                                           ctrl['id']))
+            chunks = list(sql_iter_np(tbl, conn, 7, ['id'], partitioning))
+            self.assertTrue(all(chunk.shape[0] <= 7 for chunk in chunks))
+            self.assertTrue(np.array_equal(np.concatenate(chunks), 
+                                           result[['id']]))
+        result = sql_to_np(tbl, conn, 
+                           partitioning=SQLPartitioning('id', 3, 'range', 2))
+        self.assertTrue(np.array_equal(result['id'], ctrl['id']))
+        conn.close()
+
+    def test_np_to_sql(self):
+        db_url = 'sqlite:///{}'.format(self._tmp_files('test_np_to_sql.db'))
+        conn = sqlalchemy.create_engine(db_url).connect()
+        A = np.array([(1, 0.5, True, 'a', '2015-01-01T10:00:00'),
+                      (2, np.nan, False, '', 'NaT'),
+                      (3, 1.5, True, 'ccc', '2014-12-31T23:59:59')],
+                     dtype=[('id', int), ('val', float), ('flag', bool),
+                            ('name', 'S3'), ('time', 'M8[s]')])
+        tbl = np_to_sql(A, 'from_np', conn, chunk_rows=2)
+        result = sql_to_np(tbl, conn)
+        self.assertEqual(result.dtype, A.dtype)
+        for name in ('id', 'flag', 'name'):
+            self.assertTrue(np.array_equal(result[name], A[name]))
+        self.assertTrue(np.array_equal(result['time'][[0, 2]],
+                                       A['time'][[0, 2]]))
+        self.assertTrue(np.isnat(result['time'][1]))
+        conn.close()
+
 if __name__ == '__main__':
     unittest.main()
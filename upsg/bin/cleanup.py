@@ -3,56 +3,239 @@
 import sys
 import os
 import glob
+import time
+from multiprocessing.pool import ThreadPool
 import tables
 import sqlalchemy
+from sqlalchemy.engine.url import make_url
 
 from upsg.utils import np_sa_to_dict
+from upsg.db import get_connection, dispose_engines, invalidate_tables
+from upsg.db import drop_uploads
+from upsg.registry import get_registry_path, read_registry, write_registry
+from upsg.registry import RegistryEntry
 
-def run(path='.'):
-    """removes .upsg files and temporary sql tables from
-    the given path"""
+# Number of files that are removed at once
+REMOVE_WORKERS = 8
+# Databases that can drop several tables in one statement, and how many
+# they are asked to drop at a time
+DIALECTS_DROPPING_MANY = frozenset(('postgresql', 'mysql'))
+DROP_BATCH = 500
+# Seconds in each unit that --max-age accepts
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
 
-    for file in glob.iglob(os.path.join(path, '*.upsg')):
-        hfile = tables.open_file(file, mode='r')
+
+def parse_age(age):
+    """converts an age like '90', '30m', '12h' or '7d' to seconds"""
+    if age[-1] in AGE_UNITS:
+        return float(age[:-1]) * AGE_UNITS[age[-1]]
+    return float(age)
+
+
+def __scan_files(path, registered):
+    """Returns registry entries for .upsg files in path that aren't in the
+    registry, for the pipeline-generated tables they refer to, and for the
+    files that those which are views refer to. These files have to be 
+    opened to find their tables, so they are slower to clean up than 
+    registered files."""
+    entries = []
+    for file_name in glob.iglob(os.path.join(path, '*.upsg')):
+        file_name = os.path.abspath(file_name)
+        if file_name in registered:
+            continue
+        created = os.path.getmtime(file_name)
+        entries.append(RegistryEntry(created, 'file', file_name, None, None))
+        hfile = tables.open_file(file_name, mode='r')
         storage_method = hfile.get_node_attr('/upsg_inf', 'storage_method')
         if storage_method == 'sql':
             sql_group = hfile.root.sql
             pipeline_generated = hfile.get_node_attr(sql_group,
                                                      'pipeline_generated')
             if pipeline_generated:
-                db_url = hfile.get_node_attr(sql_group, 'db_url')
-                tbl_name = hfile.get_node_attr(sql_group, 'tbl_name')
-                conn_params = np_sa_to_dict(hfile.root.sql.conn_params.read())
-                engine = sqlalchemy.create_engine(db_url)
-                conn = engine.connect(**conn_params)
-                md = sqlalchemy.MetaData()
-                md.reflect(conn)
-                tbl = md.tables[tbl_name]
-                tbl.drop(conn)
+                entries.append(RegistryEntry(
+                    created,
+                    'sql',
+                    hfile.get_node_attr(sql_group, 'tbl_name'),
+                    hfile.get_node_attr(sql_group, 'db_url'),
+                    np_sa_to_dict(hfile.root.sql.conn_params.read())))
+        elif storage_method == 'view':
+            entries.append(RegistryEntry(
+                created,
+                'ref',
+                hfile.get_node_attr('/view', 'parent_file'),
+                None,
+                None))
         hfile.close()
-        os.remove(file)
+    return entries
+
+
+def __db_exists(db_url):
+    """False for SQLite databases whose files are gone, which connecting
+    to would create"""
+    url = make_url(db_url)
+    if url.drivername.startswith('sqlite') and url.database not in (
+            None, '', ':memory:'):
+        return os.path.exists(url.database)
+    return True
+
+
+def __drop(conn, kind, tbl_names):
+    """Drops the tables or views (according to kind) with the given names,
+    several per statement where the database allows it"""
+    quote = conn.dialect.identifier_preparer.quote
+    batch_size = 1
+    if conn.dialect.name in DIALECTS_DROPPING_MANY:
+        batch_size = DROP_BATCH
+    for start in xrange(0, len(tbl_names), batch_size):
+        conn.execute('DROP {} IF EXISTS {}'.format(
+            kind,
+            ', '.join(quote(tbl_name) for tbl_name in
+                      tbl_names[start:start + batch_size])))
+
+
+def __drop_tables(entries):
+    """Drops the tables and views of the given registry entries over one
+    connection per database, and returns the entries that couldn't be
+    dropped"""
+    by_db = {}
+    for entry in entries:
+        key = (entry.db_url, tuple(sorted(entry.conn_params.items())))
+        by_db.setdefault(key, []).append(entry)
+    failed = []
+    for (db_url, _), db_entries in by_db.iteritems():
+        if not __db_exists(db_url):
+            continue
+        # Newest first, so views are dropped before the views they select
+        # from
+        db_entries.sort(key=lambda entry: entry.created, reverse=True)
+        tbl_names = []
+        for entry in db_entries:
+            if entry.name not in tbl_names:
+                tbl_names.append(entry.name)
+        try:
+            conn = get_connection(db_url, db_entries[0].conn_params)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            sys.stderr.write('Could not connect to {}: {}\n'.format(db_url, e))
+            failed += db_entries
+            continue
+        try:
+            views = set(sqlalchemy.inspect(conn).get_view_names())
+            with conn.begin():
+                # Views go first, since databases may refuse to drop tables
+                # that views depend on
+                __drop(conn, 'VIEW', [tbl_name for tbl_name in tbl_names if
+                                      tbl_name in views])
+                __drop(conn, 'TABLE', [tbl_name for tbl_name in tbl_names if
+                                       tbl_name not in views])
+            # The tables are gone, so their uploads mustn't be reused
+            drop_uploads(conn, db_url, tbl_names)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            sys.stderr.write('Could not clean up {}: {}\n'.format(db_url, e))
+            failed += db_entries
+        finally:
+            conn.close()
+            invalidate_tables(db_url, tbl_names)
+    return failed
+
+
+def __remove_file(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        # presumably, it's already gone
+        pass
+
+
+def run(path='.', max_age=None):
+    """removes pipeline-generated .upsg files and sql tables recorded in the
+    registry of the given path, along with any other .upsg files in the
+    path and the temporary sql tables they refer to
+
+    Parameters
+    ----------
+    path : str
+        The directory to clean
+    max_age : float or None
+        If not None, only files and tables created more than this many
+        seconds ago are removed, and files are kept as long as views
+        of them that are kept. Otherwise, everything is removed.
+
+    """
+    registry_path = get_registry_path(path)
+    # Records made while we clean up go to a new registry. Records left by
+    # a cleanup that was interrupted are picked up again.
+    cleaning_path = registry_path + '.cleaning'
+    entries = read_registry(cleaning_path)
+    if os.path.exists(registry_path):
+        claimed_path = '{}.{}'.format(cleaning_path, os.getpid())
+        os.rename(registry_path, claimed_path)
+        claimed = read_registry(claimed_path)
+        write_registry(cleaning_path, claimed)
+        os.remove(claimed_path)
+        entries += claimed
+    entries += __scan_files(path, frozenset(
+        entry.name for entry in entries if entry.kind == 'file'))
+    if max_age is None:
+        expired = entries
+        kept = []
+    else:
+        oldest = time.time() - max_age
+        expired = [entry for entry in entries if entry.created < oldest]
+        kept = [entry for entry in entries if entry.created >= oldest]
+        # Files that views we keep refer to are kept too
+        referenced = frozenset(entry.name for entry in kept if 
+                               entry.kind == 'ref')
+        kept += [entry for entry in expired if entry.kind == 'file' and
+                 entry.name in referenced]
+        expired = [entry for entry in expired if entry.kind != 'file' or
+                   entry.name not in referenced]
+    kept += __drop_tables([entry for entry in expired if entry.kind == 'sql'])
+    pool = ThreadPool(REMOVE_WORKERS)
+    try:
+        pool.map(__remove_file,
+                 [entry.name for entry in expired if entry.kind == 'file'])
+    finally:
+        pool.close()
+        pool.join()
+    write_registry(registry_path, kept)
+    __remove_file(cleaning_path)
+    dispose_engines()
 
 
 def usage():
     print """cleanup.py - removes .upsg files and temporary sql tables from
     a given directory.
 
-    usage: cleanup.py [dir]
+    usage: cleanup.py [--max-age AGE] [dir]
        or: cleanup.py --help displays this message
        or: cleanup.py -h     displays this message
 
     Arguments:
        dir: The directory to clean. Is the current workind directory
             by default.
+       AGE: Only remove files and tables older than this. A number of
+            seconds, optionally followed by one of s, m, h or d for
+            seconds, minutes, hours or days (e.g. 12h). Everything is
+            removed by default.
     """
     exit(0)
 
 if __name__ == '__main__':
     path = '.'
-    if len(sys.argv) > 1:
-        if sys.argv[1] in ('-h', '--help'):
+    max_age = None
+    args = sys.argv[1:]
+    if args and args[0] in ('-h', '--help'):
+        usage()
+    if args and args[0] == '--max-age':
+        if len(args) < 2:
+            usage()
+        try:
+            max_age = parse_age(args[1])
+        except ValueError:
             usage()
-        path = sys.argv[1]
+        args = args[2:]
+    if args:
+        path = args[0]
     if not os.path.isdir(path):
         usage()
-    run(path)
+    run(path, max_age)
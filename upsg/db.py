@@ -0,0 +1,255 @@
+"""A process-wide registry of SQLAlchemy engines and reflected tables.
+
+Every part of UPSG that talks to a database gets its connections from here,
+so connections to the same database come from one pool rather than each
+conversion creating (and handshaking with) a new engine. Tables are 
+reflected one at a time and cached, rather than reflecting the whole 
+database to find one table. UObjects uploaded to a database are recorded 
+in the database itself, so the same contents are only uploaded once.
+
+"""
+import threading
+
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+
+from registry import register_table
+
+__engines = {}
+__engines_lock = threading.Lock()
+# (db_url, table name) : sqlalchemy.schema.Table
+__tables = {}
+__tables_lock = threading.Lock()
+
+
+def __engine_key(db_url, conn_params):
+    return (str(db_url), tuple(sorted(conn_params.iteritems())))
+
+
+def get_engine(db_url, conn_params={}):
+    """Returns the shared engine for a database, creating it if this is the
+    first request for it.
+
+    Parameters
+    ----------
+    db_url : str
+        The url of the database. Should conform to the format of
+        SQLAlchemy database URLS
+        (http://docs.sqlalchemy.org/en/rel_0_9/core/engines.html#database-urls)
+    conn_params : dict of str to ?
+        A dictionary of the keyword arguments to be passed to the connect
+        method of some library implementing the Python Database API
+        Specification 2.0
+        (https://www.python.org/dev/peps/pep-0249/#connect)
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+
+    """
+    key = __engine_key(db_url, conn_params)
+    with __engines_lock:
+        try:
+            return __engines[key]
+        except KeyError:
+            connect_args = dict(conn_params)
+            if make_url(db_url).drivername.startswith('sqlite'):
+                # UObjects hold on to their connections, and may be read,
+                # cleaned up or garbage collected in a different thread than
+                # the one that connected
+                connect_args.setdefault('check_same_thread', False)
+            engine = sqlalchemy.create_engine(db_url,
+                                              connect_args=connect_args)
+            __engines[key] = engine
+            return engine
+
+
+def get_connection(db_url, conn_params={}):
+    """Checks a connection out of the shared pool for a database.
+
+    Closing the connection returns it to the pool. Arguments are as for
+    get_engine.
+
+    Returns
+    -------
+    sqlalchemy.engine.Connection
+
+    """
+    return get_engine(db_url, conn_params).connect()
+
+
+def engine_keys():
+    """Returns a token identifying the engines currently in the registry,
+    to be passed to dispose_engines"""
+    with __engines_lock:
+        return frozenset(__engines.iterkeys())
+
+
+def __in_memory(db_url):
+    url = make_url(db_url)
+    return url.drivername.startswith('sqlite') and url.database in (
+        None, '', ':memory:')
+
+
+def dispose_engines(keep=None):
+    """Closes the pooled connections of engines in the registry and removes
+    them from the registry.
+
+    Connections that are checked out when this is called keep working, and
+    are closed rather than pooled when they are closed.
+
+    Parameters
+    ----------
+    keep : frozenset or None
+        If None, every engine is disposed. Otherwise, a value returned by 
+        engine_keys, and only engines created since it was returned are 
+        disposed. Engines of in-memory SQLite databases are then kept as
+        well, since disposing them destroys the database.
+
+    """
+    with __engines_lock:
+        if keep is None:
+            engines = __engines.values()
+            __engines.clear()
+        else:
+            engines = []
+            for key in __engines.keys():
+                if key not in keep and not __in_memory(key[0]):
+                    engines.append(__engines.pop(key))
+    for engine in engines:
+        engine.dispose()
+
+
+def reflect_table(conn, db_url, tbl_name):
+    """Returns a sqlalchemy Table for a table or view in the database. 
+
+    Only the requested table is reflected, and the result is cached until
+    invalidate_tables is called for it.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to the database at db_url
+    db_url : str
+        The url of the database
+    tbl_name : str
+        The name of the table or view
+
+    Returns
+    -------
+    sqlalchemy.schema.Table
+
+    """
+    key = (str(db_url), tbl_name)
+    with __tables_lock:
+        try:
+            return __tables[key]
+        except KeyError:
+            pass
+    tbl = sqlalchemy.Table(tbl_name, sqlalchemy.MetaData(), autoload=True,
+                           autoload_with=conn)
+    with __tables_lock:
+        __tables[key] = tbl
+    return tbl
+
+
+def invalidate_tables(db_url=None, tbl_names=None):
+    """Removes tables from the cache used by reflect_table. 
+
+    This should be called whenever tables may have been created, altered
+    or dropped in a way that UPSG can't otherwise know about.
+
+    Parameters
+    ----------
+    db_url : str or None
+        The url of the database whose tables should be removed. If None,
+        tables of every database are removed.
+    tbl_names : list of str or None
+        The tables to remove. If None, every table of the database is 
+        removed.
+
+    """
+    with __tables_lock:
+        if db_url is None:
+            __tables.clear()
+            return
+        db_url = str(db_url)
+        for key in __tables.keys():
+            if key[0] == db_url and (tbl_names is None or 
+                                     key[1] in tbl_names):
+                del __tables[key]
+
+
+# Table in each database recording which tables hold uploaded UObjects, so
+# that uploads can be reused and cleaned up
+UPLOADS_TABLE = '_UPSG_UPLOADS'
+__uploads = sqlalchemy.Table(
+    UPLOADS_TABLE,
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column('fingerprint', sqlalchemy.String(64)),
+    sqlalchemy.Column('tbl_name', sqlalchemy.String(64)))
+
+
+def find_upload(conn, db_url, fingerprint):
+    """Returns the name of a table that a UObject with the given 
+    fingerprint was uploaded to, or None if there isn't one.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to the database at db_url
+    db_url : str
+        The url of the database
+    fingerprint : str
+        Fingerprint of the UObject's contents, as returned by 
+        UObject.fingerprint
+
+    Returns
+    -------
+    str or None
+
+    """
+    if not conn.dialect.has_table(conn, UPLOADS_TABLE):
+        return None
+    for (tbl_name,) in conn.execute(
+            sqlalchemy.select([__uploads.c.tbl_name]).where(
+                __uploads.c.fingerprint == fingerprint)):
+        if conn.dialect.has_table(conn, tbl_name):
+            return tbl_name
+        # Somebody dropped the table without telling us
+        conn.execute(__uploads.delete().where(
+            __uploads.c.tbl_name == tbl_name))
+        invalidate_tables(db_url, [tbl_name])
+    return None
+
+
+def register_upload(conn, db_url, fingerprint, tbl_name, conn_params={}):
+    """Records that a UObject with the given fingerprint has been uploaded
+    to a table, so that find_upload can find it and drop_uploads can drop
+    it. Arguments are as for find_upload and get_engine. The table is also
+    recorded in the registry, so cleanup.py can drop it once it is old 
+    enough."""
+    register_table(db_url, conn_params, tbl_name)
+    __uploads.create(conn, checkfirst=True)
+    conn.execute(__uploads.insert(), fingerprint=fingerprint, 
+                 tbl_name=tbl_name)
+
+
+def drop_uploads(conn, db_url, tbl_names):
+    """Drops those of the given tables that register_upload recorded in a
+    database, along with their records. Uploads of other tables, which 
+    may belong to pipelines run elsewhere, are left alone. Arguments are 
+    as for find_upload, and tbl_names is a list of str."""
+    if not conn.dialect.has_table(conn, UPLOADS_TABLE):
+        return
+    tbl_names = [tbl_name for (tbl_name,) in conn.execute(
+        sqlalchemy.select([__uploads.c.tbl_name]).where(
+            __uploads.c.tbl_name.in_(tbl_names)))]
+    if not tbl_names:
+        return
+    for tbl_name in tbl_names:
+        if conn.dialect.has_table(conn, tbl_name):
+            reflect_table(conn, db_url, tbl_name).drop(conn)
+    conn.execute(__uploads.delete().where(
+        __uploads.c.tbl_name.in_(tbl_names)))
+    invalidate_tables(db_url, tbl_names)
@@ -27,6 +27,10 @@ class CSVWrite(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return []
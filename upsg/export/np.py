@@ -29,6 +29,10 @@ class NumpyWrite(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return []
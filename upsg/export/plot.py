@@ -2,7 +2,6 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from ..stage import RunnableStage
-from ..utils import np_sa_to_nd
 from ..uobject import UObject, UObjectPhase
 
 
@@ -64,14 +63,18 @@ class Plot(RunnableStage):
     def input_keys(self):
         return ['x', 'y']
 
+    @property
+    def required_input_keys(self):
+        return ['y']
+
     @property
     def output_keys(self):
         return ['plot_file']
 
     def run(self, outputs_requested, **kwargs):
-        y = np_sa_to_nd(kwargs['y'].to_np())[0]
+        y = kwargs['y'].to_matrix()[0]
         try:
-            x = np_sa_to_nd(kwargs['x'].to_np())[0]
+            x = kwargs['x'].to_matrix()[0]
         except KeyError:
             M = y.shape[0]
             x = np.arange(M).reshape(M, 1)
@@ -14,17 +14,23 @@ class CSVRead(RunnableStage):
     ----------
     filename : str
         filename of the csv
+    parse_dates : bool
+        If True, columns holding ISO 8601 dates or datetimes are read as
+        datetime64 columns
     kwargs : dict
         keyword arguments to pass to numpy.genfromtxt
         (http://docs.scipy.org/doc/numpy/reference/generated/numpy.genfromtxt.html)
         If no kwargs are provided, we use: dtype=None, delimiter=',', 
-        names=True.
+        names=True. Unless kwargs other than delimiter are given, the csv 
+        is streamed rather than read with numpy.genfromtxt. See 
+        UObject.from_csv
 
     """
 
-    def __init__(self, filename, **kwargs):
+    def __init__(self, filename, parse_dates=False, **kwargs):
             
         self.__filename = filename
+        self.__parse_dates = parse_dates
         self.__kwargs = kwargs
 
     @property
@@ -37,5 +43,6 @@ class CSVRead(RunnableStage):
 
     def run(self, outputs_requested, **kwargs):
         uo = UObject(UObjectPhase.Write)
-        uo.from_csv(self.__filename, **self.__kwargs)
+        uo.from_csv(self.__filename, parse_dates=self.__parse_dates, 
+                    **self.__kwargs)
         return {'output': uo}
@@ -1,10 +1,20 @@
+import sqlalchemy
+
 from ..stage import RunnableStage
 from ..uobject import UObject, UObjectPhase
+from ..transform.split import Query
+from ..utils import sql_sample_clause
+from ..db import get_engine
 
 
 class SQLRead(RunnableStage):
     """Stage to read in an sql table. Output is offered with the 'output' key
 
+    If any of columns, query, sample, order_by or limit are given, only the
+    selected slice of the table is offered. The slice is selected in the
+    database and stored there as a view, or as a table if it is
+    materialized, so the rest of the table is never read.
+
     Parameters
     ----------
     db_url : str
@@ -18,14 +28,52 @@ class SQLRead(RunnableStage):
         method of some library implementing the Python Database API
         Specification 2.0
         (https://www.python.org/dev/peps/pep-0249/#connect)
+    columns : list of str or None
+        The columns to read. If None, all columns are read.
+    query : str or None
+        If not None, only rows matching this query are read. Uses the same
+        language as upsg.transform.split.Query
+    sample : float or None
+        If not None, a random sample of approximately this fraction of the
+        rows is read. Samples are always materialized, so that the same
+        sample is seen each time the output is read.
+    order_by : list of str or None
+        Columns to sort by, most significant first. Columns prefixed with
+        '-' are sorted in descending order.
+    limit : int or None
+        If not None, at most this many rows are read.
+    materialize : bool
+        If True, the slice is stored in a new table rather than in a view
+    partitioning : upsg.utils.SQLPartitioning or None
+        If provided, stages that convert the output out of sql read it in
+        partitions over several connections in parallel. Rows are then 
+        ordered by partition.
+
+    Examples
+    --------
+    >>> recent = SQLRead('sqlite:///small.db', 'hours',
+    ...                  columns=['employee_id', 'time'],
+    ...                  query="time >= DT('2015-01-01')",
+    ...                  order_by=['-time'], limit=100)
+    >>> big = SQLRead('postgresql://localhost/warehouse', 'facts', 
+    ...               partitioning=SQLPartitioning('fact_id', 16, 'hash', 8))
 
     """
 
 
-    def __init__(self, db_url, table_name, conn_params={}):
+    def __init__(self, db_url, table_name, conn_params={}, columns=None,
+                 query=None, sample=None, order_by=None, limit=None,
+                 materialize=False, partitioning=None):
         self.__db_url = db_url
         self.__table_name = table_name
         self.__conn_params = conn_params
+        self.__columns = columns
+        self.__query = None if query is None else Query(query)
+        self.__sample = sample
+        self.__order_by = order_by
+        self.__limit = limit
+        self.__materialize = materialize or sample is not None
+        self.__partitioning = partitioning
 
     @property
     def input_keys(self):
@@ -35,11 +83,41 @@ class SQLRead(RunnableStage):
     def output_keys(self):
         return ['output']
 
+    def __where(self, table):
+        clauses = []
+        if self.__query is not None:
+            clauses.append(self.__query.to_sql_clause(table))
+        if self.__sample is not None:
+            dialect = get_engine(self.__db_url, self.__conn_params).dialect
+            clauses.append(sql_sample_clause(dialect, self.__sample))
+        return sqlalchemy.and_(*clauses)
+
     def run(self, outputs_requested, **kwargs):
         uo = UObject(UObjectPhase.Write)
         uo.from_sql(
-                self.__db_url, 
-                self.__conn_params, 
-                self.__table_name, 
-                False)
-        return {'output': uo}
+                self.__db_url,
+                self.__conn_params,
+                self.__table_name,
+                False,
+                self.__partitioning)
+        if (self.__columns is None and self.__query is None and
+            self.__sample is None and self.__order_by is None and
+            self.__limit is None):
+            return {'output': uo}
+        uo.write_to_read_phase()
+        uo_slice = UObject(UObjectPhase.Write)
+        try:
+            uo_slice.from_sql_select(
+                    uo,
+                    columns=self.__columns,
+                    where=(None if self.__query is None and 
+                           self.__sample is None else self.__where),
+                    order_by=self.__order_by,
+                    limit=self.__limit,
+                    materialize=self.__materialize,
+                    partitioning=self.__partitioning)
+        finally:
+            # The selection has its own connection, so the connection to 
+            # the whole table goes back to the pool
+            uo.cleanup()
+        return {'output': uo_slice}
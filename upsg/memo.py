@@ -0,0 +1,428 @@
+"""A persistent cache of the outputs of pipeline nodes.
+
+When a Pipeline is run with a Memo, each node is given a key that is a
+digest of its stage and of its inputs. If the outputs of a node with the
+same key are in the cache, they are read from the cache and the stage isn't
+run. Otherwise, the stage is run and its outputs are stored in the cache as
+.upsg files. Stages are assumed to compute the same outputs from the same
+inputs each time they are run.
+
+Inputs are identified without reading them wherever possible: an input
+offered by a node that has a key is identified by that key and the output
+key it was offered under, so keys are chained from node to node like a
+Merkle tree. Only inputs offered by nodes without keys, such as nodes that
+read a csv or a database, are identified by the fingerprints of their
+contents. Those nodes are always run, so edits to the files or tables they
+read are always noticed.
+
+Nodes are always run if they have no connected inputs (since they read
+from outside of the pipeline), if they have no connected outputs (since
+they are run for their side effects), if their stage can't be 
+fingerprinted, or if any of their inputs are stored in sql (since the 
+database may change from run to run). Outputs stored in sql are not cached.
+
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import types
+
+import numpy as np
+
+from .uobject import UObject, UObjectPhase
+
+MEMO_ENV_VAR = 'UPSG_MEMO_DIR'
+# Used if MEMO_ENV_VAR isn't set. Relative to the working directory
+DEFAULT_MEMO_DIR = '.upsg_memo'
+DEFAULT_MAX_BYTES = 2 ** 30
+# Changed whenever the way that keys are computed changes, so that old
+# entries are never mistaken for new ones
+MEMO_FORMAT = '1'
+
+
+class Unmemoizable(Exception):
+    pass
+
+
+def __digest_value(digest, value, seen):
+    """Adds a canonical representation of value to digest. seen maps the
+    ids of containers and objects that have already been digested to the
+    order in which they were digested, so cycles terminate"""
+    if value is None or isinstance(value, (bool, int, long, float, complex,
+                                           basestring)):
+        digest.update('{}:{!r};'.format(type(value).__name__, value))
+        return
+    if isinstance(value, np.ndarray):
+        digest.update('ndarray:{}:{};'.format(value.dtype.descr,
+                                              value.shape))
+        if value.dtype.hasobject:
+            for item in value.flat:
+                __digest_value(digest, item, seen)
+        else:
+            digest.update(np.ascontiguousarray(value).data)
+        return
+    if isinstance(value, np.generic):
+        digest.update('{}:{!r};'.format(type(value).__name__, value))
+        return
+    if isinstance(value, (type, types.ClassType, types.ModuleType,
+                          types.BuiltinFunctionType)):
+        digest.update('global:{}.{};'.format(
+            getattr(value, '__module__', None), value.__name__))
+        return
+    if isinstance(value, types.CodeType):
+        digest.update('code:{!r};'.format(value.co_code))
+        __digest_value(digest, value.co_consts, seen)
+        __digest_value(digest, value.co_names, seen)
+        return
+    if id(value) in seen:
+        digest.update('ref:{};'.format(seen[id(value)]))
+        return
+    seen[id(value)] = len(seen)
+    if isinstance(value, types.FunctionType):
+        digest.update('function:{}.{};'.format(value.__module__,
+                                               value.__name__))
+        __digest_value(digest, value.func_code, seen)
+        __digest_value(digest, value.func_defaults, seen)
+        __digest_value(digest,
+                       None if value.func_closure is None else
+                       tuple(cell.cell_contents for cell in
+                             value.func_closure),
+                       seen)
+        return
+    if isinstance(value, types.MethodType):
+        digest.update('method;')
+        __digest_value(digest, value.im_func, seen)
+        __digest_value(digest, value.im_self, seen)
+        return
+    if isinstance(value, (list, tuple)):
+        digest.update('{}:{};'.format(type(value).__name__, len(value)))
+        for item in value:
+            __digest_value(digest, item, seen)
+        return
+    if isinstance(value, (set, frozenset, dict)):
+        # Unordered, so we digest each item on its own and sort the results
+        if isinstance(value, dict):
+            items = value.iteritems()
+        else:
+            items = value
+        item_digests = []
+        for item in items:
+            item_digest = hashlib.sha1()
+            __digest_value(item_digest, item, dict(seen))
+            item_digests.append(item_digest.hexdigest())
+        digest.update('{}:{};'.format(type(value).__name__,
+                                      ''.join(sorted(item_digests))))
+        return
+    # Anything else is digested the way that pickle would save it
+    try:
+        reduced = value.__reduce_ex__(2)
+    except Exception as e:
+        raise Unmemoizable('Cannot fingerprint {!r}: {}'.format(value, e))
+    if isinstance(reduced, basestring):
+        digest.update('global:{}.{};'.format(type(value).__module__,
+                                             reduced))
+        return
+    digest.update('object:{}.{};'.format(type(value).__module__,
+                                         type(value).__name__))
+    __digest_value(digest, reduced, seen)
+
+
+def stage_fingerprint(stage):
+    """Returns a digest of a stage's class and state.
+
+    The state is found the way that pickle would find it, so stages that
+    define __reduce__ (for example, wrapped scikit-learn estimators, which
+    reduce to their estimator class and parameters) are fingerprinted by
+    what __reduce__ returns.
+
+    Parameters
+    ----------
+    stage : upsg.stage.RunnableStage
+
+    Returns
+    -------
+    str
+        A hexadecimal SHA-1 digest
+
+    Raises
+    ------
+    Unmemoizable
+        If some part of the stage's state can't be fingerprinted
+
+    """
+    digest = hashlib.sha1()
+    __digest_value(digest, stage, {})
+    return digest.hexdigest()
+
+
+def get_memo_path(directory='.'):
+    """Returns the path of the cache used when no path is given to Memo.
+
+    Parameters
+    ----------
+    directory : str
+        The directory that the cache is in, unless the UPSG_MEMO_DIR
+        environment variable is set, in which case its value is the path
+        of the cache
+
+    Returns
+    -------
+    str
+        The absolute path of the cache
+
+    """
+    try:
+        path = os.environ[MEMO_ENV_VAR]
+    except KeyError:
+        path = os.path.join(directory, DEFAULT_MEMO_DIR)
+    return os.path.abspath(path)
+
+
+class Memo(object):
+
+    """A directory of cached node outputs.
+
+    Each entry is a directory named by the key of the node that made it,
+    holding one .upsg file per output. Entries are evicted least recently
+    used first once the cache is larger than max_bytes.
+
+    Parameters
+    ----------
+    path : str or None
+        The directory to keep the cache in. It is created if it doesn't
+        exist. If None, the path given by get_memo_path is used.
+    max_bytes : int
+        The size that the cache is kept under
+
+    Examples
+    --------
+    >>> p.run(memo=Memo())
+
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_MAX_BYTES):
+        if path is None:
+            path = get_memo_path()
+        self.__path = os.path.abspath(path)
+        self.__max_bytes = max_bytes
+        if not os.path.isdir(self.__path):
+            try:
+                os.makedirs(self.__path)
+            except OSError:
+                # presumably, another process just made it
+                pass
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __entry_path(self, key):
+        return os.path.join(self.__path, key)
+
+    def load(self, key, output_keys):
+        """Returns the cached outputs of the node with the given key, or
+        None if they aren't all cached
+
+        Parameters
+        ----------
+        key : str
+        output_keys : list of str
+            The outputs that are needed
+
+        Returns
+        -------
+        dict of (str : UObject) or None
+            UObjects in their read phase, backed by the files in the cache
+
+        """
+        entry_path = self.__entry_path(key)
+        file_names = {out_key: os.path.join(entry_path,
+                                            '{}.upsg'.format(out_key)) for
+                      out_key in output_keys}
+        if not all(os.path.exists(file_name) for file_name in
+                   file_names.itervalues()):
+            return None
+        try:
+            # Marks the entry as recently used
+            os.utime(entry_path, None)
+        except OSError:
+            # evicted in the meantime
+            return None
+        return {out_key: UObject(UObjectPhase.Read, file_name=file_name) for
+                out_key, file_name in file_names.iteritems()}
+
+    def store(self, key, output_args):
+        """Caches the outputs of the node with the given key.
+
+        Outputs that are views are stored as complete tables, so entries
+        never depend on files outside of the cache. If any output is
+        stored in sql, nothing is cached.
+
+        Parameters
+        ----------
+        key : str
+        output_args : dict of (str : UObject)
+            UObjects in their read phase
+
+        Returns
+        -------
+        bool
+            Whether the outputs were cached
+
+        """
+        entry_path = self.__entry_path(key)
+        if os.path.exists(entry_path):
+            return True
+        storage_methods = {out_key: uo.get_storage_method() for
+                           out_key, uo in output_args.iteritems()}
+        if 'sql' in storage_methods.itervalues():
+            return False
+        # Written somewhere else first, so a partly written entry is never
+        # loaded
+        partial_path = tempfile.mkdtemp(prefix='.partial_', dir=self.__path)
+        try:
+            for out_key, uo in output_args.iteritems():
+                file_name = os.path.join(partial_path,
+                                         '{}.upsg'.format(out_key))
+                if storage_methods[out_key] == 'view':
+                    uo_table = UObject(UObjectPhase.Write)
+                    uo_table.from_np(uo.to_np())
+                    uo_table.write_to_file(file_name)
+                    uo_table.cleanup()
+                else:
+                    uo.write_to_file(file_name)
+            os.rename(partial_path, entry_path)
+        except OSError:
+            # Another process cached the same entry first
+            shutil.rmtree(partial_path, True)
+            return os.path.exists(entry_path)
+        except:
+            shutil.rmtree(partial_path, True)
+            raise
+        self.__evict(key)
+        return True
+
+    def __evict(self, keep_key):
+        entries = []
+        total_bytes = 0
+        for key in os.listdir(self.__path):
+            if key.startswith('.'):
+                continue
+            entry_path = self.__entry_path(key)
+            try:
+                n_bytes = sum(
+                    os.path.getsize(os.path.join(entry_path, file_name)) for
+                    file_name in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), key, n_bytes))
+            except OSError:
+                # evicted by another process
+                continue
+            total_bytes += n_bytes
+        entries.sort()
+        for _, key, n_bytes in entries:
+            if total_bytes <= self.__max_bytes:
+                break
+            if key == keep_key:
+                continue
+            shutil.rmtree(self.__entry_path(key), True)
+            total_bytes -= n_bytes
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        for key in os.listdir(self.__path):
+            shutil.rmtree(self.__entry_path(key), True)
+
+    def session(self):
+        """Returns a MemoSession for one run of a Pipeline"""
+        return MemoSession(self)
+
+
+class MemoSession(object):
+
+    """Keys the nodes of one run of a Pipeline, and reads and writes their
+    outputs in a Memo.
+
+    Runners call lookup before running each node and finish after it has
+    run (or its outputs have been loaded). Nodes must be looked up after
+    the nodes that they take input from have finished.
+
+    Parameters
+    ----------
+    memo : Memo
+
+    """
+
+    def __init__(self, memo):
+        self.__memo = memo
+        # (Node, output key) : digest identifying the output, for outputs
+        # of nodes that have keys
+        self.__refs = {}
+
+    def __key(self, node, input_args):
+        input_connections = node.get_inputs()
+        output_keys = sorted(node.get_outputs().keys())
+        if not input_connections or not output_keys:
+            return None
+        try:
+            stage_fp = stage_fingerprint(node.get_stage())
+        except Unmemoizable:
+            return None
+        digest = hashlib.sha1()
+        digest.update('{};{};{};'.format(MEMO_FORMAT, stage_fp,
+                                         output_keys))
+        for in_key in sorted(input_args):
+            conn = input_connections[in_key]
+            try:
+                ref = self.__refs[(conn.other.node, conn.other.key)]
+            except KeyError:
+                uo = input_args[in_key]
+                if uo.get_storage_method() == 'sql':
+                    return None
+                ref = uo.fingerprint()
+            digest.update('{}:{};'.format(in_key, ref))
+        return digest.hexdigest()
+
+    def lookup(self, node, input_args):
+        """Finds the key of a node and its cached outputs
+
+        Parameters
+        ----------
+        node : upsg.pipeline.Node
+        input_args : dict of (str : UObject)
+            The inputs that the node will be run with
+
+        Returns
+        -------
+        (str or None, dict of (str : UObject) or None)
+            The node's key, or None if the node can't be memoized, and its
+            cached outputs, or None if they aren't cached
+
+        """
+        key = self.__key(node, input_args)
+        if key is None:
+            return (None, None)
+        return (key, self.__memo.load(key, node.get_outputs().keys()))
+
+    def finish(self, node, key, output_args, from_memo=False):
+        """Records the outputs of a node, caching them if they weren't
+        loaded from the cache
+
+        Parameters
+        ----------
+        node : upsg.pipeline.Node
+        key : str or None
+            The key returned by lookup
+        output_args : dict of (str : UObject)
+            The node's outputs, in their read phase
+        from_memo : bool
+            Whether output_args were returned by lookup
+
+        """
+        if key is None:
+            return
+        for out_key in output_args:
+            self.__refs[(node, out_key)] = hashlib.sha1(
+                '{}:{}'.format(key, out_key)).hexdigest()
+        if not from_memo:
+            self.__memo.store(key, output_args)
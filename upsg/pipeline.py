@@ -1,5 +1,5 @@
 from __future__ import print_function
-from collections import namedtuple
+from collections import namedtuple, deque
 import os
 import sys
 import weakref
@@ -13,12 +13,14 @@ import numpy as np
 
 from .uobject import UObjectException
 from .utils import get_resource_path
+from .db import dispose_engines, engine_keys
 
 RUN_MODE_ENV_VAR = 'UPSG_RUN_MODE'
 
 class RunMode:
-    DBG, LUIGI, LUIGI_QUIET = range(3)
-    from_str = {'dbg': DBG, 'luigi': LUIGI, 'luigi_quiet': LUIGI_QUIET}
+    DBG, LUIGI, LUIGI_QUIET, PARALLEL = range(4)
+    from_str = {'dbg': DBG, 'luigi': LUIGI, 'luigi_quiet': LUIGI_QUIET,
+                'parallel': PARALLEL}
 
 class PipelineException(Exception):
     pass
@@ -187,11 +189,15 @@ class Node(object):
         Otherwise, will default to using __repr__
     uid : str or None
         The unique uid of edge. If not provided, a uid will be generated
+    compression : upsg.uobject.CompressionPolicy or str or None
+        If provided, the CompressionPolicy used by UObjects that this Node's
+        Stage writes. Otherwise, the Pipeline's policy is used.
 
     """
 
 
-    def __init__(self, stage, connections=None, label=None, uid=None):
+    def __init__(self, stage, connections=None, label=None, uid=None,
+                 compression=None):
         self.__stage = stage
         self.__connections = {}
         if connections is None:
@@ -205,6 +211,7 @@ class Node(object):
         if uid == None:
             uid = 'node_{}'.format(uuid.uuid4())
         self.__uid = uid    
+        self.__compression = compression
 
     def __getitem__(self, key):
         """Gets the Connections specified by key"""
@@ -265,6 +272,14 @@ class Node(object):
     def get_stage(self):
         return self.__stage
 
+    def get_compression(self):
+        """Returns the CompressionPolicy given to this Node, or None if the
+        Pipeline's policy should be used"""
+        return self.__compression
+
+    def set_compression(self, compression):
+        self.__compression = compression
+
     def get_inputs(self, live_only=True):
         """Returns a dict of (key : Connection) for all Connections
         that are incoming.
@@ -311,6 +326,10 @@ class Node(object):
     def input_keys(self):
         return self.get_stage().input_keys
 
+    @property
+    def required_input_keys(self):
+        return self.get_stage().required_input_keys
+
     @property
     def uid(self):
         return self.__uid
@@ -330,6 +349,121 @@ class Node(object):
         """Synonym for self.connect_to(other)"""
         self.connect_to(other)
 
+DependencyIndex_ = namedtuple(
+    'DependencyIndex', [
+        'nodes', 'in_degree', 'producers', 'consumers'])
+
+
+class DependencyIndex(DependencyIndex_):
+
+    """A namedtuple recording which Nodes of a Pipeline take input from 
+    which, as built by Pipeline.dependency_index
+
+    Attributes
+    ----------
+    nodes : list of Node
+        Every Node of the Pipeline, in an order in which each Node comes 
+        after all of the Nodes that it takes input from
+    in_degree : dict of (Node : int)
+        The number of distinct Nodes that each Node takes input from
+    producers : dict of (Node : list of Node)
+        The distinct Nodes that each Node takes input from
+    consumers : dict of (Node : list of Node)
+        The distinct Nodes that take input from each Node
+
+    """
+    pass
+
+
+class LiveOutputs(object):
+
+    """Holds the outputs of finished Nodes until the Nodes that take them
+    as input have run.
+
+    Readers are counted per UObject rather than per output, since a Stage 
+    may pass a UObject it was given through as one of its outputs. When the
+    last reader of a UObject is done, the UObject is cleaned up and its 
+    reference dropped, so only the outputs on the frontier of the run are
+    kept.
+
+    Parameters
+    ----------
+    index : DependencyIndex
+        The dependency index of the Pipeline being run
+
+    """
+
+    def __init__(self, index):
+        # (Node, output key) : number of inputs connected to the output
+        self.__n_consumers = {}
+        for node in index.nodes:
+            for conn in node.get_inputs().itervalues():
+                output = (conn.other.node, conn.other.key)
+                self.__n_consumers[output] = self.__n_consumers.get(
+                    output, 0) + 1
+        # (Node, output key) : UObject, for outputs that haven't been read
+        # by all of their consumers
+        self.__outputs = {}
+        # (Node, output key) : number of consumers that have yet to read it
+        self.__n_unread = {}
+        # id of UObject : number of inputs that have yet to read it
+        self.__n_readers = {}
+
+    def __release(self, uo, n_reads=1):
+        uo_id = id(uo)
+        n_readers = self.__n_readers.get(uo_id, 0) - n_reads
+        if n_readers > 0:
+            self.__n_readers[uo_id] = n_readers
+            return
+        self.__n_readers.pop(uo_id, None)
+        uo.cleanup()
+
+    def get_inputs(self, node):
+        """Returns a dict of (input key : UObject) of node's inputs, leaving
+        out inputs that its producers didn't provide"""
+        input_args = {}
+        for input_key, conn in node.get_inputs().iteritems():
+            try:
+                input_args[input_key] = self.__outputs[
+                    (conn.other.node, conn.other.key)]
+            except KeyError:
+                pass
+        return input_args
+
+    def finish(self, node, output_args):
+        """Records that node has run, producing output_args.
+
+        Outputs that are connected to other Nodes are kept for them. Other
+        outputs, and the inputs that node has now read, are cleaned up
+        unless some other Node has yet to read them.
+
+        """
+        unused = []
+        for key, uo in output_args.iteritems():
+            output = (node, key)
+            n_consumers = self.__n_consumers.get(output, 0)
+            if n_consumers == 0:
+                unused.append(uo)
+                continue
+            self.__outputs[output] = uo
+            self.__n_unread[output] = n_consumers
+            self.__n_readers[id(uo)] = self.__n_readers.get(
+                id(uo), 0) + n_consumers
+        for uo in unused:
+            self.__release(uo, 0)
+        for conn in node.get_inputs().itervalues():
+            output = (conn.other.node, conn.other.key)
+            try:
+                uo = self.__outputs[output]
+            except KeyError:
+                continue
+            self.__n_unread[output] -= 1
+            if self.__n_unread[output] == 0:
+                del self.__outputs[output]
+                del self.__n_unread[output]
+            self.__release(uo)
+
+
 class Pipeline(object):
 
     """Internal representation of a UPSG pipeline.
@@ -358,7 +492,7 @@ class Pipeline(object):
         
         """
         return self.__struct_str_rep(self) == self.__struct_str_rep(other)
-    def add(self, stage, label=None):
+    def add(self, stage, label=None, compression=None):
         """Add a stage to the pipeline
 
         Parameters
@@ -368,6 +502,11 @@ class Pipeline(object):
         label: str or None
             label to be returned by created Node's __str__ method. If not
             provieded, will use Node's __repr__ method
+        compression: upsg.uobject.CompressionPolicy or str or None
+            If provided, the CompressionPolicy to use for UObjects written by
+            the stage (or, for a MetaStage, by every stage in its 
+            sub-pipeline that does not have a policy of its own). Otherwise,
+            the policy passed to run is used.
 
         Returns
         -------
@@ -378,14 +517,85 @@ class Pipeline(object):
         # TODO this is here to avoid a circular import. Should refactor
         from stage import MetaStage, RunnableStage
         if isinstance(stage, RunnableStage):
-            node = Node(stage, label=label)
+            node = Node(stage, label=label, compression=compression)
             self.__nodes.append(node)
             return node
         if isinstance(stage, MetaStage):
-            metanode = self.__integrate(stage, *stage.pipeline)
+            other, in_node, out_node = stage.pipeline
+            if compression is not None:
+                for node in other.__nodes:
+                    if node.get_compression() is None:
+                        node.set_compression(compression)
+            metanode = self.__integrate(stage, other, in_node, out_node)
             return metanode
         raise TypeError('Not a valid RunnableStage or MetaStage')
 
+    def dependency_index(self):
+        """Indexes which Nodes take input from which, and orders the Nodes
+        so that each comes after the Nodes it takes input from.
+
+        Building the index takes time linear in the number of Nodes and
+        edges, and checks that the Pipeline can be run.
+
+        Returns
+        -------
+        DependencyIndex
+
+        Raises
+        ------
+        PipelineException
+            If a required input of some Node is not connected, if a Node
+            takes input from a Node that isn't in the Pipeline, or if the
+            Pipeline has a cycle
+
+        """
+        nodes = []
+        consumers = {}
+        for node in self.__nodes:
+            if node not in consumers:
+                nodes.append(node)
+                consumers[node] = []
+        producers = {}
+        unconnected = []
+        for node in nodes:
+            input_connections = node.get_inputs()
+            unconnected += ['{}[{}]'.format(node, key) for key in 
+                            node.required_input_keys if 
+                            key not in input_connections]
+            node_producers = []
+            for conn in input_connections.itervalues():
+                producer = conn.other.node
+                if producer not in consumers:
+                    raise PipelineException(
+                        '{} takes input from {}, which is not in the '
+                        'Pipeline'.format(node, producer))
+                if producer not in node_producers:
+                    node_producers.append(producer)
+                    consumers[producer].append(node)
+            producers[node] = node_producers
+        if unconnected:
+            raise PipelineException(
+                'Required inputs are not connected: {}'.format(
+                    ', '.join(unconnected)))
+        in_degree = {node: len(producers[node]) for node in nodes}
+        # Kahn's algorithm
+        n_waiting = dict(in_degree)
+        ready = deque(node for node in nodes if n_waiting[node] == 0)
+        order = []
+        while ready:
+            node = ready.popleft()
+            order.append(node)
+            for consumer in consumers[node]:
+                n_waiting[consumer] -= 1
+                if n_waiting[consumer] == 0:
+                    ready.append(consumer)
+        if len(order) < len(nodes):
+            raise PipelineException(
+                'Pipeline has a cycle. Nodes in or after the cycle: '
+                '{}'.format(', '.join(str(node) for node in nodes if 
+                                      n_waiting[node] > 0)))
+        return DependencyIndex(order, in_degree, producers, consumers)
+
     def __integrate(self, stage, other, in_node, out_node):
         """Integrates another pipeline into this one and creates a virtual
         uid to access the sub-pipeline.
@@ -531,9 +741,17 @@ class Pipeline(object):
         single_step : bool
             If True, will invoke pdb after every stage is run
 
+        compression : upsg.uobject.CompressionPolicy or str or None
+            The CompressionPolicy used by stages that were not given their 
+            own. See Pipeline.run
+
+        memo : upsg.memo.Memo or None
+            If provided, nodes whose outputs are cached in the Memo are not
+            run, and the outputs of nodes that are run are cached
+
         """
         import run_debug
-        run_debug.run(self, self.__nodes, **kwargs)
+        run_debug.run(self, self.dependency_index(), **kwargs)
 
     def run_luigi(self, **kwargs):
         """Run pipeline using luigi
@@ -543,10 +761,35 @@ class Pipeline(object):
         logging_conf_file : str or None
             Path of file to configure luigi logging that follows the format 
             of: https://docs.python.org/2/library/logging.config.html
+        compression : upsg.uobject.CompressionPolicy or str or None
+            The CompressionPolicy used by stages that were not given their 
+            own. See Pipeline.run
+        workers : int
+            The number of worker processes that run tasks. With more than
+            one, stages are run in other processes, so state that stages
+            set while running (for example, NumpyWrite.result) is not seen
+            by this process.
+        resume : bool
+            If True, outputs are written to the working directory at paths
+            derived from their stages and the stages upstream of them, so a
+            rerun of the same pipeline (for example, after an interruption)
+            skips the nodes whose outputs are already there. Nodes with no
+            connected outputs leave an empty marker file when they finish,
+            and are skipped as well, so what such stages keep in memory 
+            (for example, NumpyWrite.result) is only set by the run that 
+            ran them. The paths don't depend on the data that the pipeline
+            reads, so this assumes that the files and tables that it reads
+            haven't changed since the earlier run. 
+            If False, the default, every node is run.
+        run_id : str
+            Only used if resume is True. Runs with different run_ids don't
+            reuse each other's outputs, so pass a new run_id when the data 
+            that the pipeline reads has changed (or remove the old outputs,
+            for example, with cleanup.py).
         """
 
         import run_luigi
-        run_luigi.run(self.__nodes, **kwargs)
+        run_luigi.run(self.dependency_index(), **kwargs)
 
     def run_luigi_quiet(self, **kwargs):
         """Run a pipeline using luigi using a default logging configuration.
@@ -559,22 +802,59 @@ class Pipeline(object):
                 'luigi_default_logging.cfg')
         self.run_luigi(**kwargs)
 
+    def run_parallel(self, **kwargs):
+        """Run the pipeline in the current Python process, running nodes
+        whose inputs are ready at the same time on a pool of threads or
+        processes.
+
+        Parameters
+        ----------
+        n_workers : int or None
+            The number of nodes to run at once. If None, the number of CPUs
+        pool : {'thread', 'process'}
+            Whether nodes are run by a pool of threads, which pass UObjects
+            to each other without encoding them but take turns reading and
+            writing hdf5 files, or by a pool of processes, which requires
+            stages to be picklable
+        compression : upsg.uobject.CompressionPolicy or str or None
+            The CompressionPolicy used by stages that were not given their 
+            own. See Pipeline.run
+        memo : upsg.memo.Memo or None
+            If provided, nodes whose outputs are cached in the Memo are not
+            run, and the outputs of nodes that are run are cached
+
+        """
+        import run_parallel
+        run_parallel.run(self.dependency_index(), **kwargs)
+
     RUN_METHODS = {RunMode.DBG: run_debug,
                    RunMode.LUIGI: run_luigi,
-                   RunMode.LUIGI_QUIET: run_luigi_quiet}
+                   RunMode.LUIGI_QUIET: run_luigi_quiet,
+                   RunMode.PARALLEL: run_parallel}
 
-    def run(self, run_mode=None, **kwargs):
+    def run(self, run_mode=None, compression=None, **kwargs):
         """Run the pipeline
+
+        When the run finishes, the database engines that it added to the 
+        upsg.db registry are disposed. Engines that were in the registry 
+        before the run, and those of in-memory SQLite databases, are left
+        for the caller to dispose with upsg.db.dispose_engines.
         
         Parameters
         ----------
-        run_mode : {RunMode.DBG, RunMode.LUIGI} or str or None
+        run_mode : {RunMode.DBG, RunMode.LUIGI, RunMode.PARALLEL} or str or None
             Specifies the method to use to run the pipeline. 
             If an attribute of RunMode, specifies the run mode to use.
-            If a str, should be either 'dbg' or 'luigi'
+            If a str, should be one of 'dbg', 'luigi' or 'parallel'
             If None, defaults to debug unless the environmental variable:
-            UPSG_RUN_MODE is set, which should be either 'dbg' or 'luigi' and
-            will specify the run mode
+            UPSG_RUN_MODE is set, which should be one of 'dbg', 'luigi' or
+            'parallel' and will specify the run mode
+        compression : upsg.uobject.CompressionPolicy or str or None
+            The CompressionPolicy used for UObjects written by stages that 
+            were not added with a policy of their own. A str is parsed with
+            CompressionPolicy.from_str. If None, the policy given by the 
+            environmental variable UPSG_COMPRESSION is used, or 
+            upsg.uobject.DEFAULT_COMPRESSION if it is not set.
         kwargs : kwargs
             keyword arguments to pass to the run method
 
@@ -591,4 +871,11 @@ class Pipeline(object):
             except KeyError:
                 run_mode = RunMode.DBG
 
-        self.RUN_METHODS[run_mode](self, **kwargs)
+        existing_engines = engine_keys()
+        try:
+            self.RUN_METHODS[run_mode](self, compression=compression, 
+                                       **kwargs)
+        finally:
+            # Connections that stages' outputs still hold keep working. 
+            # Pools that were open before the run belong to the caller.
+            dispose_engines(existing_engines)
@@ -0,0 +1,185 @@
+"""A log of the tables and files that pipelines generate.
+
+Each generated sql table or view and each .upsg file written by a pipeline
+is recorded as it is created, so the cleanup.py utility can find them
+without opening every .upsg file, and can remove only those that are older
+than a given age. The log is a text file with one tab-separated record per
+line, which is appended to by every process running in the same directory.
+
+"""
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+
+REGISTRY_ENV_VAR = 'UPSG_REGISTRY'
+# Used if REGISTRY_ENV_VAR isn't set. Relative to the working directory
+DEFAULT_REGISTRY_FILE = '.upsg_registry'
+
+__registry_lock = threading.Lock()
+
+RegistryEntry_ = namedtuple(
+    'RegistryEntry', [
+        'created', 'kind', 'name', 'db_url', 'conn_params'])
+
+
+class RegistryEntry(RegistryEntry_):
+
+    """A namedtuple representing one record of the registry
+
+    Attributes
+    ----------
+    created : float
+        When the table or file was created, in seconds since the epoch
+    kind : {'sql', 'file', 'ref'}
+        Whether the record is for a sql table or view, for a file, or 
+        for a file that a view refers to, which shouldn't be removed while
+        the record is kept
+    name : str
+        The name of the table or view, or the absolute path of the file
+    db_url : str or None
+        For sql records, the sqlalchemy url for the database
+    conn_params : dict of str : ? or None
+        For sql records, parameters to pass to the DBAPI 2 connect() method
+
+    """
+    pass
+
+
+def get_registry_path(directory='.'):
+    """Returns the path of the registry that this process records to.
+
+    Parameters
+    ----------
+    directory : str
+        The directory that the registry is in, unless the UPSG_REGISTRY 
+        environment variable is set, in which case its value is the path
+        of the registry
+
+    Returns
+    -------
+    str
+        The absolute path of the registry
+
+    """
+    try:
+        path = os.environ[REGISTRY_ENV_VAR]
+    except KeyError:
+        path = os.path.join(directory, DEFAULT_REGISTRY_FILE)
+    return os.path.abspath(path)
+
+
+def __append(entries, path):
+    lines = ''.join(
+        '\t'.join((repr(entry.created),
+                   entry.kind,
+                   entry.name,
+                   entry.db_url or '',
+                   json.dumps(entry.conn_params))) + '\n' for
+        entry in entries)
+    with __registry_lock:
+        # Each record is written with a single write to a file opened for
+        # appending, so records from different processes don't interleave
+        with open(path, 'a') as fout:
+            fout.write(lines)
+
+
+def register_table(db_url, conn_params, tbl_name):
+    """Records that a pipeline has created a sql table or view
+
+    Parameters
+    ----------
+    db_url : str
+        The sqlalchemy url for the database
+    conn_params : dict of str : ?
+        Parameters to pass to the DBAPI 2 connect() method
+    tbl_name : str
+        The name of the table or view
+
+    """
+    __append([RegistryEntry(time.time(), 'sql', tbl_name, db_url,
+                            conn_params)],
+             get_registry_path())
+
+
+def register_file(path):
+    """Records that a pipeline has written a file
+
+    Parameters
+    ----------
+    path : str
+        The path of the file
+
+    """
+    __append([RegistryEntry(time.time(), 'file', os.path.abspath(path),
+                            None, None)],
+             get_registry_path())
+
+
+def register_reference(path):
+    """Records that a view has been made of the table in a file, so the 
+    file is kept at least as long as the view
+
+    Parameters
+    ----------
+    path : str
+        The path of the file
+
+    """
+    __append([RegistryEntry(time.time(), 'ref', os.path.abspath(path),
+                            None, None)],
+             get_registry_path())
+
+
+def read_registry(path):
+    """Returns the records in a registry, oldest first
+
+    Parameters
+    ----------
+    path : str
+        The path of the registry
+
+    Returns
+    -------
+    list of RegistryEntry
+
+    """
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as fin:
+        for line in fin:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                # A record that was being written when a process died
+                continue
+            created, kind, name, db_url, conn_params = fields
+            conn_params = json.loads(conn_params)
+            if conn_params is not None:
+                # json gives us unicode keys, which can't be used as 
+                # keyword arguments
+                conn_params = {str(key): value for key, value in 
+                               conn_params.iteritems()}
+            entries.append(RegistryEntry(
+                float(created),
+                kind,
+                name,
+                db_url or None,
+                conn_params))
+    return entries
+
+
+def write_registry(path, entries):
+    """Appends records to a registry, creating it if it doesn't exist
+
+    Parameters
+    ----------
+    path : str
+        The path of the registry
+    entries : list of RegistryEntry
+        The records to append
+
+    """
+    if entries:
+        __append(entries, path)
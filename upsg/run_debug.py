@@ -9,7 +9,8 @@ from StringIO import StringIO
 import numpy as np
 
 from .utils import html_escape
-from .uobject import UObjectException
+from .uobject import UObjectException, compression_policy
+from .pipeline import LiveOutputs
 
 class BasePrinter(object):
     __metaclass__ = abc.ABCMeta
@@ -84,7 +85,8 @@ class Printer(BasePrinter):
         # http://stackoverflow.com/questions/566746/how-to-get-console-window-width-in-python
         # (2nd answer)
         try:
-            a = uo.to_np()[:10]
+            # We only need the first few rows, so don't read the whole table
+            a = next(uo.iter_np(10))
         except UObjectException: # unsupported conversion
             return ''
         header = fmt_row_1.format(
@@ -216,9 +218,9 @@ class GraphPrinter(BasePrinter):
         print('Report printed to: {}'.format(
             os.path.abspath(self.__out_file)))
 
-    def __data_print(self, a):
+    def __data_print(self, a, n_rows):
         self.__fout.write('<p>table of shape: ({},{})</p>'.format(
-            len(a),
+            n_rows,
             len(a.dtype)))
         self.__fout.write('<p><table>\n')
         header = '<tr>{}</tr>\n'.format(
@@ -263,8 +265,14 @@ class GraphPrinter(BasePrinter):
                    node[arg].other.node))
             uo = output_args[arg]
             try:
-                a = uo.to_np()
-                self.__data_print(a)
+                # We only print the first 100 rows, so that's all we read
+                a = next(uo.iter_np(100))
+                stats = uo.stats(compute=False)
+                if stats is None:
+                    n_rows = sum(chunk.shape[0] for chunk in uo.iter_np())
+                else:
+                    n_rows = stats.rows
+                self.__data_print(a, n_rows)
             except UObjectException:
                 try:
                     a = uo.to_external_file()
@@ -335,7 +343,8 @@ def get_progress_stage_printer():
 
 DEBUG_OUTPUT_ENV_VAR = 'UPSG_DEBUG_OUTPUT_MODE'
 
-def run(pipeline, nodes, output='', report_path='', single_step=False):
+def run(pipeline, index, output='', report_path='', single_step=False,
+        compression=None, memo=None):
     """Run the pipeline in the current Python process.
 
     This method of running the job runs everything in serial on a single
@@ -346,6 +355,8 @@ def run(pipeline, nodes, output='', report_path='', single_step=False):
     ----------
     pipeline : upsg.pipeline.Pipeline
         The Pipeline to run
+    index : upsg.pipeline.DependencyIndex
+        The Pipeline's dependency index. Nodes are run in its order
     output : str
         Method of displaying output. One of:
 
@@ -376,6 +387,14 @@ def run(pipeline, nodes, output='', report_path='', single_step=False):
     single_step : bool
         If True, will invoke pdb after every stage is run
 
+    compression : upsg.uobject.CompressionPolicy or str or None
+        The CompressionPolicy used for nodes that don't have their own. If 
+        None, the policy already in effect is used.
+
+    memo : upsg.memo.Memo or None
+        If provided, nodes whose outputs are in this cache are not run, and
+        the outputs of nodes that are run are added to it
+
     """
 
     if output == '':
@@ -405,38 +424,28 @@ def run(pipeline, nodes, output='', report_path='', single_step=False):
         stage_printer = Printer()
 
     stage_printer.header_print()
-    # TODO what should the user call rather than run?
-    node_queue = [node for node in nodes
-                  if not node.get_outputs()]  # start with the root nodes
-    state = dict.fromkeys(nodes, None)
-    while node_queue:
-        node = node_queue.pop()
-        if state[node] is not None:  # already computed
-            continue
-        input_connections = node.get_inputs()
-        input_nodes = frozenset([input_connections[input_key].other.node
-                                 for input_key in input_connections])
-        unfinished_dependencies = [dep_node for dep_node in input_nodes
-                                   if state[dep_node] is None]
-        if unfinished_dependencies:
-            node_queue.append(node)
-            node_queue += unfinished_dependencies
-            continue
-        input_args = {
-            input_key: state[other][other_key] for input_key,
-            other,
-            other_key in map(
-                lambda k: (
-                    k,
-                    input_connections[k].other.node,
-                    input_connections[k].other.key),
-                input_connections) if other_key in state[other]}
-        output_args = node.get_stage().run(node.get_outputs().keys(),
-                                           **input_args)
-        map(lambda k: output_args[k].write_to_read_phase(), output_args)
+    state = LiveOutputs(index)
+    session = None if memo is None else memo.session()
+    for node in index.nodes:
+        input_args = state.get_inputs(node)
+        key, output_args = None, None
+        if session is not None:
+            key, output_args = session.lookup(node, input_args)
+        from_memo = output_args is not None
+        if not from_memo:
+            node_compression = node.get_compression()
+            if node_compression is None:
+                node_compression = compression
+            with compression_policy(node_compression):
+                output_args = node.get_stage().run(
+                        node.get_outputs().keys(),
+                        **input_args)
+            map(lambda k: output_args[k].write_to_read_phase(), output_args)
+        if session is not None:
+            session.finish(node, key, output_args, from_memo)
         stage_printer.stage_print(node, input_args, output_args)
-        state[node] = output_args
         if single_step:
             import pdb
             pdb.set_trace()
+        state.finish(node, output_args)
     stage_printer.footer_print()
@@ -1,13 +1,63 @@
 from collections import namedtuple
 import logging
+import os
+import hashlib
+import uuid
 
 import luigi
 import luigi.mock
 
-from .uobject import UObject, UObjectPhase
+from .uobject import UObject, UObjectPhase, compression_policy
 from .utils import get_resource_path
+from .registry import register_file
+from .memo import stage_fingerprint, Unmemoizable
 
-def node_to_task(node, context):
+# Changed whenever the way that output paths are derived changes
+OUTPUT_PATH_FORMAT = '1'
+
+
+def node_key(node, keys, run_id=''):
+    """Returns a digest identifying the work that a node does, from which
+    the paths of its outputs are derived.
+
+    The digest covers the node's stage, the outputs that are asked of it,
+    and the keys of the nodes that it takes input from, so a node gets the
+    same key in every run of the same pipeline. If the stage can't be
+    fingerprinted, the node's uid is used instead, so the node's outputs 
+    are never reused.
+
+    Parameters
+    ----------
+    node : upsg.pipeline.Node
+    keys : dict of (upsg.pipeline.Node : str)
+        The keys of the nodes that node takes input from
+    run_id : str
+        Included in every key, so runs with different run_ids don't share
+        outputs
+
+    Returns
+    -------
+    str
+        A hexadecimal SHA-1 digest
+
+    """
+    try:
+        stage_fp = stage_fingerprint(node.get_stage())
+    except Unmemoizable:
+        stage_fp = node.uid
+    digest = hashlib.sha1()
+    digest.update('{};{};{};{};'.format(
+        OUTPUT_PATH_FORMAT, 
+        run_id, 
+        stage_fp, 
+        sorted(node.get_outputs().keys())))
+    for in_key, conn in sorted(node.get_inputs().iteritems()):
+        digest.update('{}:{}:{};'.format(in_key, keys[conn.other.node],
+                                         conn.other.key))
+    return digest.hexdigest()
+
+
+def node_to_task(node, context, compression=None, key=None):
     logger = logging.getLogger('luigi-interface')
 
     # we need to keep track of which node gives which output
@@ -19,13 +69,28 @@ def node_to_task(node, context):
         return req_tasks
 
     # TODO nonlocal targets
-    out_files = {key: luigi.file.LocalTarget('{}.upsg'.format(
-                    conn.edge.uid)) for key, conn  in node_outputs.iteritems()}
+    if key is None:
+        key = node.uid
+    # Paths are derived from the key, so outputs left by an earlier run that
+    # did the same work are found and the task isn't run again
+    out_files = {out_key: luigi.file.LocalTarget('{}_{}.upsg'.format(
+                    key, out_key)) for out_key in node_outputs}
     def output(self):
         return out_files
 
+    # Tasks without outputs are run for their side effects. They leave an
+    # empty file when they finish, so they aren't run again either
+    done_file = luigi.file.LocalTarget('{}.done'.format(key))
+    def complete(self):
+        if not node_outputs:
+            return done_file.exists()
+        return luigi.Task.complete(self)
+
     others_output_keys = {in_key: node_inputs[in_key].other.key 
                           for in_key in node_inputs}
+    node_compression = node.get_compression()
+    if node_compression is None:
+        node_compression = compression
     def run(self):
         logger.debug('running UPSG node: {} (uid {}): '
                      '#in_keys# {} #out_keys# {}'.format(
@@ -33,69 +98,59 @@ def node_to_task(node, context):
                         node.uid, 
                         node_inputs.keys(),
                         node_outputs.keys()))
-        input_files = {in_key:
-                       self.input()[in_key][others_output_keys[in_key]].open('r') 
-                       for in_key in others_output_keys}
+        # Inputs are opened directly from disk, so only the parts of each
+        # file that the stage touches are read
         input_args = {in_key:
                       UObject(
                           UObjectPhase.Read, 
-                          input_files[in_key].read()) for in_key in 
-                          others_output_keys}
-        [input_files[in_key].close() for in_key in input_files]
-        output_args = node.get_stage().run(node_outputs.keys(), **input_args)
-        output_files = {out_key: self.output()[out_key].open('w') for 
-                        out_key in node_outputs}
-        [output_files[out_key].write(output_args[out_key].get_image()) for 
-         out_key in output_files]
-        [output_files[out_key].close() for out_key in output_files]
-        self.__complete = True
+                          file_name=self.input()[in_key][
+                              others_output_keys[in_key]].path) 
+                      for in_key in others_output_keys}
+        with compression_policy(node_compression):
+            output_args = node.get_stage().run(node_outputs.keys(), 
+                                               **input_args)
+        for out_key in node_outputs:
+            # write somewhere else first so that an interrupted write never
+            # looks like a finished output. Nodes that do the same work 
+            # share output paths, so worker processes write to their own
+            # partial files
+            out_path = self.output()[out_key].path
+            partial_path = '{}.{}.partial'.format(out_path, os.getpid())
+            output_args[out_key].write_to_file(partial_path)
+            os.rename(partial_path, out_path)
+            register_file(out_path)
         [input_args[in_key].cleanup() for in_key in input_args]
         [output_args[out_key].cleanup() for out_key in output_args]
-        
-
-    def __init__(self):
-        luigi.Task.__init__(self)
-        self.__complete = False
-
-    def complete(self):
-        return self.__complete
+        if not node_outputs:
+            open(done_file.path, 'w').close()
+            register_file(done_file.path)
 
     task = type(
         'Task_{}'.format(node.uid), 
         (luigi.Task,), 
-        {'__init__': __init__,
-         'requires': requires, 
+        {'requires': requires, 
          'output': output, 
-         'run': run, 
-         'complete': complete})()
+         'complete': complete,
+         'run': run})()
 
 
     context[node] = task
     return task
 
 
-def run(nodes, logging_conf_file=None):
-    node_queue = [node for node in nodes
-                  if not node.get_outputs()]  # start with the leaves
-    context = dict.fromkeys(nodes, None)
+def run(index, logging_conf_file=None, compression=None, workers=1, 
+        resume=False, run_id=''):
+    context = {}
+    keys = {}
+    if not resume:
+        # Source data may have changed since an earlier run, and nothing in
+        # the keys would show it, so unless asked to, we don't reuse outputs
+        run_id = uuid.uuid4().hex
     luigi.interface.setup_interface_logging(logging_conf_file)
     sch = luigi.scheduler.CentralPlannerScheduler()
-    w = luigi.worker.Worker(scheduler=sch)
-    while node_queue:
-        node = node_queue.pop()
-        if context[node] is not None:  # already computed
-            continue
-        input_connections = node.get_inputs()
-        input_nodes = frozenset([input_connections[input_key].other.node
-                                 for input_key in input_connections])
-        unfinished_dependencies = [dep_node for dep_node in input_nodes
-                                   if context[dep_node] is None]
-        if unfinished_dependencies:
-            node_queue.append(node)
-            node_queue += unfinished_dependencies
-            continue
-        w.add(node_to_task(node, context))
-    w.run()        
-    
-
-
+    w = luigi.worker.Worker(scheduler=sch, worker_processes=workers)
+    # Each node's producers have tasks and keys by the time we get to it
+    for node in index.nodes:
+        keys[node] = node_key(node, keys, run_id)
+        w.add(node_to_task(node, context, compression, keys[node]))
+    w.run()
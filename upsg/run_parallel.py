@@ -0,0 +1,169 @@
+"""Runs a pipeline in the current Python process, running nodes whose inputs
+are ready at the same time on a pool of workers.
+
+With a pool of threads, nodes share the process, so UObjects are handed from
+one node to the next as Python objects rather than as hdf5 images. HDF5 
+isn't thread-safe, so only one thread at a time reads or writes the hdf5 
+files behind UObjects (for example, tables written in chunks with 
+from_np_chunks); see upsg.uobject.HDF5_LOCK. This suits stages that spend 
+their time in numpy, scikit-learn or the database, which release the GIL, 
+rather than stages that mostly read and write UObjects. With a pool of 
+processes, each node's stage is sent to a worker process along with the hdf5
+images of its inputs, and the images of its outputs and the state of the 
+stage afterward are sent back.
+
+"""
+import sys
+import cPickle
+import Queue
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+
+from .uobject import UObject, UObjectPhase, compression_policy
+from .db import dispose_engines
+from .pipeline import PipelineException, LiveOutputs
+
+POOL_TYPES = ('thread', 'process')
+# Seconds to wait for a node to finish at a time. In Python 2, waiting on a
+# queue without a timeout can't be interrupted with Ctrl-C.
+WAIT_TIMEOUT = 60 * 60 * 24
+
+
+def __run_in_thread(node, input_args, compression):
+    try:
+        with compression_policy(compression):
+            output_args = node.get_stage().run(node.get_outputs().keys(),
+                                               **input_args)
+        for key in output_args:
+            output_args[key].write_to_read_phase()
+        return output_args, None
+    except Exception:
+        return None, sys.exc_info()
+
+
+def __run_in_process(pickled_stage, outputs_requested, input_images,
+                     compression):
+    # Everything, including the stage's state, is pickled here so that
+    # anything that can't be sent back is reported as the node's error
+    # rather than lost in the pool
+    try:
+        stage = cPickle.loads(pickled_stage)
+        input_args = {key: UObject(UObjectPhase.Read, hdf5_image=image) for
+                      key, image in input_images.iteritems()}
+        with compression_policy(compression):
+            output_args = stage.run(outputs_requested, **input_args)
+        output_images = {key: output_args[key].get_image() for
+                         key in output_args}
+        [output_args[key].cleanup() for key in output_args]
+        [input_args[key].cleanup() for key in input_args]
+        return output_images, cPickle.dumps(vars(stage), -1), None
+    except Exception as e:
+        return None, None, e
+
+
+def run(index, n_workers=None, pool='thread', compression=None, memo=None):
+    """Run the pipeline with a pool of workers in the current Python process.
+
+    Parameters
+    ----------
+    index : upsg.pipeline.DependencyIndex
+        The dependency index of the Pipeline to run
+    n_workers : int or None
+        The number of nodes to run at once. If None, the number of CPUs
+    pool : {'thread', 'process'}
+        Whether nodes are run by a pool of threads or a pool of processes.
+        With a pool of threads, access to hdf5 files is serialized. With a
+        pool of processes, stages must be picklable, and each stage is 
+        updated with the state that its copy had after being run.
+    compression : upsg.uobject.CompressionPolicy or str or None
+        The CompressionPolicy used for nodes that don't have their own. If
+        None, the policy already in effect is used.
+    memo : upsg.memo.Memo or None
+        If provided, nodes whose outputs are in this cache are not run, and
+        the outputs of nodes that are run are added to it. The cache is
+        read and written by this thread rather than by the workers.
+
+    """
+    if pool not in POOL_TYPES:
+        raise PipelineException('pool must be one of {}'.format(POOL_TYPES))
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    consumers = index.consumers
+    # number of each node's producers that haven't finished
+    n_waiting = dict(index.in_degree)
+    ready = deque(node for node in index.nodes if n_waiting[node] == 0)
+    state = LiveOutputs(index)
+    session = None if memo is None else memo.session()
+    # Node : key in memo
+    keys = {}
+    # Node : outputs loaded from memo
+    loaded = {}
+    finished = Queue.Queue()
+
+    if pool == 'process':
+        # Worker processes shouldn't inherit pooled database connections
+        dispose_engines()
+        workers = multiprocessing.Pool(n_workers)
+    else:
+        workers = ThreadPool(n_workers)
+
+    def submit(node):
+        input_args = state.get_inputs(node)
+        if session is not None:
+            keys[node], output_args = session.lookup(node, input_args)
+            if output_args is not None:
+                loaded[node] = output_args
+                finished.put((node, None))
+                return
+        node_compression = node.get_compression()
+        if node_compression is None:
+            node_compression = compression
+        callback = lambda result: finished.put((node, result))
+        if pool == 'thread':
+            workers.apply_async(
+                __run_in_thread,
+                (node, input_args, node_compression),
+                callback=callback)
+            return
+        workers.apply_async(
+            __run_in_process,
+            (cPickle.dumps(node.get_stage(), -1),
+             node.get_outputs().keys(),
+             {key: input_args[key].get_image() for key in input_args},
+             node_compression),
+            callback=callback)
+
+    try:
+        for _ in xrange(len(index.nodes)):
+            while ready:
+                submit(ready.popleft())
+            node, result = finished.get(timeout=WAIT_TIMEOUT)
+            if result is None:
+                output_args = loaded.pop(node)
+            elif pool == 'thread':
+                output_args, exc_info = result
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                output_images, stage_state, error = result
+                if error is not None:
+                    raise error
+                vars(node.get_stage()).update(cPickle.loads(stage_state))
+                output_args = {key: UObject(UObjectPhase.Read,
+                                            hdf5_image=image) for
+                               key, image in output_images.iteritems()}
+            if session is not None:
+                session.finish(node, keys.pop(node), output_args,
+                               result is None)
+            state.finish(node, output_args)
+            for consumer in consumers[node]:
+                n_waiting[consumer] -= 1
+                if n_waiting[consumer] == 0:
+                    ready.append(consumer)
+        workers.close()
+    except:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
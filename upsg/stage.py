@@ -12,14 +12,20 @@ class __Stage(object):
     def input_keys(self):
         """A list of keys signifying what this Stage will be expecting as input.
 
-            For some stages, all inputs need not be required. At present, if
-            an input is required but not provided in the pipeline, the user
-            will have to deal with a runtime error. In the future, we intend
-            to build a way to enforce requirements at the pipeline building
-            stage
+            For some stages, all inputs need not be required. Inputs that 
+            must be connected are listed in required_input_keys.
+
+        """
+        return []
+
+    @property
+    def required_input_keys(self):
+        """The input keys that must be connected for this Stage to run. 
+
+            A Pipeline refuses to run if any of these are left unconnected.
+            By default, no input is required.
 
         """
-        # TODO enforce required input
         return []
 
     @abc.abstractproperty
@@ -5,7 +5,6 @@ from .stage import RunnableStage, MetaStage
 from .pipeline import Pipeline
 from .transform.identity import Identity
 from .transform.split import SplitColumns, SplitY, Query
-from .transform.timify import Timify
 from .fetch.csv import CSVRead
 from .fetch.sql import SQLRead
 from .wrap.wrap_sklearn import wrap
@@ -83,11 +82,11 @@ class DataToaster(MetaStage):
         return self
 
     def from_csv(self, file_name):
-        self.__from(CSVRead, file_name)
-        return self.__transform(Timify)
+        return self.__from(CSVRead, file_name, parse_dates=True)
 
-    def from_sql(self, db_url, table_name, conn_params={}):
-        return self.__from(SQLRead, db_url, table_name, conn_params)
+    def from_sql(self, db_url, table_name, conn_params={}, **kwargs):
+        return self.__from(SQLRead, db_url, table_name, conn_params, 
+                           **kwargs)
 
     FetchedConn = namedtuple('FetchedConn', ('conn', 'key'))
 
@@ -1,3 +1,5 @@
+import itertools as it
+
 import numpy as np
 
 from ..stage import RunnableStage
@@ -31,6 +33,10 @@ class FillNA(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['output']
@@ -38,11 +44,17 @@ class FillNA(RunnableStage):
     def run(self, outputs_requested, **kwargs):
         default_value = self.__default_value
         uo_out = UObject(UObjectPhase.Write)
-        in_array = kwargs['input'].to_np()
-        # http://stackoverflow.com/questions/5124376/convert-nan-value-to-zero
-        for (col_name, fmt) in in_array.dtype.descr:
-            if 'f' in fmt:
-                in_array[col_name][np.isnan(in_array[col_name])] = default_value 
-        uo_out.from_np(in_array)
+
+        def fill(chunk):
+            # iter_np may give us a read-only view of another stage's output, 
+            # so we fill a copy
+            chunk = chunk.copy()
+            # http://stackoverflow.com/questions/5124376/convert-nan-value-to-zero
+            for (col_name, fmt) in chunk.dtype.descr:
+                if 'f' in fmt:
+                    chunk[col_name][np.isnan(chunk[col_name])] = default_value 
+            return chunk
+
+        uo_out.from_np_chunks(it.imap(fill, kwargs['input'].iter_np()))
 
         return {'output': uo_out}
@@ -28,6 +28,10 @@ class LabelEncode(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['output']
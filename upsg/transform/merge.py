@@ -38,6 +38,10 @@ class Merge(RunnableStage):
     @property
     def input_keys(self):
         return ['input_left', 'input_right']
+
+    @property
+    def required_input_keys(self):
+        return ['input_left', 'input_right']
     
     @property
     def output_keys(self):
@@ -34,15 +34,17 @@ class RenameCols(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['output']
 
     def run(self, outputs_requested, **kwargs):
-        # TODO maybe we can avoid rewriting all the data (esp in sql) by
-        # creating some sort of a "view" object
         uo_out = UObject(UObjectPhase.Write)
-        in_array = kwargs['input'].to_np()
+        uo_in = kwargs['input']
         rename_dict = self.__rename_dict
 
         if isinstance(rename_dict, dict):
@@ -51,9 +53,10 @@ class RenameCols(RunnableStage):
                     return rename_dict[col]
                 except KeyError:
                     return col
-            in_array.dtype.names = map(repl, in_array.dtype.names)
+            new_names = map(repl, uo_in.get_column_names())
         else:
-            in_array.dtype.names = rename_dict
-        uo_out.from_np(in_array)
+            new_names = rename_dict
+
+        uo_out.from_view(uo_in, rename=new_names)
 
         return {'output': uo_out}
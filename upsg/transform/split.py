@@ -2,14 +2,17 @@ import tokenize
 from StringIO import StringIO
 from token import *
 import itertools as it
+import operator
 import numpy as np
 import ast
+import sqlalchemy
 
 from sklearn.cross_validation import train_test_split
 from sklearn.cross_validation import KFold as SKKFold
 
 from ..stage import RunnableStage
 from ..uobject import UObject, UObjectPhase
+from ..utils import datetime64_to_datetime
 
 class SplitColumns(RunnableStage):
     """
@@ -44,27 +47,30 @@ class SplitColumns(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['output', 'complement']
 
     def run(self, outputs_requested, **kwargs):
-        # TODO different implementation if internally sql?
         columns = list(self.__columns)
 
         to_return = {}
-        in_array = kwargs['input'].to_np()
+        uo_in = kwargs['input']
 
         if 'output' in outputs_requested:
             uo_out = UObject(UObjectPhase.Write)
-            uo_out.from_np(in_array[columns])
+            uo_out.from_view(uo_in, columns)
             to_return['output'] = uo_out
 
         if 'complement' in outputs_requested:
             uo_complement = UObject(UObjectPhase.Write)
-            # http://stackoverflow.com/questions/3462143/get-difference-between-two-lists
-            remaining_columns = list(set(in_array.dtype.names) - set(columns))
-            uo_complement.from_np(in_array[remaining_columns])
+            remaining_columns = [col for col in uo_in.get_column_names() if
+                                 col not in columns]
+            uo_complement.from_view(uo_in, remaining_columns)
             to_return['complement'] = uo_complement
 
         return to_return
@@ -103,6 +109,10 @@ class SplitY(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['X', 'y']
@@ -110,15 +120,15 @@ class SplitY(RunnableStage):
     def run(self, outputs_requested, **kwargs):
         uo_X = UObject(UObjectPhase.Write)
         uo_y = UObject(UObjectPhase.Write)
-        in_array = kwargs['input'].to_np()
-        names = list(in_array.dtype.names)
+        uo_in = kwargs['input']
+        names = uo_in.get_column_names()
         if isinstance(self.__column, int):
             col_name = names[self.__column]
         else:
             col_name = self.__column
-        uo_y.from_np(in_array[[col_name]])
+        uo_y.from_view(uo_in, [col_name])
         names.remove(col_name)
-        uo_X.from_np(in_array[names])
+        uo_X.from_view(uo_in, names)
         return {'X': uo_X, 'y': uo_y}
 
 
@@ -155,6 +165,10 @@ class SplitTrainTest(RunnableStage):
     def input_keys(self):
         return self.__input_keys
 
+    @property
+    def required_input_keys(self):
+        return self.__input_keys
+
     @property
     def output_keys(self):
         return self.__output_keys
@@ -220,6 +234,10 @@ class KFold(RunnableStage):
     def input_keys(self):
         return self.__input_keys
 
+    @property
+    def required_input_keys(self):
+        return self.__input_keys
+
     @property
     def output_keys(self):
         return self.__output_keys
@@ -300,6 +318,10 @@ class Query(RunnableStage):
         col_names need to be the name of a column in the table. col_names
         SHOULD NOT be quoted. Literal string SHOULD be quoted
 
+        If input is stored in sql, the query is translated into a SQL WHERE
+        clause and output and complement are views in the same database.
+        NULLs are treated the way numpy treats NaN.
+
     Examples
     --------
     >>> q1 = Query("id > 50")
@@ -335,6 +357,8 @@ class Query(RunnableStage):
         def __init__(self, col_names, array_name):
             self.__col_names = col_names
             self.__array_name = ast.Name(id=array_name, ctx=ast.Load())
+            # columns that the query actually refers to
+            self.referenced_cols = []
 
         def __visit_op(self, np_op, *args):
             module, attr = np_op.split('.')
@@ -390,6 +414,8 @@ class Query(RunnableStage):
             if col_name not in self.__col_names:
                 raise QueryError('\'{}\' is not a valid column name'.format(
                     col_name))
+            if col_name not in self.referenced_cols:
+                self.referenced_cols.append(col_name)
             sub_slice = ast.Index(value=ast.Str(s=col_name)) 
             return ast.Subscript(
                     value=self.__array_name, 
@@ -421,6 +447,37 @@ class Query(RunnableStage):
         def generic_visit(self, node):
             raise QueryError('node {} not supported'.format(node))
 
+    # For each comparison op, functions of (min, max, literal) that are True
+    # if the comparison is True for every value in [min, max] and 
+    # if the comparison is False for every value in [min, max], respectively
+    __RANGE_DECISIONS = {
+        ast.Lt: (lambda lo, hi, v: hi < v, lambda lo, hi, v: lo >= v),
+        ast.LtE: (lambda lo, hi, v: hi <= v, lambda lo, hi, v: lo > v),
+        ast.Gt: (lambda lo, hi, v: lo > v, lambda lo, hi, v: hi <= v),
+        ast.GtE: (lambda lo, hi, v: lo >= v, lambda lo, hi, v: hi < v),
+        ast.Eq: (lambda lo, hi, v: lo == hi == v, 
+                 lambda lo, hi, v: v < lo or v > hi),
+        ast.NotEq: (lambda lo, hi, v: v < lo or v > hi, 
+                    lambda lo, hi, v: lo == hi == v)}
+
+    # The op to use if a comparison's operands are swapped
+    __FLIPPED_CMP = {
+        ast.Lt: ast.Gt,
+        ast.LtE: ast.GtE,
+        ast.Gt: ast.Lt,
+        ast.GtE: ast.LtE,
+        ast.Eq: ast.Eq,
+        ast.NotEq: ast.NotEq}
+
+    # sqlalchemy equivalents of comparison ops
+    __SQL_CMP = {
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne}
+
     def __init__(self, query):
         self.__query = query
 
@@ -429,19 +486,175 @@ class Query(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['output', 'complement', 'output_inds', 'complement_inds']
 
     def __get_ast(self, col_names):
+        """Returns the transformed AST and the columns that it refers to"""
         parser = self.__QueryParser(col_names, self.__IN_TABLE_NAME)
         query = ast.fix_missing_locations(
                 parser.visit(ast.parse(self.__query, mode='eval')))
-        return query
+        return query, parser.referenced_cols
+
+    def __literal(self, node):
+        """Returns the value of a literal in the query, or None if node is
+        not a literal"""
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, ast.Str):
+            return node.s
+        if (isinstance(node, ast.Call) and len(node.args) == 1 and 
+            isinstance(node.args[0], ast.Str)):
+            return np.datetime64(node.args[0].s)
+        return None
+
+    def __decide(self, node, stats):
+        """Uses the min and max of each column to decide the query without
+        reading the table.
+
+        Parameters
+        ----------
+        node : ast.AST
+            A node of the untransformed query
+        stats : upsg.uobject.TableStats
+            Statistics of the table being queried
+
+        Returns
+        -------
+        True if every row satisfies node, False if no row satisfies node, or
+        None if the statistics aren't enough to tell.
+
+        """
+        if isinstance(node, ast.Expression):
+            return self.__decide(node.body, stats)
+        if isinstance(node, ast.BoolOp):
+            decisions = [self.__decide(value, stats) for value in 
+                         node.values]
+            short_circuit = isinstance(node.op, ast.Or)
+            if any(decision is short_circuit for decision in decisions):
+                return short_circuit
+            if all(decision is (not short_circuit) for decision in 
+                   decisions):
+                return not short_circuit
+            return None
+        if isinstance(node, ast.UnaryOp):
+            decision = self.__decide(node.operand, stats)
+            return None if decision is None else not decision
+        if isinstance(node, ast.Name):
+            col_stats = stats.columns[node.id]
+            if col_stats.min is None or col_stats.min.dtype.kind != 'b':
+                return None
+            if col_stats.min:
+                return True
+            if not col_stats.max:
+                return False
+            return None
+        if isinstance(node, ast.Compare):
+            op = type(node.ops[0])
+            left = node.left
+            right = node.comparators[0]
+            if isinstance(left, ast.Name):
+                col_node, literal_node = left, right
+            elif isinstance(right, ast.Name):
+                col_node, literal_node = right, left
+                op = self.__FLIPPED_CMP[op]
+            else:
+                return None
+            literal = self.__literal(literal_node)
+            col_stats = stats.columns[col_node.id]
+            if literal is None or col_stats.min is None:
+                return None
+            kind = col_stats.min.dtype.kind
+            if kind == 'M':
+                if not isinstance(literal, np.datetime64):
+                    return None
+            elif kind in 'iuf':
+                if not isinstance(literal, (int, long, float)):
+                    return None
+            else:
+                return None
+            all_true, all_false = self.__RANGE_DECISIONS[op]
+            lo = col_stats.min
+            hi = col_stats.max
+            # NaN and NaT are != to everything and fail every other 
+            # comparison
+            if all_true(lo, hi, literal) and (col_stats.nulls == 0 or 
+                                              op is ast.NotEq):
+                return True
+            if all_false(lo, hi, literal) and (col_stats.nulls == 0 or 
+                                               op is not ast.NotEq):
+                return False
+            return None
+        return None
+
+    def __sql_clause(self, node, table):
+        """Translates a node of the untransformed query into a 
+        sqlalchemy clause over table"""
+        if isinstance(node, ast.Expression):
+            return self.__sql_clause(node.body, table)
+        if isinstance(node, ast.BoolOp):
+            clauses = [self.__sql_clause(value, table) for value in 
+                       node.values]
+            if isinstance(node.op, ast.Or):
+                return sqlalchemy.or_(*clauses)
+            return sqlalchemy.and_(*clauses)
+        if isinstance(node, ast.UnaryOp):
+            return sqlalchemy.not_(self.__sql_clause(node.operand, table))
+        if isinstance(node, ast.Name):
+            return sqlalchemy.func.coalesce(table.c[node.id], 
+                                            sqlalchemy.false())
+        if isinstance(node, ast.Compare):
+            op = type(node.ops[0])
+            left = self.__sql_operand(node.left, table)
+            right = self.__sql_operand(node.comparators[0], table)
+            if not isinstance(left, sqlalchemy.sql.ClauseElement):
+                left = sqlalchemy.literal(left)
+            null_value = sqlalchemy.true() if op is ast.NotEq else (
+                sqlalchemy.false())
+            return sqlalchemy.func.coalesce(self.__SQL_CMP[op](left, right),
+                                            null_value)
+        raise QueryError('node {} not supported'.format(node))
+
+    def __sql_operand(self, node, table):
+        """Returns the column, Python value or clause that a side of a 
+        comparison refers to"""
+        if isinstance(node, ast.Name):
+            return table.c[node.id]
+        literal = self.__literal(node)
+        if literal is not None:
+            # Leaving literals as Python values lets sqlalchemy give them 
+            # the type of the column they're compared with
+            return datetime64_to_datetime(literal)
+        return self.__sql_clause(node, table)
+
+    def to_sql_clause(self, table):
+        """Translates the query into a clause for a SQL WHERE over table.
+
+        Comparisons with NULL are False, except for != which is True, so 
+        NULLs are selected the same way as NaN and NaT are by numpy.
+
+        Parameters
+        ----------
+        table : sqlalchemy.schema.Table
+            The table being queried
+
+        Returns
+        -------
+        sqlalchemy.sql.ClauseElement
+
+        """
+        # Raises a QueryError if the query isn't valid for the table
+        self.__get_ast([col.name for col in table.columns])
+        return self.__sql_clause(ast.parse(self.__query, mode='eval'), table)
 
     def dump_ast(self, col_names):
         """Dumps the AST of the query transformed into Python. Provided for debugging purposes."""
-        query = self.__get_ast(col_names)
+        query, referenced_cols = self.__get_ast(col_names)
         return ast.dump(query)
 
     def run(self, outputs_requested, **kwargs):
@@ -452,18 +665,65 @@ class Query(RunnableStage):
         #     http://pandas.pydata.org/pandas-docs/dev/generated/pandas.eval.html
         # supports numpy arithmetic comparison operators:
         #     http://docs.scipy.org/doc/numpy/reference/arrays.ndarray.html#arithmetic-and-comparison-operations
-        in_table = kwargs['input'].to_np()
-        col_names = in_table.dtype.names
-        query = self.__get_ast(col_names)
-        mask = eval(compile(query, '<string>', 'eval'))
+        uo_in = kwargs['input']
+        col_names = uo_in.get_column_names()
+        query, referenced_cols = self.__get_ast(col_names)
         ret = {}
+        if uo_in.get_storage_method() == 'sql':
+            # Select the rows in the database, next to the data, rather 
+            # than reading the table
+            where = self.to_sql_clause
+            if 'output' in outputs_requested:
+                uo_out = UObject(UObjectPhase.Write)
+                uo_out.from_sql_select(uo_in, where=where)
+                ret['output'] = uo_out
+            if 'complement' in outputs_requested:
+                uo_comp = UObject(UObjectPhase.Write)
+                uo_comp.from_sql_select(
+                    uo_in, 
+                    where=lambda table: sqlalchemy.not_(where(table)))
+                ret['complement'] = uo_comp
+            # Indices still need the mask, since sql tables have no 
+            # inherent row order to index
+            outputs_requested = [key for key in outputs_requested if key 
+                                 not in ret]
+            if not outputs_requested:
+                return ret
+        # Statistics only save time if they're already there. Computing them
+        # reads every column, not just the ones that the query mentions
+        stats = uo_in.stats(compute=False)
+        decision = None
+        if stats is not None:
+            decision = self.__decide(ast.parse(self.__query, mode='eval'), 
+                                     stats)
+        if decision is None:
+            code = compile(query, '<string>', 'eval')
+            # We only need the columns that the query mentions to build the
+            # mask, and we only need them a chunk at a time
+            mask = np.concatenate([
+                np.asarray(eval(code, globals(), 
+                                {self.__IN_TABLE_NAME: chunk}), 
+                           dtype=bool) for
+                chunk in uo_in.iter_np(columns=referenced_cols)])
+        else:
+            # The statistics tell us the answer without looking at the data
+            mask = np.empty(stats.rows, dtype=bool)
+            mask.fill(decision)
+
+        def select_rows(chunk_mask):
+            start = 0
+            for chunk in uo_in.iter_np():
+                stop = start + chunk.shape[0]
+                yield chunk[chunk_mask[start:stop]]
+                start = stop
+
         if 'output' in outputs_requested:
             uo_out = UObject(UObjectPhase.Write)
-            uo_out.from_np(in_table[mask])
+            uo_out.from_np_chunks(select_rows(mask))
             ret['output'] = uo_out
         if 'complement' in outputs_requested:
             uo_comp = UObject(UObjectPhase.Write)
-            uo_comp.from_np(in_table[np.logical_not(mask)])
+            uo_comp.from_np_chunks(select_rows(np.logical_not(mask)))
             ret['complement'] = uo_comp
         if 'output_inds' in outputs_requested:
             uo_out_inds = UObject(UObjectPhase.Write)
@@ -495,13 +755,17 @@ class SplitByInds(RunnableStage):
     def input_keys(self):
         return ['input', 'inds']
 
+    @property
+    def required_input_keys(self):
+        return ['input', 'inds']
+
     @property
     def output_keys(self):
         return ['output']
 
     def run(self, outputs_requested, **kwargs):
-        in_table = kwargs['input'].to_np()
         inds = kwargs['inds'].to_np()
         ret = {'output': UObject(UObjectPhase.Write)}
-        ret['output'].from_np(in_table[inds[inds.dtype.names[0]]])
+        ret['output'].from_view(kwargs['input'], 
+                                rows=inds[inds.dtype.names[0]])
         return ret
@@ -1,10 +1,13 @@
 from copy import deepcopy
+import re
+import sys
 
 import sqlalchemy
 
 from ..stage import RunnableStage
 from ..uobject import UObject, UObjectPhase
 from ..utils import random_table_name
+from ..db import get_connection, invalidate_tables
 
 
 class RunSQL(RunnableStage):
@@ -41,8 +44,25 @@ class RunSQL(RunnableStage):
         Specification 2.0
         (https://www.python.org/dev/peps/pep-0249/#connect)
 
+    unlogged : bool
+        If True and the database is PostgreSQL, output tables created with
+        "CREATE TABLE {out_key}" are created as UNLOGGED tables, which 
+        skip the write-ahead log. They are faster to write, but are 
+        emptied if the database crashes. Ignored for other databases.
+
     in_keys and out_keys should not share any elements
 
+    Inputs that aren't already stored in the database are uploaded to
+    tables that are shared with every other stage and run that uploads the
+    same contents (see UObject.to_sql), so query must treat the tables
+    of its inputs as read-only. A query that alters, deletes from or drops
+    an input table changes what later runs read.
+
+    All of the statements in query are run on one connection in a single
+    transaction. If any statement fails, the transaction is rolled back and
+    any outputs that already exist are dropped (for databases, like SQLite,
+    that commit CREATE statements as they are run).
+
     Examples
     --------
     Say that we are generating two tables elsewhere in the
@@ -62,13 +82,15 @@ class RunSQL(RunnableStage):
     
     """
 
-    def __init__(self, db_url, query, in_keys=[], out_keys=[], conn_params={}):
+    def __init__(self, db_url, query, in_keys=[], out_keys=[], conn_params={},
+                 unlogged=False):
 
         self.__query = query
         self.__in_keys = in_keys
         self.__out_keys = out_keys
         self.__db_url = db_url
         self.__conn_params = conn_params
+        self.__unlogged = unlogged
 
     @property
     def input_keys(self):
@@ -78,22 +100,64 @@ class RunSQL(RunnableStage):
     def output_keys(self):
         return self.__out_keys
 
+    def __make_unlogged(self, query):
+        """Makes CREATE TABLE statements for outputs CREATE UNLOGGED TABLE"""
+        out_keys = '|'.join(re.escape(key) for key in self.__out_keys)
+        if not out_keys:
+            return query
+        return re.sub(
+            r'(CREATE\s+)(TABLE\s+\{{(?:{})\}})'.format(out_keys),
+            r'\1UNLOGGED \2',
+            query,
+            flags=re.IGNORECASE)
+
+    def __drop_outputs(self, conn, tbl_names):
+        """Drops whichever of the output tables or views exist"""
+        inspector = sqlalchemy.inspect(conn)
+        views = set(inspector.get_view_names())
+        tables = set(inspector.get_table_names())
+        quote = conn.dialect.identifier_preparer.quote
+        for tbl_name in tbl_names:
+            if tbl_name in views:
+                conn.execute('DROP VIEW {}'.format(quote(tbl_name)))
+            elif tbl_name in tables:
+                conn.execute('DROP TABLE {}'.format(quote(tbl_name)))
+
     def run(self, outputs_requested, **kwargs):
         db_url = self.__db_url
         conn_params = self.__conn_params
-        conn = sqlalchemy.create_engine(db_url, connect_args=conn_params)
         sql_info = {key: kwargs[key].to_sql(db_url, conn_params) for 
                     key in kwargs}
 
         table_names = {key: sql_info[key].table.name for key in sql_info}
         table_names.update({key: random_table_name() for
                             key in self.__out_keys})
-        query = self.__query.format(**table_names)
-
-        # sqlalchemy only lets us execute one statement at a time
-        # TODO execute these within a transaction so we don't break ACID
-        [conn.execute(sqlalchemy.sql.text(statement))
-         for statement in query.split(';')]
+        conn = get_connection(db_url, conn_params)
+        try:
+            query = self.__query
+            if self.__unlogged and conn.dialect.name == 'postgresql':
+                query = self.__make_unlogged(query)
+            query = query.format(**table_names)
+            # sqlalchemy only lets us execute one statement at a time
+            statements = [statement for statement in query.split(';') if
+                          statement.strip()]
+            trans = conn.begin()
+            try:
+                for statement in statements:
+                    conn.execute(sqlalchemy.sql.text(statement))
+                trans.commit()
+            except:
+                exc_info = sys.exc_info()
+                trans.rollback()
+                self.__drop_outputs(conn, 
+                                    [table_names[key] for key in 
+                                     self.__out_keys])
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            conn.close()
+            # We don't know which tables the query created, altered or 
+            # dropped
+            invalidate_tables(db_url)
 
         output = {key: UObject(UObjectPhase.Write) for key in self.__out_keys}
         [output[key].from_sql(db_url, conn_params, table_names[key], True) for
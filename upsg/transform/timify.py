@@ -24,28 +24,51 @@ class Timify(RunnableStage):
     def input_keys(self):
         return ['input']
 
+    @property
+    def required_input_keys(self):
+        return ['input']
+
     @property
     def output_keys(self):
         return ['output']
 
     def run(self, outputs_requested, **kwargs):
-        in_data = kwargs['input'].to_np()
-        cols = []
-        dtype = []
-        
-        for name, sub_dtype in in_data.dtype.descr:
-            col = in_data[name]
-            if 'S' in sub_dtype:
+        uo_in = kwargs['input']
+
+        # First pass: find the string columns that are times in every chunk,
+        # and the finest unit that any chunk needs
+        dt_dtypes = {}
+        not_dt = set()
+        for chunk in uo_in.iter_np():
+            for name, sub_dtype in chunk.dtype.descr:
+                if 'S' not in sub_dtype or name in not_dt:
+                    continue
                 try:
-                    col = col.astype('M8')
-                    sub_dtype = col.dtype
+                    col_dtype = chunk[name].astype('M8').dtype
                 except ValueError: # not a time
-                    pass
-            cols.append(col)
-            dtype.append((name, sub_dtype))
+                    not_dt.add(name)
+                    dt_dtypes.pop(name, None)
+                    continue
+                try:
+                    dt_dtypes[name] = np.promote_types(dt_dtypes[name], 
+                                                       col_dtype)
+                except KeyError:
+                    dt_dtypes[name] = col_dtype
+
+        # Second pass: convert
+        def convert(chunk):
+            dtype = [(name, dt_dtypes.get(name, sub_dtype)) for 
+                     name, sub_dtype in chunk.dtype.descr]
+            out = np.empty(chunk.shape[0], dtype=dtype)
+            for name, _ in dtype:
+                if name in dt_dtypes:
+                    out[name] = chunk[name].astype(dt_dtypes[name])
+                else:
+                    out[name] = chunk[name]
+            return out
 
         uo_out = UObject(UObjectPhase.Write)
-        uo_out.from_np(np.fromiter(it.izip(*cols), dtype=dtype))
+        uo_out.from_np_chunks(it.imap(convert, uo_in.iter_np()))
         return {'output': uo_out}
 
         
@@ -1,10 +1,32 @@
+import os
 import tables
 import uuid
-from collections import namedtuple
+import hashlib
+import threading
+import functools
+import itertools as it
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 import numpy as np
 import sqlalchemy
 from utils import np_nd_to_sa, is_sa, np_type, np_sa_to_dict, dict_to_np_sa
-from utils import sql_to_np, np_to_sql, random_table_name, obj_to_str
+from utils import np_sa_select_cols, np_sa_rename_cols, np_sa_to_nd
+from utils import np_nd_recast
+from utils import sql_to_np, sql_iter_np, np_to_sql, random_table_name
+from utils import SQLPartitioning
+from utils import obj_to_str, np_col_hashes, kmv_update, kmv_estimate
+from utils import csv_sample_dtype, csv_iter_np, CSVSchemaError
+from db import get_connection, reflect_table, find_upload, register_upload
+from registry import register_table, register_reference
+
+# Default number of rows to handle at once when reading or writing a UObject
+# in chunks
+DEFAULT_CHUNK_ROWS = 65536
+
+COMPRESSION_ENV_VAR = 'UPSG_COMPRESSION'
+
+# Size of the K-Minimum-Values sketches used to estimate distinct counts
+KMV_SIZE = 1024
 
 SQLTableInfo_ = namedtuple(
     'SQLTableInfo', [
@@ -31,6 +53,224 @@ class SQLTableInfo(SQLTableInfo_):
     pass
 
 
+ViewInfo_ = namedtuple(
+    'ViewInfo', [
+        'parent', 'parent_columns', 'columns', 'rows'])
+
+
+class ViewInfo(ViewInfo_):
+
+    """A namedtuple describing a UObject with the "view" storage method
+
+    Attributes
+    ----------
+    parent : UObject
+        The UObject, in its read phase, holding the underlying table
+    parent_columns : list of str
+        The columns of parent that appear in the view, in view order
+    columns : list of str
+        The names that those columns have in the view
+    rows : numpy.ndarray or None
+        Indices of the rows of parent that appear in the view, in view
+        order, or None if all rows appear
+
+    """
+    pass
+
+
+ColumnStats_ = namedtuple(
+    'ColumnStats', [
+        'nulls', 'min', 'max', 'distinct', 'nbytes'])
+
+
+class ColumnStats(ColumnStats_):
+
+    """A namedtuple of statistics about one column of a table
+
+    Attributes
+    ----------
+    nulls : int
+        The number of NaNs (for float columns) or NaTs (for datetime64 
+        columns). Always 0 for other types.
+    min : numpy scalar or None
+        The smallest value in the column other than NaN or NaT. None for 
+        string columns, and for columns without any such values.
+    max : numpy scalar or None
+        The largest value in the column. See min.
+    distinct : int
+        An estimate of the number of distinct values in the column. Exact
+        if there are fewer than KMV_SIZE distinct values.
+    nbytes : int
+        The size of the column in bytes when held in a numpy array
+
+    """
+    pass
+
+
+TableStats_ = namedtuple(
+    'TableStats', [
+        'rows', 'nbytes', 'columns'])
+
+
+class TableStats(TableStats_):
+
+    """A namedtuple of statistics about a table
+
+    Attributes
+    ----------
+    rows : int
+        The number of rows in the table
+    nbytes : int
+        The size of the table in bytes when held in a numpy structured array
+    columns : collections.OrderedDict of str : ColumnStats
+        Statistics for each column, in table order
+
+    """
+    pass
+
+
+CompressionPolicy_ = namedtuple(
+    'CompressionPolicy', [
+        'complib', 'complevel', 'shuffle', 'chunk_rows'])
+
+
+class CompressionPolicy(CompressionPolicy_):
+
+    """A namedtuple describing how UObjects compress the tables and arrays
+    that they write to hdf5
+
+    Attributes
+    ----------
+    complib : str or None
+        The compression library to use. Any library that PyTables supports,
+        for example 'zlib', 'blosc', 'blosc:lz4' or 'blosc:zstd'. The blosc
+        filters are faster than zlib, but they ship with PyTables rather 
+        than with HDF5, so files that use them can't be read by HDF5 tools
+        or libraries (such as h5py) that don't have the filter installed
+    complevel : int
+        Compression level from 0 to 9. 0 disables compression
+    shuffle : bool
+        Whether or not to apply the shuffle filter before compressing
+    chunk_rows : int or None
+        The number of rows in each hdf5 chunk. If None, PyTables picks a 
+        chunk size
+
+    """
+
+    def get_filters(self):
+        """Returns the tables.Filters corresponding to this policy"""
+        if not self.complevel:
+            return tables.Filters(complevel=0)
+        return tables.Filters(complevel=self.complevel, complib=self.complib,
+                              shuffle=self.shuffle)
+
+    def get_chunkshape(self, row_shape=()):
+        """Returns the chunkshape to use for a table or array whose rows 
+        have the given shape"""
+        if self.chunk_rows is None:
+            return None
+        return (self.chunk_rows,) + tuple(row_shape)
+
+    @classmethod
+    def from_str(cls, policy_str):
+        """Parses a policy of the form used by the UPSG_COMPRESSION 
+        environmental variable.
+
+        The string is either 'none' or a comma-separated list of 
+        key=value pairs, where the keys are attributes of CompressionPolicy.
+        Attributes that are not given take their values from 
+        DEFAULT_COMPRESSION. For example:
+        
+            complib=blosc:zstd,complevel=9,shuffle=0,chunk_rows=8192
+
+        """
+        policy_str = policy_str.strip()
+        if policy_str.lower() == 'none':
+            return NO_COMPRESSION
+        parsers = {'complib': str, 'complevel': int, 
+                   'shuffle': lambda val: bool(int(val)),
+                   'chunk_rows': int}
+        values = {}
+        for item in policy_str.split(','):
+            try:
+                key, val = item.split('=')
+                values[key.strip()] = parsers[key.strip()](val.strip())
+            except (ValueError, KeyError):
+                raise UObjectException(
+                    'Invalid compression policy {}'.format(policy_str))
+        return DEFAULT_COMPRESSION._replace(**values)
+
+NO_COMPRESSION = CompressionPolicy(None, 0, False, None)
+# zlib is built into HDF5, so any HDF5 reader can read .upsg files written
+# with the default policy
+DEFAULT_COMPRESSION = CompressionPolicy('zlib', 1, True, None)
+
+__compression_state = threading.local()
+
+
+def get_compression_policy():
+    """Returns the CompressionPolicy that UObjects created in the current
+    thread will use.
+
+    This is the innermost policy set with compression_policy. If none has
+    been set, it is the policy given by the UPSG_COMPRESSION environmental 
+    variable, or DEFAULT_COMPRESSION if the variable is not set.
+
+    """
+    try:
+        return __compression_state.policies[-1]
+    except (AttributeError, IndexError):
+        pass
+    try:
+        return CompressionPolicy.from_str(os.environ[COMPRESSION_ENV_VAR])
+    except KeyError:
+        return DEFAULT_COMPRESSION
+
+
+@contextmanager
+def compression_policy(policy):
+    """Context manager setting the CompressionPolicy used by UObjects 
+    created in the current thread.
+
+    Parameters
+    ----------
+    policy : CompressionPolicy or str or None
+        The policy to use. A str is parsed with CompressionPolicy.from_str. 
+        If None, the policy in effect is left unchanged.
+
+    """
+    if isinstance(policy, basestring):
+        policy = CompressionPolicy.from_str(policy)
+    if policy is None:
+        yield
+        return
+    try:
+        policies = __compression_state.policies
+    except AttributeError:
+        policies = __compression_state.policies = []
+    policies.append(policy)
+    try:
+        yield
+    finally:
+        policies.pop()
+
+
+# PyTables, and the HDF5 library under it, aren't thread-safe, so UObject
+# methods that touch hdf5 files hold this lock. It is reentrant because 
+# UObjects call each other while holding it (for example, a view reads its
+# parent, and from_np_chunks may consume another UObject's iter_np)
+HDF5_LOCK = threading.RLock()
+
+
+def hdf5_locked(method):
+    """Decorates a method so that it holds HDF5_LOCK while it runs"""
+    @functools.wraps(method)
+    def locked(*args, **kwargs):
+        with HDF5_LOCK:
+            return method(*args, **kwargs)
+    return locked
+
+
 class UObjectException(Exception):
 
     """Exception related to UObjects"""
@@ -87,12 +327,103 @@ class UObject(object):
         If the file is being written, this argument is optional and will have
         no effect. 
 
-        If the file is being read, this argument is mandatory. Failure
-        to specify the argument will result in an exception.
+        If the file is being read, either this argument or file_name is 
+        mandatory. Failure to specify one of them will result in an 
+        exception.
+    file_name : str or None
+        If provided, the path of a .upsg file on the local disk that backs
+        this UObject. 
+
+        If the file is being written, the hdf5 file will be created at this 
+        path and written to directly rather than being built in memory. 
+
+        If the file is being read, the file at this path will be opened
+        with a normal, file-backed PyTables open. Only the parts of the file
+        that are actually accessed will be read from disk.
+
+    Notes
+    -----
+    When a UObject is written with from_np (or another from\_ method that
+    produces a table in memory), the UObject keeps a reference to the
+    written array rather than encoding it immediately. If the UObject is
+    then moved to its read phase in the same process with 
+    write_to_read_phase, to_np returns a read-only view of that array and
+    no hdf5 encoding or decoding takes place. The hdf5 representation is 
+    only produced when something asks for it (for example, get_image).
+
+    UObjects may be used from several threads at once. Because HDF5 isn't
+    thread-safe, only one thread at a time reads or writes an hdf5 file; 
+    see HDF5_LOCK.
 
     """
 
-    def __open_for_read(self, hdf5_image):
+    class __StatsAccumulator(object):
+        """Accumulates TableStats over the successive chunks of a table"""
+
+        RANGE_KINDS = 'biufM'
+
+        def __init__(self, dtype):
+            self.__dtype = dtype
+            n_cols = len(dtype)
+            self.__rows = 0
+            self.__nulls = [0] * n_cols
+            self.__mins = [None] * n_cols
+            self.__maxes = [None] * n_cols
+            self.__sketches = [np.empty(0, dtype=np.uint64)] * n_cols
+
+        def update(self, A):
+            """Adds the rows of the structured array A"""
+            self.update_cols([A[name] for name in A.dtype.names])
+
+        def update_cols(self, cols):
+            """Adds rows given as a list of 1-dimensional arrays, one for 
+            each column"""
+            if cols:
+                self.__rows += cols[0].shape[0]
+            for i, col in enumerate(cols):
+                # Columns of structured arrays are strided, so we copy each 
+                # one once rather than striding over it for every statistic
+                col = np.ascontiguousarray(col)
+                kind = col.dtype.kind
+                if kind == 'f':
+                    null_mask = np.isnan(col)
+                elif kind == 'M':
+                    null_mask = np.isnat(col)
+                else:
+                    null_mask = None
+                valid = col
+                if null_mask is not None and null_mask.any():
+                    valid = col[np.logical_not(null_mask)]
+                self.__nulls[i] += col.shape[0] - valid.shape[0]
+                if kind in self.RANGE_KINDS and valid.shape[0] > 0:
+                    col_min = valid.min()
+                    col_max = valid.max()
+                    if self.__mins[i] is None or col_min < self.__mins[i]:
+                        self.__mins[i] = col_min
+                    if self.__maxes[i] is None or col_max > self.__maxes[i]:
+                        self.__maxes[i] = col_max
+                self.__sketches[i] = kmv_update(
+                    self.__sketches[i], 
+                    np_col_hashes(col), 
+                    KMV_SIZE)
+
+        def get_stats(self):
+            dtype = self.__dtype
+            rows = self.__rows
+            columns = OrderedDict(
+                (name, ColumnStats(
+                    self.__nulls[i], 
+                    self.__mins[i], 
+                    self.__maxes[i],
+                    kmv_estimate(self.__sketches[i], KMV_SIZE),
+                    rows * dtype[i].itemsize)) for 
+                i, name in enumerate(dtype.names))
+            return TableStats(rows, rows * dtype.itemsize, columns)
+
+    def __open_for_read(self, hdf5_image=None):
+        if self.__file_name is not None:
+            self.__file = tables.open_file(self.__file_name, mode='r')
+            return
         file_name = str(uuid.uuid4()) + '.upsg'
         #print 'Reading ' + file_name
         self.__file = tables.open_file(
@@ -102,32 +433,71 @@ class UObject(object):
                 driver_core_backing_store=0,
                 driver_core_image=hdf5_image)
 
-    def __init__(self, phase, hdf5_image=None):
-
-        self.__phase = phase
-        self.__finalized = False
+    def __open_for_write(self, file_name=None):
+        """Creates a new hdf5 file with an incomplete /upsg_inf group.
 
-        if phase == UObjectPhase.Write:
+        If file_name is None, the file is created in memory. Otherwise, it is
+        created on disk at file_name
+        
+        """
+        if file_name is None:
             # create an in-memory hdf5 file
             file_name = str(uuid.uuid4()) + '.upsg'
             #print 'Writing ' + file_name
-            self.__file = tables.open_file(
+            hfile = tables.open_file(
                     file_name,
                     mode='w',
                     driver='H5FD_CORE',
                     driver_core_backing_store=0)
-            upsg_inf_grp = self.__file.create_group('/', 'upsg_inf')
-            self.__file.set_node_attr(
-                upsg_inf_grp,
-                'storage_method',
-                'INCOMPLETE')
-            self.__file.flush()
+        else:
+            hfile = tables.open_file(file_name, mode='w')
+        upsg_inf_grp = hfile.create_group('/', 'upsg_inf')
+        hfile.set_node_attr(
+            upsg_inf_grp,
+            'storage_method',
+            'INCOMPLETE')
+        hfile.flush()
+        return hfile
+
+    @hdf5_locked
+    def __init__(self, phase, hdf5_image=None, file_name=None):
+
+        self.__phase = phase
+        self.__finalized = False
+        # array that this UObject was written from. Kept so that UObjects
+        # passed between stages in the same process don't have to go through
+        # hdf5
+        self.__in_memory = None
+        # storage method of self.__in_memory
+        self.__in_memory_method = None
+        # converter that has not yet been applied to self.__file
+        self.__pending = None
+        self.__file_name = file_name
+        # Captured now so that writes deferred until after the creating stage
+        # has finished still use that stage's policy
+        self.__compression = get_compression_policy()
+        # TableStats, once they have been computed or read
+        self.__stats = None
+        # ViewInfo, if this UObject is a view and it has been resolved
+        self.__view = None
+        # Number of views that read from this UObject. While there are any,
+        # cleanup is deferred until the last of them is cleaned up
+        self.__n_dependents = 0
+        self.__cleanup_deferred = False
+        # SQLTableInfo, if this UObject is stored in sql and has connected
+        # to the database
+        self.__sql_table_info = None
+        # hex digest of the contents, once it has been computed
+        self.__fingerprint = None
+
+        if phase == UObjectPhase.Write:
+            self.__file = self.__open_for_write(file_name)
             return
 
         if phase == UObjectPhase.Read:
-            if hdf5_image is None:
+            if hdf5_image is None and file_name is None:
                 raise UObjectException(('Asked to open in read mode but no '
-                                        'image provided'))
+                                        'image or file name provided'))
             self.__open_for_read(hdf5_image)
             return
 
@@ -136,16 +506,77 @@ class UObject(object):
     def __del__(self):
         self.cleanup()
 
+    @hdf5_locked
     def cleanup(self):
+        if self.__n_dependents > 0:
+            self.__cleanup_deferred = True
+            return
+        view = self.__view
+        self.__view = None
+        self.__in_memory = None
+        self.__stats = None
+        self.__fingerprint = None
+        self.__pending = None
+        if self.__sql_table_info is not None:
+            # Closed here rather than whenever the garbage collector gets 
+            # to it, which may be in a thread that isn't allowed to
+            self.__sql_table_info.conn.close()
+            self.__sql_table_info = None
         try:
             self.__file.close()
         except IOError:
             # presumably, file is already closed
             pass
+        if view is not None:
+            view.parent.__remove_dependent()
 
+    def __add_dependent(self):
+        self.__n_dependents += 1
+
+    def __remove_dependent(self):
+        self.__n_dependents -= 1
+        if self.__n_dependents == 0 and self.__cleanup_deferred:
+            self.cleanup()
+
+    @hdf5_locked
     def get_image(self):
+        """Returns a string containing the hdf5 representation of this 
+        UObject.
+
+        If the UObject has only been kept in memory so far, this is the point 
+        at which the hdf5 representation is produced.
+
+        """
+        self.__write_pending()
         return self.__file.get_file_image()
 
+    @hdf5_locked
+    def write_to_file(self, file_name):
+        """Writes the hdf5 representation of this UObject to a .upsg file
+        on the local disk.
+
+        Unlike get_image, the representation is never held in memory as a 
+        string. The UObject must either be finalized or in its read phase.
+
+        Parameters
+        ----------
+        file_name : str
+            Path of the file to write. An existing file will be overwritten
+
+        """
+        if self.__phase == UObjectPhase.Write and not self.__finalized:
+            raise UObjectException('UObject is not finalized')
+        if self.__pending is not None:
+            # We haven't encoded anything yet, so encode straight to disk
+            hfile = self.__open_for_write(file_name)
+            try:
+                self.__apply_converter(self.__pending, hfile)
+            finally:
+                hfile.close()
+            return
+        self.__file.flush()
+        self.__file.copy_file(file_name, overwrite=True)
+
     def get_phase(self):
         """
         
@@ -167,6 +598,7 @@ class UObject(object):
         """
         return self.__finalized
 
+    @hdf5_locked
     def write_to_read_phase(self):
         """
         
@@ -183,40 +615,337 @@ class UObject(object):
         if not self.__finalized:
             raise UObjectException('UObject is not finalized')
 
-        image = self.__file.get_file_image()
-        self.__file.close()
-        self.__open_for_read(image)
+        if self.__in_memory is not None:
+            # in-process handoff. We can skip hdf5 entirely. 
+            self.__phase = UObjectPhase.Read
+            self.__finalized = False
+            return
+
+        if self.__file_name is not None:
+            # The data is already on disk. Just reopen it.
+            self.__file.close()
+            self.__open_for_read()
+        else:
+            image = self.__file.get_file_image()
+            self.__file.close()
+            self.__open_for_read(image)
         self.__phase = UObjectPhase.Read
         self.__finalized = False
 
     def __get_conn(self, conn=None, db_url=None, conn_params={}):
         if conn is not None:
             return conn
-        engine = sqlalchemy.create_engine(db_url)
-        return engine.connect(**conn_params)
+        return get_connection(db_url, conn_params)
 
     def __get_new_table_name(self):
         return random_table_name()
 
-    def __convert_to(self, target_format, conn=None, db_url=None,
-                     conn_params={}, tbl_name=None):
-        # TODO write this nicer than if statements
-        storage_method = self.__file.get_node_attr(
-            '/upsg_inf',
-            'storage_method')
+    def __storage_method(self):
+        if self.__in_memory is not None:
+            return self.__in_memory_method
+        return self.__file.get_node_attr('/upsg_inf', 'storage_method')
+
+    def __read_np(self, columns=None):
+        storage_method = self.__storage_method()
+        if storage_method == 'view':
+            return self.__read_view(columns)
+        if storage_method == 'matrix':
+            return self.__read_matrix_sa(columns)
+        if storage_method == 'columnar':
+            return self.__read_columnar(columns)
+        if storage_method == 'sql':
+            # Views of sql tables that select rows read their parents here
+            sql_table_info = self.__sql_table()
+            return sql_to_np(sql_table_info.table, sql_table_info.conn, 
+                             columns, self.__sql_partitioning())
+
+        if self.__in_memory is not None:
+            # Readers get a view so they can't alter the writer's array
+            A = self.__in_memory.view(np.ndarray)
+            if columns is not None:
+                return np_sa_select_cols(A, columns)
+            A.flags.writeable = False
+            return A
+
+        hfile = self.__file
+        table = hfile.root.np.table
+        if columns is None:
+            A = table.read()
+        else:
+            # read a buffer's worth of rows at a time so that we never have 
+            # to hold the columns we don't want
+            A = np.empty(table.nrows, dtype=[(str(name), table.dtype[name]) 
+                                             for name in columns])
+            chunk_rows = table.nrowsinbuf
+            for start in xrange(0, table.nrows, chunk_rows):
+                stop = start + chunk_rows
+                block = table.read(start, stop)
+                for name in columns:
+                    A[name][start:stop] = block[name]
+
+        return self.__restore_dt(A, self.__dt_cols())
+
+    def __dt_cols(self):
+        """Returns a list of (column name, dtype) for the columns of the
+        np table that were stored as int64 but are really datetime64"""
+        hfile = self.__file
+        try:
+            dt_cols = hfile.get_node(hfile.root.np, 'dt_cols').read()
+        except tables.NoSuchNodeError:
+            return []
+        table_names = hfile.root.np.table.dtype.names
+        return [(table_names[col], dt_dtype) for col, dt_dtype in dt_cols]
+
+    def __restore_dt(self, A, dt_cols):
+        """Casts columns of A read from the np table back to np.datetime64
+        as necessary"""
+        if not dt_cols:
+            return A
+        A_names = A.dtype.names
+        view_dtype = A.dtype.descr
+        for name, dt_dtype in dt_cols:
+            if name in A_names:
+                idx = A_names.index(name)
+                view_dtype[idx] = (view_dtype[idx][0], dt_dtype)
+        return A.view(dtype=view_dtype)
+
+    def __stored_dtype(self):
+        """Returns the dtype of the table stored with the "columnar" or 
+        "matrix" storage method"""
+        if self.__in_memory is not None:
+            return self.__in_memory[1]
+        hfile = self.__file
+        names = hfile.get_node_attr('/upsg_inf', 'column_names')
+        dtypes = hfile.get_node_attr('/upsg_inf', 'column_dtypes')
+        return np.dtype([(str(name), np.dtype(col_dtype)) for 
+                         name, col_dtype in it.izip(names, dtypes)])
+
+    def __read_columnar(self, columns=None, start=None, stop=None):
+        """Reads rows start through stop of the given columns of a table
+        stored with the "columnar" storage method"""
         hfile = self.__file
+        dtype = self.__stored_dtype()
+        if columns is None:
+            columns = dtype.names
+        col_arrays = [hfile.get_node('/columns', 'c{}'.format(
+                          dtype.names.index(name))) for name in columns]
+        n_rows = len(col_arrays[0]) if col_arrays else 0
+        n_rows = len(xrange(*slice(start, stop).indices(n_rows)))
+        A = np.empty(n_rows, dtype=[(name, dtype[name]) for name in columns])
+        for name, col_array in it.izip(columns, col_arrays):
+            col = col_array.read(start, stop)
+            if dtype[name].kind == 'M':
+                # datetimes are stored as int64
+                col = col.view(dtype[name])
+            A[name] = col
+        return A
+
+    def __read_matrix(self, start=None, stop=None):
+        """Returns rows start through stop of the 2-dimensional array stored
+        with the "matrix" storage method"""
+        if self.__in_memory is not None:
+            # Readers get a view so they can't alter the writer's array
+            M = self.__in_memory[0][start:stop].view()
+            M.flags.writeable = False
+            return M
+        hfile = self.__file
+        M = hfile.root.matrix.matrix.read(start, stop)
+        matrix_dtype = np.dtype(hfile.get_node_attr('/matrix', 'dtype'))
+        if matrix_dtype.kind == 'M':
+            # datetimes are stored as int64
+            M = M.view(matrix_dtype)
+        return M
+
+    def __read_matrix_sa(self, columns=None, start=None, stop=None):
+        """Reads rows start through stop of the given columns of a table 
+        stored with the "matrix" storage method into a structured array"""
+        M = self.__read_matrix(start, stop)
+        dtype = self.__stored_dtype()
+        if columns is None:
+            columns = dtype.names
+        A = np.empty(M.shape[0], dtype=[(name, dtype[name]) for name in 
+                                         columns])
+        for name in columns:
+            A[name] = M[:, dtype.names.index(name)]
+        return A
+
+    def __iter_np(self, chunk_rows, columns=None):
+        """Returns a generator of structured arrays, each holding at most
+        chunk_rows rows of the table"""
+        if chunk_rows < 1:
+            raise UObjectException('chunk_rows must be positive')
+        storage_method = self.__storage_method()
+        if storage_method == 'view':
+            return self.__iter_view(chunk_rows, columns)
         if storage_method == 'np':
-            A = hfile.root.np.table.read()
+            if self.__in_memory is not None:
+                A = self.__read_np(columns)
+                return (A[start:start + chunk_rows] for start in 
+                        xrange(0, max(A.shape[0], 1), chunk_rows))
+            return self.__iter_np_table(chunk_rows, columns)
+        if storage_method == 'columnar':
+            n_rows = self.__file.root.columns.c0.nrows
+            return (self.__read_columnar(columns, start, start + chunk_rows) 
+                    for start in xrange(0, max(n_rows, 1), chunk_rows))
+        if storage_method == 'matrix':
+            n_rows = self.__read_matrix_n_rows()
+            return (self.__read_matrix_sa(columns, start, start + chunk_rows) 
+                    for start in xrange(0, max(n_rows, 1), chunk_rows))
+        if storage_method == 'sql':
+            sql_table_info = self.__sql_table()
+            return sql_iter_np(sql_table_info.table, sql_table_info.conn, 
+                               chunk_rows, columns, 
+                               self.__sql_partitioning())
+        raise UObjectException('Unsupported conversion')
+
+    def __read_matrix_n_rows(self):
+        if self.__in_memory is not None:
+            return self.__in_memory[0].shape[0]
+        return self.__file.root.matrix.matrix.shape[0]
+
+    def __iter_np_table(self, chunk_rows, columns):
+        table = self.__file.root.np.table
+        dt_cols = self.__dt_cols()
+        for start in xrange(0, max(table.nrows, 1), chunk_rows):
+            A = table.read(start, start + chunk_rows)
+            if columns is not None:
+                A = np_sa_select_cols(A, columns)
+            yield self.__restore_dt(A, dt_cols)
+
+    def __sql_table(self):
+        """Returns SQLTableInfo for a UObject with the "sql" storage method.
+        The connection is opened the first time and closed by cleanup"""
+        if self.__sql_table_info is not None:
+            return self.__sql_table_info
+        hfile = self.__file
+        sql_group = hfile.root.sql
+        db_url = hfile.get_node_attr(sql_group, 'db_url')
+        tbl_name = hfile.get_node_attr(sql_group, 'tbl_name')
+        conn_params = np_sa_to_dict(hfile.root.sql.conn_params.read())
+        conn = self.__get_conn(None, db_url, conn_params)
+        tbl = reflect_table(conn, db_url, tbl_name)
+        self.__sql_table_info = SQLTableInfo(tbl, conn, db_url, conn_params)
+        return self.__sql_table_info
+
+    def __upload(self, db_url, conn_params):
+        """Uploads the table to a new sql table, unless a table with the 
+        same contents has already been uploaded to the database, and 
+        returns SQLTableInfo for the table"""
+        conn = self.__get_conn(None, db_url, conn_params)
+        fingerprint = self.fingerprint()
+        tbl_name = find_upload(conn, db_url, fingerprint)
+        if tbl_name is not None:
+            tbl = reflect_table(conn, db_url, tbl_name)
+        else:
+            tbl_name = self.__get_new_table_name()
+            tbl = np_to_sql(self.__read_np(), tbl_name, conn)
+            register_upload(conn, db_url, fingerprint, tbl_name, 
+                            conn_params)
+        return SQLTableInfo(tbl, conn, db_url, conn_params)
+
+    def __sql_partitioning(self):
+        """Returns the SQLPartitioning with which a UObject with the "sql"
+        storage method is read, or None if it's read over one connection"""
+        attrs = self.__file.root.sql._v_attrs
+        if 'partition_col' not in attrs:
+            return None
+        return SQLPartitioning(str(attrs.partition_col), 
+                               int(attrs.n_partitions),
+                               str(attrs.partition_method), 
+                               int(attrs.n_workers))
+
+    def __get_view(self):
+        """Returns ViewInfo for a UObject with the "view" storage method"""
+        if self.__view is not None:
+            return self.__view
+        hfile = self.__file
+        view_group = hfile.root.view
+        parent_file = hfile.get_node_attr(view_group, 'parent_file')
+        if not os.path.exists(parent_file) and self.__file_name is not None:
+            # The directory holding both files may have been moved
+            moved_file = os.path.join(
+                os.path.dirname(os.path.abspath(self.__file_name)),
+                os.path.basename(parent_file))
+            if os.path.exists(moved_file):
+                parent_file = moved_file
+        parent = UObject(UObjectPhase.Read, file_name=parent_file)
+        parent_columns = [str(col) for col in 
+                          hfile.get_node_attr(view_group, 'parent_columns')]
+        columns = [str(col) for col in 
+                   hfile.get_node_attr(view_group, 'column_names')]
+        if 'rows' in view_group:
+            rows = view_group.rows.read()
+        else:
+            rows = None
+        parent.__add_dependent()
+        self.__view = ViewInfo(parent, parent_columns, columns, rows)
+        return self.__view
+
+    def __view_parent_columns(self, columns=None):
+        """Returns the columns of the view's parent that correspond to 
+        the given columns of the view"""
+        view = self.__get_view()
+        if columns is None:
+            return view.parent_columns
+        correspondence = dict(it.izip(view.columns, view.parent_columns))
+        try:
+            return [correspondence[col] for col in columns]
+        except KeyError as e:
+            raise UObjectException('No column named {}'.format(e.args[0]))
+
+    def __read_view(self, columns=None):
+        """Reads the given columns of a UObject with the "view" storage
+        method from its parent"""
+        view = self.__get_view()
+        parent_columns = self.__view_parent_columns(columns)
+        A = view.parent.__read_np(parent_columns)
+        if view.rows is not None:
+            A = A[view.rows]
+        return np_sa_rename_cols(
+            A, 
+            view.columns if columns is None else columns)
+
+    def __iter_view(self, chunk_rows, columns=None):
+        view = self.__get_view()
+        parent_columns = self.__view_parent_columns(columns)
+        names = view.columns if columns is None else list(columns)
+        rows = view.rows
+        if rows is None:
+            return (np_sa_rename_cols(A, names) for A in 
+                    view.parent.__iter_np(chunk_rows, parent_columns))
+        if np.all(rows[1:] >= rows[:-1]):
+            # The view's rows come in the parent's order, so we can pick 
+            # them out of the parent one chunk at a time
+            return self.__iter_view_sorted_rows(
+                view.parent.__iter_np(chunk_rows, parent_columns),
+                rows,
+                names)
+        A = self.__read_view(columns)
+        return (A[start:start + chunk_rows] for start in 
+                xrange(0, max(A.shape[0], 1), chunk_rows))
+
+    def __iter_view_sorted_rows(self, parent_chunks, rows, names):
+        offset = 0
+        yielded = False
+        for A in parent_chunks:
+            stop = offset + A.shape[0]
+            lo, hi = np.searchsorted(rows, (offset, stop))
+            if lo < hi:
+                yielded = True
+                yield np_sa_rename_cols(A[rows[lo:hi] - offset], names)
+            offset = stop
+        if not yielded:
+            yield np_sa_rename_cols(A[:0], names)
 
-            # cast back to np.datetime64 as necessary
-            try:
-                dt_cols = hfile.get_node(hfile.root.np, 'dt_cols').read()
-                view_dtype = A.dtype.descr
-                for col, dt_dtype in dt_cols:
-                    view_dtype[col] = (view_dtype[col][0], dt_dtype)
-                A = A.view(dtype=view_dtype)
-            except tables.NoSuchNodeError:
-                pass
+    def __convert_to(self, target_format, conn=None, db_url=None,
+                     conn_params={}, tbl_name=None, columns=None):
+        # TODO write this nicer than if statements
+        storage_method = self.__storage_method()
+        hfile = self.__file
+        if storage_method in ('np', 'columnar', 'matrix', 'view'):
+            if target_format == 'sql' and tbl_name is None:
+                return self.__upload(db_url, conn_params)
+            A = self.__read_np(columns)
 
             if target_format == 'np':
                 return A
@@ -236,17 +965,11 @@ class UObject(object):
                     conn_params)
             raise UObjectException('Unsupported conversion')
         if storage_method == 'sql':
-            sql_group = hfile.root.sql
-            db_url = hfile.get_node_attr(sql_group, 'db_url')
-            tbl_name = hfile.get_node_attr(sql_group, 'tbl_name')
-            conn_params = np_sa_to_dict(hfile.root.sql.conn_params.read())
-            conn = self.__get_conn(None, db_url, conn_params)
-            md = sqlalchemy.MetaData()
-            md.reflect(conn)
-            tbl = md.tables[tbl_name]
+            sql_table_info = self.__sql_table()
             if target_format == 'sql':
-                return SQLTableInfo(tbl, conn, db_url, conn_params)
-            result = sql_to_np(tbl, conn)
+                return sql_table_info
+            result = sql_to_np(sql_table_info.table, sql_table_info.conn, 
+                               columns, self.__sql_partitioning())
             if target_format == 'np':
                 return result
             if target_format == 'dict':
@@ -260,6 +983,236 @@ class UObject(object):
             raise UObjectException('Unsupported conversion')
         raise UObjectException('Unsupported internal format')
 
+    @hdf5_locked
+    def get_storage_method(self):
+        """Returns how the table that this UObject represents is stored: 
+        'np', 'columnar', 'matrix', 'view', 'sql' or 'external'.
+
+        Stages can use this to do their work where the data is, for 
+        example, by selecting rows from a table stored in sql with 
+        from_sql_select. The UObject must be in its read phase. Calling this
+        method does not count as invoking one of the "to\_" methods.
+
+        Returns
+        -------
+        str
+
+        """
+        if self.__phase != UObjectPhase.Read:
+            raise UObjectException('UObject is not in the read phase')
+        return self.__storage_method()
+
+    @hdf5_locked
+    def get_column_names(self):
+        """Returns the names of the columns of the table that this UObject
+        represents without reading the table itself.
+
+        The UObject must be in its read phase. Calling this method does not
+        count as invoking one of the "to\_" methods.
+
+        Returns
+        -------
+        list of str
+            Column names in table order
+        
+        """
+        if self.__phase != UObjectPhase.Read:
+            raise UObjectException('UObject is not in the read phase')
+        storage_method = self.__storage_method()
+        if storage_method == 'np':
+            if self.__in_memory is not None:
+                return list(self.__in_memory.dtype.names)
+            return list(self.__file.root.np.table.dtype.names)
+        if storage_method in ('columnar', 'matrix'):
+            return list(self.__stored_dtype().names)
+        if storage_method == 'view':
+            return list(self.__get_view().columns)
+        if storage_method == 'sql':
+            return [str(col.name) for col in self.__sql_table().table.columns]
+        raise UObjectException('Unsupported conversion')
+
+    @hdf5_locked
+    def fingerprint(self):
+        """Returns a digest of the contents of the table that this UObject
+        represents. 
+        
+        UObjects representing tables with the same column names, types and
+        values have the same fingerprint. UObjects stored in sql are 
+        fingerprinted by their database and table name rather than by 
+        their contents, and external files by their file name.
+
+        The UObject must be in its read phase. Calling this method does not
+        count as invoking one of the "to\_" methods.
+
+        Returns
+        -------
+        str
+            A hexadecimal SHA-1 digest
+
+        """
+        if self.__phase != UObjectPhase.Read:
+            raise UObjectException('UObject is not in the read phase')
+        if self.__fingerprint is None:
+            digest = hashlib.sha1()
+            storage_method = self.__storage_method()
+            if storage_method == 'sql':
+                sql_group = self.__file.root.sql
+                digest.update('sql')
+                digest.update(self.__file.get_node_attr(sql_group, 'db_url'))
+                digest.update(self.__file.get_node_attr(sql_group, 
+                                                        'tbl_name'))
+            elif storage_method == 'external':
+                digest.update('external')
+                digest.update(self.__convert_to('external'))
+            else:
+                dtype = None
+                for chunk in self.__iter_np(DEFAULT_CHUNK_ROWS):
+                    if dtype is None:
+                        dtype = chunk.dtype
+                        digest.update(str(dtype.descr))
+                    digest.update(np.ascontiguousarray(chunk).data)
+            self.__fingerprint = digest.hexdigest()
+        return self.__fingerprint
+
+    @hdf5_locked
+    def stats(self, compute=True):
+        """Returns statistics about the table that this UObject represents
+        without reading the table itself.
+
+        Statistics are computed when a table is written with from_np, 
+        from_np_chunks, from_csv or from_matrix and are stored in the 
+        .upsg file. Views that include all of their parent's rows take their
+        statistics from the parent.
+
+        The UObject must be in its read phase. Calling this method does not
+        count as invoking one of the "to\_" methods.
+
+        Parameters
+        ----------
+        compute : bool
+            A table that has only been held in memory has no stored 
+            statistics, so they are computed from the table when they are
+            first asked for, which takes about as long as hashing every 
+            column. If False, they are not computed, and None is returned
+            unless they already have been.
+
+        Returns
+        -------
+        TableStats or None
+            The statistics, or None if they are not available for this 
+            UObject (for example, if it is stored in sql)
+
+        """
+        if self.__phase != UObjectPhase.Read:
+            raise UObjectException('UObject is not in the read phase')
+        if self.__stats is None:
+            if self.__storage_method() == 'view':
+                self.__stats = self.__view_stats(compute)
+            elif self.__in_memory is not None:
+                if compute:
+                    self.__compute_stats(self.__in_memory, 
+                                         self.__in_memory_method)
+            else:
+                self.__stats = self.__read_stats()
+        return self.__stats
+
+    def __view_stats(self, compute=True):
+        """Derives TableStats for a view from the stats of its parent, or
+        returns None if that's not possible without reading the table"""
+        view = self.__get_view()
+        parent_stats = view.parent.stats(compute)
+        if parent_stats is None or view.rows is not None:
+            return None
+        columns = OrderedDict(
+            (name, parent_stats.columns[parent_col]) for parent_col, name in 
+            it.izip(view.parent_columns, view.columns))
+        return TableStats(parent_stats.rows,
+                          sum(cs.nbytes for cs in columns.itervalues()),
+                          columns)
+
+    def __compute_stats(self, data, method='np'):
+        """Computes TableStats for data, which is either a structured array
+        (if method is 'np') or a tuple of a matrix and a dtype (if method is
+        'matrix')"""
+        if self.__stats is not None:
+            return self.__stats
+        if method == 'matrix':
+            M, dtype = data
+            acc = self.__StatsAccumulator(dtype)
+            acc.update_cols(self.__matrix_cols(M, dtype))
+        else:
+            acc = self.__StatsAccumulator(data.dtype)
+            acc.update(data)
+        self.__stats = acc.get_stats()
+        return self.__stats
+
+    def __matrix_cols(self, M, dtype):
+        """Returns the columns of the 2-dimensional array M cast to the 
+        types in dtype"""
+        return [M[:, i] if M.dtype == dtype[i] else M[:, i].astype(dtype[i])
+                for i in xrange(len(dtype))]
+
+    def __write_stats(self, hfile, stats):
+        """Stores TableStats as attributes of /upsg_inf"""
+        names = stats.columns.keys()
+        col_stats = stats.columns.values()
+        set_attr = lambda attr, val: hfile.set_node_attr(
+            '/upsg_inf', 
+            attr, 
+            val)
+        set_attr('stats_rows', stats.rows)
+        set_attr('stats_columns', np.array(names, dtype=str))
+        for attr in ('nulls', 'distinct', 'nbytes'):
+            set_attr('stats_{}'.format(attr), np.array(
+                [getattr(cs, attr) for cs in col_stats], dtype=np.int64))
+        ranged = [(name, cs) for name, cs in it.izip(names, col_stats) if 
+                  cs.min is not None]
+        if not ranged:
+            return
+        # datetimes are stored as int64
+        range_dtype = np.dtype([
+            (name, np.int64 if cs.min.dtype.kind == 'M' else cs.min.dtype) 
+            for name, cs in ranged])
+        for attr in ('min', 'max'):
+            set_attr('stats_{}'.format(attr), np.array(
+                [tuple(getattr(cs, attr).astype(range_dtype[name]) for 
+                       name, cs in ranged)],
+                dtype=range_dtype))
+        set_attr('stats_range_dtypes', np.array(
+            [cs.min.dtype.str for name, cs in ranged]))
+
+    def __read_stats(self):
+        """Reads TableStats written by __write_stats, or returns None if 
+        there aren't any"""
+        attrs = self.__file.root.upsg_inf._v_attrs
+        if 'stats_rows' not in attrs:
+            return None
+        names = [str(name) for name in attrs.stats_columns]
+        mins = {}
+        maxes = {}
+        if 'stats_min' in attrs:
+            for name, range_dtype in it.izip(attrs.stats_min.dtype.names,
+                                             attrs.stats_range_dtypes):
+                range_dtype = np.dtype(range_dtype)
+                mins[name] = attrs.stats_min[name].view(range_dtype)[0]
+                maxes[name] = attrs.stats_max[name].view(range_dtype)[0]
+        columns = OrderedDict(
+            (name, ColumnStats(
+                int(nulls), 
+                mins.get(name), 
+                maxes.get(name), 
+                int(distinct), 
+                int(nbytes))) for 
+            name, nulls, distinct, nbytes in it.izip(
+                names, 
+                attrs.stats_nulls, 
+                attrs.stats_distinct, 
+                attrs.stats_nbytes))
+        return TableStats(int(attrs.stats_rows), 
+                          sum(cs.nbytes for cs in columns.itervalues()), 
+                          columns)
+
+    @hdf5_locked
     def __to(self, converter):
         """Does generic book-keeping when a "to_" function is invoked.
 
@@ -285,9 +1238,17 @@ class UObject(object):
         self.__finalized = True
         return to_return
 
-    def to_np(self):
+    def to_np(self, columns=None):
         """Makes the universal object available in a numpy array.
 
+        Parameters
+        ----------
+        columns : list of str or None
+            If provided, only the given columns will be read, and they will
+            appear in the given order. If the UObject is stored in sql, only
+            the given columns will be selected from the database. If None,
+            all columns will be read.
+
         Returns
         -------
         numpy.ndarray
@@ -295,11 +1256,77 @@ class UObject(object):
 
         """
 
-        return self.__to(lambda: self.__convert_to('np'))
+        return self.__to(lambda: self.__convert_to('np', columns=columns))
+
+    def to_matrix(self):
+        """Makes the universal object available as a single-type numpy 
+        array.
+
+        The result is the same as calling utils.np_sa_to_nd on the result of 
+        to_np. If the UObject was written with from_matrix, however, the 
+        stored matrix is returned without ever building a structured array.
+
+        Returns
+        -------
+        tuple (nd, dtype)
+            where nd is a 0, 1 or 2-dimensional numpy.ndarray and dtype is
+            the numpy.dtype of the structured array that to_np would return.
+
+        """
+        def converter():
+            if self.__storage_method() == 'matrix':
+                dtype = self.__stored_dtype()
+                return (np_nd_recast(self.__read_matrix(), dtype), dtype)
+            return np_sa_to_nd(self.__convert_to('np'))
+        return self.__to(converter)
 
-    def to_dataframe(self):
+    def iter_np(self, chunk_rows=DEFAULT_CHUNK_ROWS, columns=None):
+        """Makes the universal object available as a sequence of numpy 
+        arrays, each holding a contiguous block of rows.
+
+        Only one block needs to be held in memory at a time, so this is the
+        method to use for tables that may not fit in memory.
+
+        Parameters
+        ----------
+        chunk_rows : int
+            The maximum number of rows in each block
+        columns : list of str or None
+            If provided, only the given columns will be read. See to_np.
+
+        Returns
+        -------
+        iterator of numpy.ndarray
+            Structured arrays which, concatenated, hold the same table that 
+            to_np would return. At least one (possibly empty) array is 
+            always produced.
+
+        """
+        return self.__to(lambda: self.__locked_iter(
+            self.__iter_np(chunk_rows, columns)))
+
+    def __locked_iter(self, chunks):
+        """Yields the arrays of chunks, holding HDF5_LOCK while each one is
+        read"""
+        while True:
+            with HDF5_LOCK:
+                try:
+                    A = next(chunks)
+                except StopIteration:
+                    return
+            yield A
+
+    def to_dataframe(self, columns=None):
+        """Makes the universal object available in a pandas DataFrame.
+
+        Parameters
+        ----------
+        columns : list of str or None
+            If provided, only the given columns will be read. See to_np.
+
+        """
         from pandas import DataFrame
-        return DataFrame(self.to_np())
+        return DataFrame(self.to_np(columns))
 
     def to_csv(self, file_name, **kwargs):
         """Makes the universal object available in a csv.
@@ -322,14 +1349,18 @@ class UObject(object):
         """
         if not kwargs:
             kwargs = {'delimiter': ',', 'fmt':'%s'}
+        kwargs.pop('header', None)
 
         def converter():
-            table = self.__convert_to('np')
-            header = ",".join(map(
-                lambda field_name: '"{}"'.format(field_name),
-                table.dtype.names))
-            kwargs['header'] = header
-            np.savetxt(file_name, table, **kwargs)
+            with open(file_name, 'w') as fout:
+                for i, chunk in enumerate(self.__iter_np(DEFAULT_CHUNK_ROWS)):
+                    if i == 0:
+                        header = ",".join(map(
+                            lambda field_name: '"{}"'.format(field_name),
+                            chunk.dtype.names))
+                        np.savetxt(fout, chunk, header=header, **kwargs)
+                    else:
+                        np.savetxt(fout, chunk, **kwargs)
             return file_name
 
         return self.__to(converter)
@@ -344,7 +1375,12 @@ class UObject(object):
         conn_params: dict of str : ?
             Parameters to pass to the DBAPI 2 connect() method
         tbl_name: str or None
-            Name for created table. If None, a random name is chosen
+            Name for created table. If None, a random name is chosen, and 
+            if a UObject with the same fingerprint has already been 
+            uploaded to the database, its table is returned rather than 
+            uploading the contents again. Such tables are dropped by the
+            cleanup.py utility. Since they are shared, they must not be
+            modified.
 
         Returns
         -------
@@ -387,7 +1423,8 @@ class UObject(object):
         
         return self.__to(lambda: self.__convert_to('external'))
 
-    def __from(self, converter):
+    @hdf5_locked
+    def __from(self, converter, in_memory=None, in_memory_method='np'):
         """Does generic book-keeping when a "from_function is invoked.
 
         Every public-facing "from_" function should invoke this function.
@@ -398,6 +1435,16 @@ class UObject(object):
             A function that updates the passed file as specified
             by the from_ function. It should return the storage method
             being used
+        in_memory: numpy.ndarray or None
+            If provided, a structured array holding the same table that
+            converter would write. The UObject will keep a reference to
+            the array and defer running converter until the hdf5
+            representation is actually required.
+        in_memory_method: str
+            The storage method that in_memory represents. If 'np', 
+            in_memory is a structured array. If 'matrix', in_memory is a 
+            tuple of a 2-dimensional array and the dtype of its columns. If
+            'view', in_memory is a ViewInfo.
 
         """
 
@@ -406,85 +1453,512 @@ class UObject(object):
         if self.__finalized:
             raise UObjectException('UObject is already finalized')
 
-        storage_method = converter(self.__file)
+        if self.__file_name is not None:
+            # We were asked to be backed by a file, so don't hold onto memory
+            in_memory = None
+        self.__pending = converter
+        self.__in_memory = in_memory
+        self.__in_memory_method = in_memory_method
+        if in_memory is None:
+            self.__write_pending()
+        # The pipeline is responsible for syncing the persistent_file
+        #self.__file.close()
+        self.__finalized = True
+
+    def __write_pending(self):
+        """Applies a converter deferred by __from to the hdf5 file"""
+        converter = self.__pending
+        if converter is None:
+            return
+        self.__pending = None
+        self.__apply_converter(converter, self.__file)
+
+    def __apply_converter(self, converter, hfile):
+        storage_method = converter(hfile)
 
-        self.__file.set_node_attr(
+        hfile.set_node_attr(
             '/upsg_inf',
             'storage_method',
             storage_method)
-        self.__file.flush()
-        # The pipeline is responsible for syncing the persistent_file
-        #self.__file.close()
-        self.__finalized = True
+        hfile.flush()
 
-    def from_csv(self, filename, **kwargs):
+    def from_csv(self, filename, parse_dates=False, 
+                 chunk_rows=DEFAULT_CHUNK_ROWS, **kwargs):
         """Writes the contents of a CSV to the UOBject and prepares the .upsg
         file.
 
+        Unless kwargs other than delimiter are given, the csv is streamed 
+        into the .upsg file chunk_rows rows at a time, so it never has to be 
+        held in memory all at once. Column types are inferred from the 
+        first rows of the csv (see upsg.utils.csv_sample_dtype) and are the 
+        same as the ones numpy.genfromtxt would infer with dtype=None. If a 
+        later row doesn't fit the inferred types, the types are widened and
+        the csv is read again.
+
         Parameters
         ----------
         filename: str
             The name of the csv file.
+        parse_dates: bool
+            If True, columns holding ISO 8601 dates or datetimes are given
+            a datetime64 type rather than a string type.
+        chunk_rows: int
+            The number of rows to parse at a time
         kwargs: 
             keyword arguments to pass to numpy.genfromtxt
             (http://docs.scipy.org/doc/numpy/reference/generated/numpy.genfromtxt.html)
             If no kwargs are provided, we use: dtype=None, delimiter=',', 
-            names=True.
+            names=True. If kwargs other than those are provided, the csv
+            is read with numpy.genfromtxt and parse_dates is ignored.
 
         """
-        if not kwargs:
-            kwargs = {'dtype': None, 'delimiter': ',', 'names': True}
+        use_genfromtxt = (
+            any(key not in ('dtype', 'delimiter', 'names') for key in kwargs) 
+            or kwargs.get('dtype') is not None 
+            or kwargs.get('names', True) is not True)
+        if use_genfromtxt:
+            data = np.atleast_1d(np.genfromtxt(filename, **kwargs))
+
+            def converter(hfile):
+                self.__create_np_table(hfile, data)
+                self.__write_stats(hfile, self.__compute_stats(data))
+                return 'np'
+
+            self.__from(converter, data)
+            return
+
+        delimiter = kwargs.get('delimiter', ',')
+        dtype = csv_sample_dtype(filename, delimiter, 
+                                 parse_dates=parse_dates)
+        while True:
+            try:
+                self.from_np_chunks(csv_iter_np(filename, dtype, chunk_rows,
+                                                delimiter, parse_dates))
+                return
+            except CSVSchemaError as e:
+                # Start again with wider types
+                dtype = e.dtype
+                if '/np' in self.__file:
+                    self.__file.remove_node('/np', recursive=True)
+
+    def from_np(self, A, storage_method='np'):
+        """Writes the contents of a numpy array to a UObject and prepares the
+        .upsg file.
+
+        Parameters
+        ----------
+        A: numpy.array
+        storage_method: {'np', 'columnar'}
+            How the table will be stored in the .upsg file. 'np' stores a 
+            table of rows. 'columnar' stores each column as a separate 
+            compressed array, which makes it cheap to read a few columns at a
+            time.
+
+        """
+
+        self.__check_np_storage_method(storage_method)
+        if is_sa(A):
+            in_memory = A
+        else:
+            in_memory = np_nd_to_sa(A)
 
         def converter(hfile):
-            data = np.genfromtxt(filename, **kwargs)
+            if storage_method == 'columnar':
+                self.__create_columns(hfile, in_memory)
+            else:
+                self.__create_np_table(hfile, in_memory)
+            self.__write_stats(hfile, self.__compute_stats(in_memory))
+            return storage_method
 
-            np_group = hfile.create_group('/', 'np')
-            hfile.create_table(np_group, 'table', obj=data)
-            return 'np'
+        self.__from(converter, in_memory)
 
-        self.__from(converter)
+    def from_np_chunks(self, chunks, storage_method='np'):
+        """Writes a table given as a sequence of numpy arrays to a UObject 
+        and prepares the .upsg file.
 
-    def from_np(self, A):
-        """Writes the contents of a numpy array to a UObject and prepares the
-        .upsg file.
+        If the UObject is backed by a file (see the file_name parameter of
+        UObject), chunks are written to the file as they are produced, so 
+        only one chunk needs to be held in memory at a time. Otherwise, the
+        chunks are concatenated and written as by from_np, so the table can
+        be handed to the next stage without going through hdf5.
 
         Parameters
         ----------
-        A: numpy.array
+        chunks: iterable of numpy.array
+            Blocks of rows which, concatenated, make up the table. Every 
+            chunk must have the same dtype.
+        storage_method: {'np', 'columnar'}
+            How the table will be stored in the .upsg file. See from_np
 
         """
+        self.__check_np_storage_method(storage_method)
+        chunks = iter(chunks)
+        try:
+            first = next(chunks)
+        except StopIteration:
+            raise UObjectException('No chunks provided')
+        try:
+            second = next(chunks)
+        except StopIteration:
+            # The whole table fits in one chunk, so we might as well keep it 
+            # in memory
+            self.from_np(first, storage_method)
+            return
+
+        def to_sa(A):
+            return A if is_sa(A) else np_nd_to_sa(A)
+
+        if self.__file_name is None:
+            # An in-memory hdf5 file would hold the whole table anyway, and
+            # it would have to be copied to be read
+            self.from_np(np.concatenate(
+                [to_sa(A) for A in it.chain((first, second), chunks)]),
+                storage_method)
+            return
 
         def converter(hfile):
-            if is_sa(A):
-                to_write = A
+            first_sa = to_sa(first)
+            acc = self.__StatsAccumulator(first_sa.dtype)
+            acc.update(first_sa)
+            if storage_method == 'columnar':
+                col_arrays = self.__create_columns(hfile, first_sa)
+                append = lambda A: self.__append_columns(col_arrays, A)
             else:
-                to_write = np_nd_to_sa(A)
-            np_group = hfile.create_group('/', 'np')
-
-            # case datetime64 columns to int64 and note it in metadata
-            to_write_dtype = to_write.dtype
-            dt_cols = [(i, col_dtype[1]) for i, col_dtype in 
-                       enumerate(to_write_dtype.descr)
-                       if 'M8' in col_dtype[1]]
-            if dt_cols:
-                view_dtype = [(name, '<i8') if 'M8' in fmt else (name, fmt) 
-                              for name, fmt in to_write_dtype.descr]
-                to_write = to_write.view(dtype=view_dtype)
-                dt_cols_sa = np.array(
-                        dt_cols, 
-                        dtype=[('col_num', int), ('dtype', '|S7')])
-                hfile.create_table(np_group, 'dt_cols', dt_cols_sa)
-
-            hfile.create_table(np_group, 'table', obj=to_write)
-            return 'np'
+                table = self.__create_np_table(hfile, first_sa)
+                append = lambda A: table.append(self.__np_storage_view(A))
+            for chunk in it.chain((second,), chunks):
+                chunk = to_sa(chunk)
+                append(chunk)
+                acc.update(chunk)
+            self.__stats = acc.get_stats()
+            self.__write_stats(hfile, self.__stats)
+            return storage_method
 
         self.__from(converter)
 
+    def from_matrix(self, M, dtype=None):
+        """Writes the contents of a single-type numpy array to a UObject 
+        and prepares the .upsg file.
+
+        Unlike from_np, the array is stored as a 2-dimensional matrix, so a 
+        subsequent to_matrix does not have to convert it to and from a 
+        structured array.
+
+        Parameters
+        ----------
+        M: numpy.ndarray
+            A 0, 1, or 2-dimensional array. 0 and 1-dimensional arrays are 
+            treated as a single column.
+        dtype: numpy.dtype or None
+            The dtype of the table that M represents, as in 
+            utils.np_nd_to_sa. Provides the column names and the type that 
+            each column will have when read with to_np. If None, every column
+            will have M's type.
+
+        """
+        if M.ndim not in (0, 1, 2):
+            raise UObjectException('from_matrix only takes 0, 1 or '
+                                   '2-dimensional arrays')
+        if M.ndim <= 1:
+            M = M.reshape(M.size, 1)
+        if dtype is None:
+            dtype = np.dtype({'names': map('f{}'.format, xrange(M.shape[1])),
+                              'formats': [M.dtype] * M.shape[1]})
+        elif len(dtype) != M.shape[1]:
+            raise UObjectException('dtype does not match the number of '
+                                   'columns in M')
+
+        def converter(hfile):
+            matrix_group = hfile.create_group('/', 'matrix')
+            self.__set_column_attrs(hfile, dtype)
+            hfile.set_node_attr(matrix_group, 'dtype', M.dtype.str)
+            to_write = M
+            if M.dtype.kind == 'M':
+                to_write = M.view('<i8')
+            matrix = hfile.create_earray(
+                matrix_group, 
+                'matrix', 
+                atom=tables.Atom.from_dtype(to_write.dtype),
+                shape=(0, M.shape[1]),
+                filters=self.__compression.get_filters(),
+                chunkshape=self.__compression.get_chunkshape(M.shape[1:]),
+                expectedrows=max(M.shape[0], 1))
+            matrix.append(to_write)
+            self.__write_stats(hfile, self.__compute_stats((M, dtype), 
+                                                           'matrix'))
+            return 'matrix'
+
+        self.__from(converter, (M, dtype), 'matrix')
+
+    def __check_np_storage_method(self, storage_method):
+        if storage_method not in ('np', 'columnar'):
+            raise UObjectException('Unsupported storage method {}'.format(
+                storage_method))
+
+    def __np_storage_view(self, A):
+        """Returns a view of the structured array A in which datetime64 
+        columns are cast to int64, which is how they are stored in hdf5"""
+        descr = A.dtype.descr
+        if not any('M8' in fmt for name, fmt in descr):
+            return A
+        return A.view(dtype=[(name, '<i8') if 'M8' in fmt else (name, fmt) 
+                             for name, fmt in descr])
+
+    def __create_np_table(self, hfile, A):
+        """Creates the np group in hfile and writes the structured array A
+        to its table. Returns the created tables.Table"""
+        np_group = hfile.create_group('/', 'np')
+
+        # case datetime64 columns to int64 and note it in metadata
+        dt_cols = [(i, col_dtype[1]) for i, col_dtype in 
+                   enumerate(A.dtype.descr)
+                   if 'M8' in col_dtype[1]]
+        if dt_cols:
+            dt_cols_sa = np.array(
+                    dt_cols, 
+                    dtype=[('col_num', int), ('dtype', '|S7')])
+            self.__create_table(hfile, np_group, 'dt_cols', dt_cols_sa)
+
+        return self.__create_table(hfile, np_group, 'table', 
+                                   self.__np_storage_view(A))
+
+    def __create_table(self, hfile, where, name, A):
+        """Creates a table holding the structured array A, compressed 
+        according to this UObject's CompressionPolicy"""
+        return hfile.create_table(
+            where, 
+            name, 
+            obj=A,
+            filters=self.__compression.get_filters(),
+            chunkshape=self.__compression.get_chunkshape(),
+            expectedrows=max(A.shape[0], 1))
+
+    def __create_columns(self, hfile, A):
+        """Creates the columns group in hfile and writes each column of
+        the structured array A to its own array. Returns the list of created
+        tables.EArrays"""
+        col_group = hfile.create_group('/', 'columns')
+        names = A.dtype.names
+        self.__set_column_attrs(hfile, A.dtype)
+        col_arrays = []
+        for i, name in enumerate(names):
+            col_dtype = A.dtype[name]
+            if col_dtype.kind == 'M':
+                col_dtype = np.dtype('<i8')
+            col_arrays.append(hfile.create_earray(
+                col_group, 
+                'c{}'.format(i),
+                atom=tables.Atom.from_dtype(col_dtype),
+                shape=(0,),
+                filters=self.__compression.get_filters(),
+                chunkshape=self.__compression.get_chunkshape(),
+                expectedrows=max(A.shape[0], 1)))
+        self.__append_columns(col_arrays, A)
+        return col_arrays
+
+    def __set_column_attrs(self, hfile, dtype):
+        """Notes the names and types of the columns of the table in the 
+        /upsg_inf group"""
+        names = dtype.names
+        hfile.set_node_attr('/upsg_inf', 'column_names', np.array(names))
+        hfile.set_node_attr(
+            '/upsg_inf', 
+            'column_dtypes', 
+            np.array([dtype[name].str for name in names]))
+
+    def __append_columns(self, col_arrays, A):
+        for col_array, name in it.izip(col_arrays, A.dtype.names):
+            col = A[name]
+            if col.dtype.kind == 'M':
+                col = col.view('<i8')
+            col_array.append(col)
+
+    @hdf5_locked
+    def from_view(self, parent, columns=None, rename=None, rows=None):
+        """Makes the universal object a view of the table represented by 
+        another UObject without copying the table.
+
+        The view records which of the parent's columns and rows it includes 
+        and what its columns are called. The parent's data is only read 
+        when the view is read, and a view of a view refers directly to the
+        underlying table. If the view is written to a .upsg file while the 
+        parent is backed by a .upsg file on the local disk, only a reference
+        to the parent's file is written. Otherwise, the view is resolved and
+        written with the "np" storage method. 
+
+        If the parent is stored in sql and all of its rows are included, the
+        view is instead created in the database, as by from_sql_select. If 
+        only some rows are included, they are picked out of the table as 
+        to_np would return it.
+
+        The parent is not cleaned up until all of its views have been.
+
+        Parameters
+        ----------
+        parent : UObject
+            A UObject in its read phase. Calling this method does not count
+            as invoking one of the parent's "to\_" methods.
+        columns : list of str or None
+            The columns of parent to include, in the order that they will
+            appear in the view. If None, all columns are included.
+        rename : list of str or None
+            The names that the included columns will have in the view, in 
+            the same order as columns. If None, the names are unchanged.
+        rows : numpy.ndarray or None
+            Either the indices of the rows of parent to include or a boolean
+            mask with an entry for each row of parent. If None, all rows are
+            included.
+
+        """
+        if parent.get_phase() != UObjectPhase.Read:
+            raise UObjectException('Parent UObject is not in the read phase')
+        parent_names = parent.get_column_names()
+        if columns is None:
+            columns = parent_names
+        columns = [str(col) for col in columns]
+        missing = [col for col in columns if col not in parent_names]
+        if missing:
+            raise UObjectException('Parent has no columns named {}'.format(
+                missing))
+        if rename is None:
+            names = columns
+        else:
+            names = [str(name) for name in rename]
+            if len(names) != len(columns):
+                raise UObjectException(
+                    'Expected {} column names but got {}'.format(
+                        len(columns), 
+                        len(names)))
+        if rows is not None:
+            rows = np.asarray(rows)
+            if rows.ndim != 1:
+                raise UObjectException('rows must be 1-dimensional')
+            if rows.dtype == np.bool_:
+                rows = np.flatnonzero(rows)
+            rows = rows.astype(np.int64)
+
+        if parent.__storage_method() == 'view':
+            parent_view = parent.__get_view()
+            columns = parent.__view_parent_columns(columns)
+            if parent_view.rows is not None:
+                if rows is None:
+                    rows = parent_view.rows
+                else:
+                    rows = parent_view.rows[rows]
+            parent = parent_view.parent
+
+        if rows is None and parent.__storage_method() == 'sql':
+            self.from_sql_select(parent, columns, names)
+            return
+
+        parent.__add_dependent()
+        self.__view = ViewInfo(parent, columns, names, rows)
+
+        def converter(hfile):
+            if parent.__file_name is None:
+                # There's no file for the view to refer to
+                A = self.__read_view()
+                self.__create_np_table(hfile, A)
+                self.__write_stats(hfile, self.__compute_stats(A))
+                return 'np'
+            view_group = hfile.create_group('/', 'view')
+            parent_file = os.path.abspath(parent.__file_name)
+            hfile.set_node_attr(view_group, 'parent_file', parent_file)
+            # so cleanup.py doesn't remove the parent before the view
+            register_reference(parent_file)
+            hfile.set_node_attr(view_group, 'parent_columns', 
+                                np.array(columns, dtype=str))
+            hfile.set_node_attr(view_group, 'column_names', 
+                                np.array(names, dtype=str))
+            if rows is not None:
+                hfile.create_earray(
+                    view_group, 
+                    'rows', 
+                    obj=rows,
+                    filters=self.__compression.get_filters())
+            return 'view'
+
+        self.__from(converter, self.__view, 'view')
+
+    @hdf5_locked
+    def from_sql_select(self, parent, columns=None, rename=None, where=None,
+                        order_by=None, limit=None, materialize=False,
+                        partitioning=None):
+        """Makes the universal object a selection from the sql table that 
+        another UObject represents, computed in the database rather than by
+        reading the table into numpy.
+
+        The selection is created in the parent's database with CREATE VIEW,
+        or with CREATE TABLE AS if materialize is True, and the UObject is 
+        written as if by from_sql.
+
+        Parameters
+        ----------
+        parent : UObject
+            A UObject in its read phase with the "sql" storage method. 
+            Calling this method does not count as invoking one of the 
+            parent's "to\_" methods.
+        columns : list of str or None
+            The columns of parent to include, in the order that they will
+            appear in the selection. If None, all columns are included.
+        rename : list of str or None
+            The names that the included columns will have in the selection,
+            in the same order as columns. If None, the names are unchanged.
+        where : (sqlalchemy.schema.Table -> sqlalchemy.sql.ClauseElement) or None
+            A function that, given the parent's table, returns the clause
+            that included rows must satisfy. If None, all rows are included.
+        order_by : list of str or None
+            Columns of parent to sort the selection by, most significant 
+            first. Columns prefixed with '-' are sorted in descending order.
+            If None, the selection is in the database's order.
+        limit : int or None
+            If not None, at most this many rows are included.
+        materialize : bool
+            If True, the selection is stored in a new table rather than in
+            a view.
+        partitioning : upsg.utils.SQLPartitioning or None
+            As for from_sql
+
+        """
+        if parent.get_phase() != UObjectPhase.Read:
+            raise UObjectException('Parent UObject is not in the read phase')
+        if parent.__storage_method() != 'sql':
+            raise UObjectException('Parent UObject is not stored in sql')
+        sql_table_info = parent.__sql_table()
+        conn = sql_table_info.conn
+        table = sql_table_info.table
+        if columns is None:
+            columns = [col.name for col in table.columns]
+        if rename is None:
+            rename = columns
+        query = sqlalchemy.select(
+            [table.c[col].label(name) for col, name in 
+             it.izip(columns, rename)])
+        if where is not None:
+            query = query.where(where(table))
+        if order_by is not None:
+            query = query.order_by(
+                *[table.c[col[1:]].desc() if col.startswith('-') else 
+                  table.c[col] for col in order_by])
+        if limit is not None:
+            query = query.limit(limit)
+        tbl_name = self.__get_new_table_name()
+        # Databases don't accept bound parameters in CREATE VIEW, so 
+        # literals are rendered into the statement
+        conn.execute('CREATE {} {} AS {}'.format(
+            'TABLE' if materialize else 'VIEW',
+            conn.dialect.identifier_preparer.quote(tbl_name),
+            query.compile(
+                dialect=conn.dialect, 
+                compile_kwargs={'literal_binds': True})))
+        self.from_sql(sql_table_info.db_url, sql_table_info.conn_params,
+                      tbl_name, True, partitioning)
+
     def from_dataframe(self, df):
         self.from_np(obj_to_str(df.to_records(index=False)))
 
     def from_sql(self, db_url, conn_params, table_name,
-                 pipeline_generated_object):
+                 pipeline_generated_object, partitioning=None):
         """
         
         Encodes a sql table in the universal object and prepares
@@ -506,23 +1980,39 @@ class UObject(object):
         pipeline_generated_object : bool
             Whether or not this table should be regarded as a table generated
             by UPSG which, consequently, should not permanently reside in the
-            database. If the table is a pipeline_object, it will be dropped by
-            the cleanup.py utility.
+            database. If the table is a pipeline_object, it is recorded in 
+            the registry (see upsg.registry) and will be dropped by the 
+            cleanup.py utility.
+        partitioning : upsg.utils.SQLPartitioning or None
+            If provided, the table is read in partitions over several 
+            connections in parallel whenever it is converted to another 
+            format (see upsg.utils.sql_to_np)
 
         """
         # TODO start with arbitrary query rather than just tables
+        if pipeline_generated_object:
+            register_table(db_url, conn_params, table_name)
 
         def converter(hfile):
             sql_group = hfile.create_group('/', 'sql')
-            hfile.create_table(
+            self.__create_table(
+                hfile,
                 sql_group,
                 'conn_params',
                 dict_to_np_sa(conn_params))
             hfile.set_node_attr(sql_group, 'db_url', db_url)
-            conn = self.__get_conn(None, db_url, conn_params)
             hfile.set_node_attr(sql_group, 'tbl_name', table_name)
             hfile.set_node_attr(sql_group, 'pipeline_generated',
                                 pipeline_generated_object)
+            if partitioning is not None:
+                hfile.set_node_attr(sql_group, 'partition_col', 
+                                    partitioning.column)
+                hfile.set_node_attr(sql_group, 'n_partitions', 
+                                    partitioning.n_partitions)
+                hfile.set_node_attr(sql_group, 'partition_method', 
+                                    partitioning.method)
+                hfile.set_node_attr(sql_group, 'n_workers', 
+                                    partitioning.n_workers)
             return 'sql'
 
         self.__from(converter)
@@ -538,12 +2028,13 @@ class UObject(object):
 
         """
 
+        sa = dict_to_np_sa(d)
+
         def converter(hfile):
-            np_group = hfile.create_group('/', 'np')
-            hfile.create_table(np_group, 'table', obj=dict_to_np_sa(d))
+            self.__create_np_table(hfile, sa)
             return 'np'
 
-        self.__from(converter)
+        self.__from(converter, sa)
 
     def from_external_file(self, file_name):
         """
@@ -1,17 +1,22 @@
 import os 
 import inspect
+import csv
 import itertools as it
 import re
 import uuid
 import upsg
 import cgi
+from StringIO import StringIO
 import importlib
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 import numpy as np
 from numpy.lib.recfunctions import merge_arrays
+from numpy.lib._iotools import NameValidator
 from sqlalchemy.schema import Table, Column
 from sqlalchemy import MetaData
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, select, and_, or_
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy.types as sqlt
 
@@ -83,6 +88,52 @@ def np_sa_to_nd(sa):
     nd = np.column_stack(cols)
     return (nd, dtype)
 
+def np_nd_recast(nd, dtype=None):
+    """
+
+    Returns the array that np_sa_to_nd(np_nd_to_sa(nd, dtype))[0] would 
+    return without building the intermediate structured array. 
+
+    If every column of dtype has the same type, this is a single cast (or no
+    cast at all if that type is nd.dtype). Otherwise, each column is cast to
+    its own type and then to the most permissive type in dtype.
+
+    Parameters
+    ----------
+    nd : numpy.ndarray
+        A single-type, 0, 1 or 2-dimensional array
+    dtype : numpy.dtype or None (optional)
+        The type of the structured array. If not provided, or None, nd.dtype is
+        used for all columns.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if nd.ndim not in (0, 1, 2):
+        raise TypeError('np_nd_recast only takes 0, 1 or 2-dimensional arrays')
+    if nd.ndim <= 1:
+        nd = nd.reshape(nd.size, 1)
+    n_cols = nd.shape[1]
+    if dtype is None:
+        col_dtypes = [nd.dtype] * n_cols
+    else:
+        col_dtypes = [dtype[i] for i in xrange(len(dtype))]
+    first_dtype = col_dtypes[0]
+    if all(col_dtype == first_dtype for col_dtype in col_dtypes):
+        if first_dtype != nd.dtype:
+            nd = nd.astype(first_dtype)
+    else:
+        most_permissive = max(col_dtypes, key=__type_permissiveness)
+        nd = np.column_stack([nd[:, i].astype(col_dtype).astype(
+                                  most_permissive) for 
+                              i, col_dtype in enumerate(col_dtypes)])
+    if n_cols == 1:
+        if nd.size == 1:
+            return nd.reshape(())
+        return nd.reshape(nd.shape[0])
+    return nd
+
 def np_nd_to_sa(nd, dtype=None):
     """
     
@@ -120,8 +171,122 @@ def np_nd_to_sa(nd, dtype=None):
     if all(dtype[i] == nd_dtype for i in xrange(len(dtype))):
         return nd.reshape(nd.size).view(dtype)
     # if the user requests an incompatible type, we have to convert
-    cols = (nd[:,i].astype(dtype[i]) for i in xrange(len(dtype))) 
-    return np.array(it.izip(*cols), dtype=dtype)
+    sa = np.empty(nd.shape[0], dtype=dtype)
+    for i, name in enumerate(dtype.names):
+        sa[name] = nd[:,i].astype(dtype[i])
+    return sa
+
+
+def np_sa_select_cols(sa, col_names):
+    """
+    
+    Returns a new structured array consisting of the columns of the 
+    structured array sa named in col_names, in the order given by col_names
+
+    """
+    dtype = np.dtype([(str(name), sa.dtype[name]) for name in col_names])
+    selected = np.empty(sa.shape, dtype=dtype)
+    for name in col_names:
+        selected[name] = sa[name]
+    return selected
+
+
+def np_sa_rename_cols(sa, col_names):
+    """
+
+    Returns a view of the structured array sa in which the columns are named,
+    in order, by col_names. sa itself and its dtype are not altered.
+
+    """
+    in_dtype = sa.dtype
+    new_dtype = np.dtype({
+        'names': [str(name) for name in col_names],
+        'formats': [in_dtype[name] for name in in_dtype.names],
+        'offsets': [in_dtype.fields[name][1] for name in in_dtype.names],
+        'itemsize': in_dtype.itemsize})
+    return sa.view(dtype=new_dtype)
+
+
+# constants for np_col_hashes. The per-word step is FNV-1a, and the result is
+# mixed with the MurmurHash3 finalizer
+__FNV_OFFSET = np.uint64(14695981039346656037)
+__FNV_PRIME = np.uint64(1099511628211)
+__MIX_MULT_1 = np.uint64(0xff51afd7ed558ccd)
+__MIX_MULT_2 = np.uint64(0xc4ceb9fe1a85ec53)
+__MIX_SHIFT = np.uint64(33)
+# Rows hashed at a time, so each block's intermediate results stay in cache
+__HASH_BLOCK_ROWS = 16384
+
+
+def np_col_hashes(col):
+    """Returns a numpy.uint64 hash of every element of the 1-dimensional,
+    fixed-width array col. Equal elements have equal hashes."""
+    n = col.shape[0]
+    itemsize = col.dtype.itemsize
+    # Elements are taken 8 bytes at a time where they can be, so most 
+    # columns take a single step
+    word_type = np.uint64 if itemsize % 8 == 0 else np.uint8
+    as_words = np.ascontiguousarray(col).view(word_type).reshape(
+        n, 
+        itemsize // np.dtype(word_type).itemsize)
+    hashes = np.empty(n, dtype=np.uint64)
+    for start in xrange(0, n, __HASH_BLOCK_ROWS):
+        block = hashes[start:start + __HASH_BLOCK_ROWS]
+        block.fill(__FNV_OFFSET)
+        for word_col in as_words[start:start + __HASH_BLOCK_ROWS].T:
+            block ^= word_col
+            block *= __FNV_PRIME
+        block ^= block >> __MIX_SHIFT
+        block *= __MIX_MULT_1
+        block ^= block >> __MIX_SHIFT
+        block *= __MIX_MULT_2
+        block ^= block >> __MIX_SHIFT
+    return hashes
+
+
+def kmv_update(sketch, hashes, k):
+    """Adds hashes to a K-Minimum-Values sketch for distinct counting.
+
+    Parameters
+    ----------
+    sketch : numpy.ndarray of numpy.uint64
+        The current sketch: the sorted, at most k smallest distinct hashes 
+        seen so far. An empty array for a new sketch.
+    hashes : numpy.ndarray of numpy.uint64
+        Hashes of new values, for example from np_col_hashes
+    k : int
+        The size of the sketch
+
+    Returns
+    -------
+    numpy.ndarray of numpy.uint64
+        The updated sketch
+    
+    """
+    if sketch.shape[0] >= k:
+        # Hashes no smaller than the largest in a full sketch can't get in
+        hashes = hashes[hashes < sketch[k - 1]]
+    n = hashes.shape[0]
+    if n > 4 * k:
+        # Hashes are spread evenly, so unless there are many repeated 
+        # values, at least k distinct hashes fall below this bound. If they
+        # do, no hash above it can get in, and we don't have to sort them
+        bound = np.uint64(min(2 ** 64 - 1, 4 * k * 2 ** 64 // n))
+        smallest = np.unique(hashes[hashes < bound])
+        if smallest.shape[0] >= k:
+            hashes = smallest
+    return np.unique(np.concatenate((sketch, hashes)))[:k]
+
+
+def kmv_estimate(sketch, k):
+    """Estimates the number of distinct values summarized by a 
+    K-Minimum-Values sketch made by kmv_update. 
+    
+    The count is exact (barring hash collisions) if there are fewer than k
+    distinct values."""
+    if sketch.shape[0] < k:
+        return sketch.shape[0]
+    return int(round((k - 1) * 2.0 ** 64 / float(sketch[k - 1])))
 
 
 def is_sa(A):
@@ -225,29 +390,23 @@ sql_to_np_types = {
             it.repeat(npt)) for npt in np_to_sql_types))}
 
 
-def sql_to_np(tbl, conn):
-    """Converts a sql table to a Numpy structured array.
-
-    Parameters
-    ----------
-    tbl : sqlalchemy.schema.table
-        Table to convert
-    conn : sqlalchemy.engine.Connectable
-        Connection to use to connect to the database
-
-    Returns
-    -------
-    A Numpy structured array
-
-    """
+# Databases that accept strings longer than a column's declared length
+DIALECTS_IGNORING_STR_LEN = frozenset(('sqlite',))
+# The longest declared string length that is used as a numpy string width
+# as is. Columns declared longer (e.g. VARCHAR(4000)) usually hold much
+# shorter strings, so they are scanned rather than allocating the declared
+# length for every row
+MAX_DECLARED_STR_LEN = 255
 
 
+def __sql_np_dtype(tbl, sql_cols, conn):
+    """Finds the Numpy dtype corresponding to the given columns of tbl"""
     # todo sessionmaker is somehow supposed to be global
     Session = sessionmaker(bind=conn)
     session = Session()
     # first pass, we don't worry about string length
     dtype = []
-    for col in tbl.columns:
+    for col in sql_cols:
         sql_type = col.type
         np_type = None
         try:
@@ -266,24 +425,511 @@ def sql_to_np(tbl, conn):
     # now, we find the max string length for our char columns
     str_cols = [tbl.columns[col_name] for col_name, col_dtype in dtype if
                 col_dtype == np.dtype(str)]
-    query_funcs = [func.max(func.length(col)).label(col.name) for
-                   col in str_cols]
-    query = session.query(*query_funcs)
-    str_lens = {col_name: str_len for col_name, str_len in it.izip(
-        (desc['name'] for desc in query.column_descriptions),
-        query.one())}
+    str_lens = {}
+    if conn.dialect.name not in DIALECTS_IGNORING_STR_LEN:
+        # If the database enforces a declared length, we can use it rather
+        # than scanning the column
+        for col in str_cols:
+            declared_len = getattr(col.type, 'length', None)
+            if declared_len and declared_len <= MAX_DECLARED_STR_LEN:
+                str_lens[col.name] = declared_len
+        str_cols = [col for col in str_cols if col.name not in str_lens]
+    if str_cols:
+        query_funcs = [func.max(func.length(col)).label(col.name) for
+                       col in str_cols]
+        query = session.query(*query_funcs)
+        str_lens.update({col_name: str_len for col_name, str_len in it.izip(
+            (desc['name'] for desc in query.column_descriptions),
+            query.one())})
 
     def corrected_col_dtype(name, col_dtype):
         if col_dtype == np.dtype(str):
-            return (name, '|S{}'.format(str_lens[name]))
+            # empty and all-NULL columns still need a nonzero length
+            return (name, '|S{}'.format(str_lens[name] or 1))
         return (name, col_dtype)
-    dtype_corrected = np.dtype([corrected_col_dtype(*dtype_tuple) for
-                                dtype_tuple in dtype])
-    # np.fromiter can't directly use the results of a query:
-    #   http://mail.scipy.org/pipermail/numpy-discussion/2010-August/052358.html
-    # TODO deal with unicode (which numpy can't handle)
-    return np.fromiter((np_process_row(row, dtype_corrected) for row in
-                        session.query(tbl).all()), dtype=dtype_corrected)
+    return np.dtype([corrected_col_dtype(*dtype_tuple) for
+                     dtype_tuple in dtype])
+
+
+def __sql_cols(tbl, columns):
+    if columns is None:
+        return list(tbl.columns)
+    return [tbl.columns[col_name] for col_name in columns]
+
+
+# What NULLs become in each kind of numpy column
+__SQL_NULL_FILLS = {'S': '', 'i': -999, 'b': False, 'M': np.datetime64('NaT')}
+
+# The number of rows that sql_to_np fetches at a time
+SQL_FETCH_ROWS = 10000
+
+
+def __sql_rows_to_np(rows, dtype, out):
+    """Writes rows fetched from the database into the structured array out,
+    one column at a time. NULLs become '' in string columns, -999 in 
+    integer columns, False in boolean columns, NaT in datetime columns and 
+    NaN otherwise"""
+    if not rows:
+        return
+    for name, col in it.izip(dtype.names, it.izip(*rows)):
+        values = np.array(col, dtype=object)
+        nulls = np.equal(values, None)
+        if nulls.any():
+            values[nulls] = __SQL_NULL_FILLS.get(dtype[name].kind, np.nan)
+        try:
+            out[name] = values
+        except UnicodeEncodeError:
+            out[name] = [utf_to_ascii(val) for val in values]
+
+
+SQLPartitioning_ = namedtuple(
+    'SQLPartitioning', [
+        'column', 'n_partitions', 'method', 'n_workers'])
+
+
+class SQLPartitioning(SQLPartitioning_):
+
+    """A namedtuple describing how to read a sql table in parallel
+
+    The table is split into partitions by the value of a column, and each
+    partition is read over its own connection from the database's pool.
+
+    Attributes
+    ----------
+    column : str
+        The column to partition by
+    n_partitions : int
+        The number of partitions
+    method : {'range', 'hash'}
+        If 'range', the column must be numeric or datetime, and each 
+        partition holds an equal-width range of its values. If 'hash', the
+        column must be integer, and rows are assigned to partitions by the
+        column's value modulo n_partitions.
+    n_workers : int
+        The number of partitions that are read at once. Partitions are held
+        in memory until they have been used, so at most about n_workers 
+        partitions are in memory at a time.
+
+    """
+    pass
+
+
+def __sql_partition_clauses(tbl, conn, partitioning):
+    """Returns a clause selecting each partition of tbl. Rows whose 
+    partitioning column is NULL are in the first partition."""
+    col = tbl.columns[partitioning.column]
+    n = partitioning.n_partitions
+    if partitioning.method == 'hash':
+        clauses = [func.abs(col) % n == i for i in xrange(n)]
+    elif partitioning.method == 'range':
+        lo, hi = conn.execute(select([func.min(col), func.max(col)])).first()
+        if lo is None:
+            # The column is all NULL
+            lo = hi = 0
+        elif isinstance(lo, basestring):
+            raise ValueError('Range partitioning needs a numeric or datetime '
+                             'column, but {} is a string'.format(col.name))
+        bounds = [lo + (hi - lo) * i / n for i in xrange(1, n)]
+        # The first and last partitions are unbounded, so rows added since 
+        # we found the min and max aren't missed
+        clauses = ([col < bounds[0]] + 
+                   [and_(col >= start, col < stop) for start, stop in 
+                    it.izip(bounds[:-1], bounds[1:])] +
+                   [col >= bounds[-1]])
+    else:
+        raise ValueError('Unknown partitioning method {}'.format(
+            partitioning.method))
+    clauses[0] = or_(clauses[0], col.is_(None))
+    return clauses
+
+
+def __sql_partition_to_np(engine, tbl, sql_cols, dtype, clause):
+    """Reads the rows of tbl that satisfy clause over a new connection"""
+    conn = engine.connect()
+    try:
+        return __sql_query_to_np(
+            conn, 
+            select(sql_cols).where(clause),
+            select([func.count()]).select_from(tbl).where(clause),
+            dtype)
+    finally:
+        conn.close()
+
+
+def __sql_partition_arrays(tbl, conn, sql_cols, dtype, partitioning):
+    """Reads partitions of tbl in a thread pool and yields them in order,
+    reading at most partitioning.n_workers ahead of the consumer"""
+    clauses = __sql_partition_clauses(tbl, conn, partitioning)
+    pool = ThreadPool(partitioning.n_workers)
+    pending = deque()
+    try:
+        for clause in clauses:
+            pending.append(pool.apply_async(
+                __sql_partition_to_np, 
+                (conn.engine, tbl, sql_cols, dtype, clause)))
+            if len(pending) >= partitioning.n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def __sql_query_to_np(conn, query, count_query, dtype):
+    """Counts the rows of a query with count_query, then fetches them into
+    a structured array allocated once"""
+    n_rows = conn.execute(count_query).scalar()
+    A = np.empty(n_rows, dtype=dtype)
+    start = 0
+    extra = []
+    for rows in __sql_fetch_blocks(conn, query, SQL_FETCH_ROWS):
+        stop = start + len(rows)
+        if stop > n_rows:
+            # The table grew after we counted it
+            block = np.empty(len(rows), dtype=dtype)
+            __sql_rows_to_np(rows, dtype, block)
+            extra.append(block)
+        else:
+            __sql_rows_to_np(rows, dtype, A[start:stop])
+        start = stop
+    if start < n_rows:
+        # The table shrank after we counted it
+        A = A[:start]
+    if extra:
+        A = np.concatenate([A] + extra)
+    return A
+
+
+def sql_to_np(tbl, conn, columns=None, partitioning=None):
+    """Converts a sql table to a Numpy structured array.
+
+    The rows are counted first so that the array can be allocated once, and
+    are then fetched SQL_FETCH_ROWS at a time from a server-side cursor 
+    (where the database driver supports one) and copied in column by 
+    column.
+
+    Parameters
+    ----------
+    tbl : sqlalchemy.schema.table
+        Table to convert
+    conn : sqlalchemy.engine.Connectable
+        Connection to use to connect to the database
+    columns : list of str or None
+        If provided, only these columns will be selected from the table,
+        in the order given. Otherwise, every column will be selected.
+    partitioning : SQLPartitioning or None
+        If provided, the table is read in partitions, in parallel, over 
+        connections from the pool of conn's engine, and the rows are 
+        ordered by partition. Each of those connections must be able to
+        see the table.
+
+    Returns
+    -------
+    A Numpy structured array
+
+    """
+    sql_cols = __sql_cols(tbl, columns)
+    dtype = __sql_np_dtype(tbl, sql_cols, conn)
+    if partitioning is not None and partitioning.n_partitions > 1:
+        return np.concatenate(list(__sql_partition_arrays(
+            tbl, 
+            conn, 
+            sql_cols, 
+            dtype, 
+            partitioning)))
+    return __sql_query_to_np(
+        conn, 
+        select(sql_cols), 
+        select([func.count()]).select_from(tbl),
+        dtype)
+
+
+def __sql_fetch_blocks(conn, query, block_rows):
+    """Runs query with a server-side cursor, where the database driver
+    supports one, and yields lists of at most block_rows rows. At least one
+    (possibly empty) list is always yielded."""
+    result = conn.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(block_rows)
+            yield rows
+            if len(rows) < block_rows:
+                break
+    finally:
+        result.close()
+
+
+def sql_iter_np(tbl, conn, chunk_rows, columns=None, partitioning=None):
+    """Reads a sql table as a sequence of Numpy structured arrays.
+
+    Rows are fetched from a server-side cursor (where the database driver
+    supports one), so only chunk_rows rows are held in memory at once.
+
+    Parameters
+    ----------
+    tbl : sqlalchemy.schema.table
+        Table to convert
+    conn : sqlalchemy.engine.Connection
+        Connection to use to connect to the database
+    chunk_rows : int
+        The maximum number of rows in each yielded array
+    columns : list of str or None
+        If provided, only these columns will be selected from the table,
+        in the order given. Otherwise, every column will be selected.
+    partitioning : SQLPartitioning or None
+        If provided, the table is read in partitions, in parallel, as by 
+        sql_to_np, and blocks are yielded partition by partition. Whole 
+        partitions, rather than chunk_rows rows, are held in memory.
+
+    Yields
+    ------
+    numpy.ndarray
+        Successive blocks of rows. At least one (possibly empty) block is
+        always yielded.
+
+    """
+    sql_cols = __sql_cols(tbl, columns)
+    dtype = __sql_np_dtype(tbl, sql_cols, conn)
+    if partitioning is not None and partitioning.n_partitions > 1:
+        yielded = False
+        for A in __sql_partition_arrays(tbl, conn, sql_cols, dtype, 
+                                        partitioning):
+            for start in xrange(0, A.shape[0], chunk_rows):
+                yield A[start:start + chunk_rows]
+                yielded = True
+        if not yielded:
+            yield np.empty(0, dtype=dtype)
+        return
+    for rows in __sql_fetch_blocks(conn, select(sql_cols), chunk_rows):
+        A = np.empty(len(rows), dtype=dtype)
+        __sql_rows_to_np(rows, dtype, A)
+        yield A
+
+
+# Number of rows that csv_sample_dtype looks at by default
+CSV_SAMPLE_ROWS = 10000
+
+# The order in which csv columns are tried as each kind of type. A column 
+# that can't be parsed as one kind is tried as the next. Datetimes come
+# between floats and strings if they are being parsed
+__CSV_KINDS = 'bifMS'
+
+
+class CSVSchemaError(ValueError):
+    """Raised by csv_iter_np when the csv contains a value that can't be 
+    parsed as the type of its column. The dtype attribute holds a dtype 
+    that accommodates the value, with which the csv can be read again."""
+
+    def __init__(self, msg, dtype):
+        super(CSVSchemaError, self).__init__(msg)
+        self.dtype = dtype
+
+
+def __csv_rows(csv_file, delimiter):
+    """Returns the names in the header of an open csv file and a reader
+    over the rest of its rows. Comments and blank lines are skipped, as 
+    numpy.genfromtxt does"""
+    header = ''
+    for line in csv_file:
+        if '#' in line:
+            # genfromtxt takes names from a header that is commented out
+            line = ''.join(line.split('#')[1:])
+        if line.strip():
+            header = line
+            break
+    names = NameValidator()(
+        [name.strip() for name in next(csv.reader([header], 
+                                                  delimiter=delimiter))])
+    lines = (line.split('#', 1)[0] if '#' in line else line for 
+             line in csv_file)
+    return names, (row for row in csv.reader(lines, delimiter=delimiter) if 
+                   row)
+
+
+def __csv_block_cols(rows, n_cols, line_num):
+    """Transposes a block of rows read from a csv into an array of strings
+    per column"""
+    for offset, row in enumerate(rows):
+        if len(row) != n_cols:
+            raise ValueError('Row {} has {} columns instead of {}'.format(
+                line_num + offset, 
+                len(row), 
+                n_cols))
+    if not rows:
+        return [np.array([], dtype='S1') for _ in xrange(n_cols)]
+    return [np.array(col, dtype=str) for col in it.izip(*rows)]
+
+
+def __csv_missing(col, strip=False):
+    """Returns a mask of the missing values in an array of strings"""
+    if strip:
+        return np.char.strip(col) == ''
+    return col == ''
+
+
+def __csv_parse_col(col, dtype):
+    """Parses an array of strings as dtype. Missing values become -1 for 
+    ints, False for bools, NaN for floats and NaT for datetimes, as in 
+    numpy.genfromtxt. Raises ValueError if some value can't be parsed as 
+    dtype or, for strings and datetimes, can't be represented by it without
+    losing information"""
+    kind = dtype.kind
+    if kind == 'S':
+        if col.dtype.itemsize > dtype.itemsize:
+            raise ValueError('String too long')
+        return col.astype(dtype)
+    if kind == 'M':
+        parsed = col.astype('M8')
+        if np.promote_types(dtype, parsed.dtype) != dtype:
+            raise ValueError('Datetime finer than {}'.format(dtype))
+        return parsed.astype(dtype)
+    for strip in (False, True):
+        missing = __csv_missing(col, strip)
+        present = col[~missing]
+        try:
+            if kind == 'b':
+                upper = np.char.upper(present)
+                if not np.all((upper == 'TRUE') | (upper == 'FALSE')):
+                    raise ValueError('Not a bool')
+                parsed = upper == 'TRUE'
+            else:
+                parsed = present.astype(dtype)
+        except (ValueError, OverflowError):
+            if strip:
+                raise ValueError('Not a {}'.format(dtype))
+            continue
+        out = np.empty(col.shape[0], dtype=dtype)
+        out[~missing] = parsed
+        out[missing] = {'b': False, 'i': -1, 'f': np.nan}[kind]
+        return out
+
+
+def __csv_col_dtype(col, parse_dates, at_least=None):
+    """Returns the narrowest dtype that can represent every value in an 
+    array of strings and that is no narrower than the dtype at_least"""
+    kinds = __CSV_KINDS if parse_dates else __CSV_KINDS.replace('M', '')
+    if at_least is not None:
+        kinds = kinds[kinds.index(at_least.kind):]
+    for kind in kinds:
+        if kind == 'S':
+            width = col.dtype.itemsize
+            if at_least is not None and at_least.kind == 'S':
+                width = max(width, at_least.itemsize)
+            return np.dtype('S{}'.format(max(width, 1)))
+        if kind == 'M':
+            try:
+                dtype = col.astype('M8').dtype
+            except ValueError:
+                continue
+            if np.datetime_data(dtype)[0] == 'generic':
+                # Nothing but NaTs
+                continue
+            if at_least is not None and at_least.kind == 'M':
+                dtype = np.promote_types(at_least, dtype)
+            return dtype
+        dtype = np.dtype({'b': bool, 'i': np.int64, 'f': float}[kind])
+        try:
+            __csv_parse_col(col, dtype)
+        except ValueError:
+            continue
+        return dtype
+
+
+def csv_sample_dtype(file_name, delimiter=',', sample_rows=CSV_SAMPLE_ROWS,
+                     parse_dates=False):
+    """Infers the dtype of the table in a csv from the first few rows.
+
+    Column names come from the first line of the file and are made valid in
+    the same way that numpy.genfromtxt makes them valid. Each column is 
+    given the first of bool, int, float, datetime64 (if parse_dates) and 
+    string that can represent every value in the sample. Strings are as wide
+    as the longest string in the sample.
+
+    Parameters
+    ----------
+    file_name : str
+        The csv to read
+    delimiter : str
+        The string separating values on each line
+    sample_rows : int
+        The number of rows, after the header, to look at
+    parse_dates : bool
+        Whether or not to give columns holding ISO 8601 dates or datetimes 
+        a datetime64 type
+
+    Returns
+    -------
+    numpy.dtype
+
+    """
+    with open(file_name, 'rb') as csv_file:
+        names, rows = __csv_rows(csv_file, delimiter)
+        cols = __csv_block_cols(list(it.islice(rows, sample_rows)), 
+                                len(names), 2)
+    return np.dtype([(name, __csv_col_dtype(col, parse_dates)) for 
+                     name, col in it.izip(names, cols)])
+
+
+def csv_iter_np(file_name, dtype, chunk_rows, delimiter=',', 
+                parse_dates=False):
+    """Reads a csv as a sequence of Numpy structured arrays.
+
+    Parameters
+    ----------
+    file_name : str
+        The csv to read. Its first line is a header
+    dtype : numpy.dtype
+        The dtype of the table in the csv, as returned by csv_sample_dtype
+    chunk_rows : int
+        The maximum number of rows in each yielded array
+    delimiter : str
+        The string separating values on each line
+    parse_dates : bool
+        Whether or not a column may be widened to a datetime64 type if it
+        turns out not to fit its type in dtype
+
+    Yields
+    ------
+    numpy.ndarray
+        Successive blocks of rows. At least one (possibly empty) block is
+        always yielded.
+
+    Raises
+    ------
+    CSVSchemaError
+        If the csv has values that can't be represented by dtype. The 
+        exception's dtype attribute holds a wider dtype with which the csv
+        should be read again.
+
+    """
+    names = dtype.names
+    line_num = 2
+    with open(file_name, 'rb') as csv_file:
+        _, rows = __csv_rows(csv_file, delimiter)
+        while True:
+            block = list(it.islice(rows, chunk_rows))
+            cols = __csv_block_cols(block, len(names), line_num)
+            A = np.empty(len(block), dtype=dtype)
+            widened = []
+            for name, col in it.izip(names, cols):
+                try:
+                    A[name] = __csv_parse_col(col, dtype[name])
+                except ValueError:
+                    widened.append(name)
+            if widened:
+                raise CSVSchemaError(
+                    'Columns {} need wider types'.format(widened),
+                    np.dtype([(name, __csv_col_dtype(col, parse_dates, 
+                                                     dtype[name]) if 
+                               name in widened else dtype[name]) for 
+                              name, col in it.izip(names, cols)]))
+            line_num += len(block)
+            if line_num > 2 and not block:
+                # The previous block was the last
+                break
+            yield A
+            if len(block) < chunk_rows:
+                break
 
 
 def np_process_row_elmt(entry, dtype):
@@ -319,9 +965,83 @@ def datetime64_to_datetime(dt):
     return datetime.utcfromtimestamp((dt - NP_EPOCH) / NP_SEC_DELTA)
 
 
-def np_to_sql(A, tbl_name, conn):
+# The number of rows that np_to_sql sends to the database at a time
+SQL_INSERT_ROWS = 10000
+
+
+def __np_col_to_py(col):
+    """Converts a column of a structured array to a list of Python objects
+    that DB API drivers understand. Datetimes become datetime.datetimes 
+    (or None for NaT)"""
+    if col.dtype.kind == 'M':
+        # tolist only produces datetimes for units of microseconds or 
+        # coarser
+        return col.astype('M8[us]').tolist()
+    return col.tolist()
+
+
+def __sql_insert_rows(conn, tbl, A, chunk_rows):
+    """Inserts the rows of A into tbl with the DB API executemany, 
+    chunk_rows rows at a time"""
+    dialect = conn.dialect
+    col_names = A.dtype.names
+    compiled = tbl.insert().compile(dialect=dialect, column_keys=col_names)
+    if dialect.positional:
+        keys = compiled.positiontup
+    else:
+        keys = col_names
+    processors = [tbl.c[key].type.dialect_impl(dialect).bind_processor(
+                    dialect) for key in keys]
+    cursor = conn.connection.cursor()
+    try:
+        for start in xrange(0, A.shape[0], chunk_rows):
+            chunk = A[start:start + chunk_rows]
+            cols = []
+            for key, processor in it.izip(keys, processors):
+                col = __np_col_to_py(chunk[key])
+                if processor is not None:
+                    col = [processor(val) for val in col]
+                cols.append(col)
+            if dialect.positional:
+                params = zip(*cols)
+            else:
+                params = [dict(it.izip(keys, row)) for row in it.izip(*cols)]
+            cursor.executemany(unicode(compiled), params)
+    finally:
+        cursor.close()
+
+
+def __sql_copy_rows(conn, tbl, A, chunk_rows):
+    """Inserts the rows of A into tbl with PostgreSQL's COPY FROM STDIN, 
+    chunk_rows rows at a time"""
+    preparer = conn.dialect.identifier_preparer
+    copy_sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
+        preparer.format_table(tbl),
+        ', '.join(preparer.quote(name) for name in A.dtype.names))
+    cursor = conn.connection.cursor()
+    try:
+        for start in xrange(0, A.shape[0], chunk_rows):
+            chunk = A[start:start + chunk_rows]
+            buf = StringIO()
+            # Strings are quoted so that empty strings aren't read as NULLs,
+            # which are written as unquoted empty fields
+            csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC).writerows(
+                it.izip(*[__np_col_to_py(chunk[name]) for name in 
+                          A.dtype.names]))
+            buf.seek(0)
+            cursor.copy_expert(copy_sql, buf)
+    finally:
+        cursor.close()
+
+
+def np_to_sql(A, tbl_name, conn, chunk_rows=SQL_INSERT_ROWS):
     """Converts a numpy structured array to an sql table
 
+    Columns are converted to Python objects a column at a time, and rows 
+    are sent to the database in batches inside a single transaction. On 
+    PostgreSQL (with psycopg2) batches are loaded with COPY FROM STDIN. 
+    Elsewhere, they are inserted with the DB API executemany.
+
     Parameters
     ----------
     A : numpy structured array
@@ -333,6 +1053,9 @@ def np_to_sql(A, tbl_name, conn):
     conn : sqlalchemy.engine.Connectable
         Connection for the sql database
 
+    chunk_rows : int
+        Number of rows to send to the database at a time
+
     Returns
     -------
     sqlalchemy.schema.table 
@@ -345,20 +1068,19 @@ def np_to_sql(A, tbl_name, conn):
     def sql_dtype(col_dtype):
         if col_dtype.char == 'S':
             return sqlt.VARCHAR(col_dtype.itemsize)
+        if col_dtype.kind == 'M':
+            return sqlt.DATETIME
         return np_to_sql_types[col_dtype][0]
     cols = [Column(name, sql_dtype(dtype[name])) for name in col_names]
     md = MetaData()
     tbl = Table(tbl_name, md, *cols)
     md.create_all(conn)
-    # http://stackoverflow.com/questions/7043158/insert-numpy-array-into-mysql-database
-    # TODO find a faster way to fix datetimes
-    conn.execute(
-        tbl.insert(), [
-            dict(
-                it.izip(
-                    col_names, [
-                        datetime64_to_datetime(cell) for cell in row])) for 
-                                row in A])
+    if conn.dialect.name == 'postgresql' and conn.dialect.driver == 'psycopg2':
+        insert_rows = __sql_copy_rows
+    else:
+        insert_rows = __sql_insert_rows
+    with conn.begin():
+        insert_rows(conn, tbl, A, chunk_rows)
     return tbl
 
 
@@ -372,6 +1094,38 @@ def random_table_name():
     return ('_UPSG_' + str(uuid.uuid4())).replace('-', '_')
 
 
+def sql_sample_clause(dialect, fraction):
+    """Returns a clause that is true for a random fraction of the rows of a
+    query, for use in a WHERE.
+
+    The clause is evaluated again each time the query is run, so queries
+    using it should be materialized if the same sample is needed more than
+    once.
+
+    Parameters
+    ----------
+    dialect : sqlalchemy.engine.interfaces.Dialect
+        Dialect of the database that the clause will be run in. SQLite,
+        PostgreSQL and MySQL are supported.
+    fraction : float
+        Expected fraction of rows for which the clause is true. Between 0 
+        and 1.
+
+    Returns
+    -------
+    sqlalchemy.sql.ClauseElement
+
+    """
+    if dialect.name == 'sqlite':
+        # SQLite's random() is a 64-bit signed integer
+        return func.random() / float(2 ** 64) + 0.5 < fraction
+    if dialect.name == 'postgresql':
+        return func.random() < fraction
+    if dialect.name == 'mysql':
+        return func.rand() < fraction
+    raise ValueError('Sampling is not supported for {}'.format(dialect.name))
+
+
 def html_escape(s):
     """Returns a string with all its html-averse characters html escaped"""
     return cgi.escape(s).encode('ascii', 'xmlcharrefreplace')
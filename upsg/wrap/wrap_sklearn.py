@@ -7,7 +7,7 @@ import sklearn.base
 
 from ..stage import RunnableStage
 from ..uobject import UObject, UObjectPhase
-from ..utils import np_nd_to_sa, np_sa_to_nd, import_object_by_name
+from ..utils import import_object_by_name
 
 
 class WrapSKLearnException(Exception):
@@ -50,15 +50,13 @@ def __wrap_estimator(sk_cls):
             try:
                 (A, dtype) = self.__cached_uos[uo]
             except KeyError:
-                A_sa = uo.to_np()
-                A, dtype = np_sa_to_nd(A_sa)
+                A, dtype = uo.to_matrix()
                 self.__cached_uos[uo] = (A, dtype)
             return (A, dtype)
 
         def __np_to_uo(self, A, dtype=None):
-            A_sa = np_nd_to_sa(A, dtype)
             uo_out = UObject(UObjectPhase.Write)
-            uo_out.from_np(A_sa)
+            uo_out.from_matrix(np.asarray(A), dtype)
             return uo_out
 
         __input_keys = set()
@@ -258,8 +256,7 @@ def __wrap_metric(fun):
             return fun(*args, **kwargs)
 
         def __uo_to_np(self, uo):
-            A_sa = uo.to_np()
-            A, dtype = np_sa_to_nd(A_sa)
+            A, dtype = uo.to_matrix()
             return np.ravel(A)
 
         def __init__(self, *args, **kwargs):
@@ -280,7 +277,7 @@ def __wrap_metric(fun):
                 np_out = (np_out,)
             out = {key: UObject(UObjectPhase.Write) for key in
                    self.__output_keys}
-            [out[key].from_np(np_nd_to_sa(np_out[i])) for i, key in
+            [out[key].from_matrix(np.asarray(np_out[i])) for i, key in
                 enumerate(self.__output_keys)]
             return out
 